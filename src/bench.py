@@ -0,0 +1,367 @@
+# benchmarks
+
+"""
+Benchmarks of the hot paths of ppe and ppc on synthetic parallel corpora. The
+corpora are generated from a seed, so runs with the same settings are
+comparable. The timings can be written to a JSON file and compared with the
+timings of an earlier run.
+"""
+
+import argparse
+import json
+import os
+import random
+import shutil
+import sys
+import tempfile
+import time
+import ppe
+import ppc
+
+# number of lexical weights cached in the lex_cache benchmarks
+LEX_CACHE_SIZE = 10000
+
+def synthetic_sentence_pair(rng, length, density, unaligned_rate,
+                            vocabulary_size):
+    """Generate a random sentence pair with a word alignment. Words are drawn
+    from a Zipf-like distribution. Aligned words are linked close to the
+    diagonal.
+
+    Keyword arguments:
+    rng -- random.Random
+    length -- mean number of words of a sentence
+    density -- mean number of links per aligned word in language 1 (>= 1)
+    unaligned_rate -- probability that a word in language 1 is unaligned
+    vocabulary_size -- number of distinct words per language
+
+    Returns 3-tuple (alignment line, l1 line, l2 line)
+    """
+    l1_length = rng.randint(max(1, length // 2), max(1, length * 3 // 2))
+    l2_length = max(1, int(round(l1_length * rng.uniform(0.8, 1.2))))
+    l1_words = ['e%d' % min(int(rng.paretovariate(1.0)), vocabulary_size)
+                for _ in xrange(l1_length)]
+    l2_words = ['f%d' % min(int(rng.paretovariate(1.0)), vocabulary_size)
+                for _ in xrange(l2_length)]
+    links = set()
+    for i in xrange(l1_length):
+        if rng.random() < unaligned_rate:
+            continue
+        center = i * l2_length // l1_length
+        num_links = 1
+        while rng.random() < density - num_links:
+            num_links += 1
+        for _ in xrange(num_links):
+            j = min(max(center + rng.randint(-1, 1), 0), l2_length - 1)
+            links.add((i, j))
+
+    alignment = ' '.join('%d-%d' % link for link in sorted(links))
+    return alignment, ' '.join(l1_words), ' '.join(l2_words)
+
+def write_corpus(directory, num_sentences, length, density, unaligned_rate,
+                 vocabulary_size = 1000, seed = 0):
+    """Write a synthetic corpus made by synthetic_sentence_pair.
+
+    Keyword arguments:
+    directory -- directory for the corpus files
+    num_sentences -- number of sentence pairs
+    seed -- seed of the random generator (default is 0)
+
+    Returns names of the alignments, language 1 and language 2 files
+    """
+    rng = random.Random(seed)
+    names = [os.path.join(directory, '%s.%d.%d' % (name, num_sentences, seed))
+             for name in ('alignments', 'l1', 'l2')]
+    files = [open(name, 'w') for name in names]
+    for _ in xrange(num_sentences):
+        for doc, line in zip(files, synthetic_sentence_pair(rng, length,
+                density, unaligned_rate, vocabulary_size)):
+            doc.write(line + '\n')
+
+    for doc in files:
+        doc.close()
+
+    return names
+
+def read_corpus(alignments_file, language1_file, language2_file):
+    """Read a corpus.
+
+    Returns list of 3-tuples (word alignment, l1 words, l2 words)
+    """
+    return [(ppe.str_to_alignments(align), l1.split(), l2.split())
+            for align, l1, l2 in zip(open(alignments_file),
+                                     open(language1_file),
+                                     open(language2_file))]
+
+def write_moses_phrase_table(file_name, corpus, max_length,
+                             repeated = False):
+    """Write the phrase pairs of a corpus with their word alignments in the
+    moses format, as input of ppe.phrase_pairs_to_file.
+
+    Keyword arguments:
+    file_name -- name of file for writing
+    corpus -- list as returned by read_corpus
+    max_length -- maximum length of phrase pairs
+    repeated -- if True, a line is written for every occurrence of a phrase
+                pair in the corpus, in corpus order, instead of one line per
+                phrase pair (default is False)
+
+    Returns list of all phrase pairs
+    """
+    phrase_alignments = {}
+    occurrences = []
+    for align, l1_words, l2_words in corpus:
+        for min1, min2, max1, max2 in ppe.extract_alignments(set(align),
+                len(l1_words), len(l2_words), max_length):
+            pair = (' '.join(l1_words[min1:max1+1]),
+                    ' '.join(l2_words[min2:max2+1]))
+            phrase_alignments[pair] = ' '.join('%d-%d' % (i - min1, j - min2)
+                for i, j in sorted(align)
+                if min1 <= i <= max1 and min2 <= j <= max2)
+            if repeated:
+                occurrences.append(pair + (phrase_alignments[pair],))
+
+    if not repeated:
+        occurrences = [pair + (phrase_alignments[pair],)
+                       for pair in sorted(phrase_alignments)]
+    doc = open(file_name, 'w')
+    for l1, l2, alignment in occurrences:
+        doc.write('%s ||| %s ||| 1 1 1 1 ||| %s ||| 1 1 1\n' % (l1, l2,
+                                                                alignment))
+    doc.close()
+    return sorted(phrase_alignments)
+
+def write_ppc_table(file_name, phrase_pairs):
+    """Write phrase pairs in the tuple format read by ppc"""
+    doc = open(file_name, 'w')
+    for phrase_pair in phrase_pairs:
+        doc.write('%r\n' % ((phrase_pair, 1.0, 1.0, 1.0),))
+    doc.close()
+
+def best_time(repeat, function, *args):
+    """Call a function repeat times with its output hidden.
+
+    Returns 2-tuple (shortest time in seconds, result of the last call)
+    """
+    best = None
+    stdout = sys.stdout
+    sys.stdout = open(os.devnull, 'w')
+    try:
+        for _ in xrange(repeat):
+            start = time.time()
+            result = function(*args)
+            seconds = time.time() - start
+            if best == None or seconds < best:
+                best = seconds
+    finally:
+        sys.stdout.close()
+        sys.stdout = stdout
+
+    return best, result
+
+def extract_all_alignments(corpus, max_length, algorithm = 'expand'):
+    """Call the extractor of ppe.EXTRACTORS named algorithm for every
+    sentence pair of a corpus"""
+    extract = ppe.EXTRACTORS[algorithm]
+    for align, l1_words, l2_words in corpus:
+        extract(set(align), len(l1_words), len(l2_words), max_length)
+
+def benchmark_scale(directory, num_sentences, length, density,
+                    unaligned_rate, max_length, max_concat, repeat, seed):
+    """Time the hot paths on a synthetic corpus of num_sentences sentence
+    pairs. The held out set of ppc.compare is made from a second corpus of
+    the same size.
+
+    Returns 2-tuple (dictionary mapping the name of a benchmark to seconds,
+            dictionary mapping the name of a benchmark to the hit rate of its
+            lexical weight cache)
+    """
+    files = write_corpus(directory, num_sentences, length, density,
+                         unaligned_rate, seed=seed)
+    corpus = read_corpus(*files)
+    timings = {}
+
+    # the default extractor keeps the plain names, so the timings compare
+    # with earlier runs
+    for algorithm in sorted(ppe.EXTRACTORS):
+        if algorithm == 'expand':
+            suffix = ''
+        else:
+            suffix = ' ' + algorithm
+        timings['extract_alignments' + suffix], _ = best_time(repeat,
+            extract_all_alignments, corpus, max_length, algorithm)
+        timings['extract_phrase_pair_freqs' + suffix], algorithm_freqs = \
+            best_time(repeat, ppe.extract_phrase_pair_freqs, files[0],
+                      files[1], files[2], max_length, None, 1, algorithm)
+        if algorithm == 'expand':
+            phrase_freqs, lex_freqs = algorithm_freqs
+
+    timings['conditional_probabilities'], _ = best_time(
+        repeat, ppe.conditional_probabilities, *phrase_freqs)
+    _, lex_probabilities = best_time(1, ppe.conditional_probabilities,
+                                     *lex_freqs)
+    if ppe.numpy != None:
+        timings['array_probabilities'], _ = best_time(repeat,
+            ppe.array_probabilities, *phrase_freqs)
+
+    phrase_table_file = os.path.join(directory, 'phrase-table.%d' %
+                                     num_sentences)
+    phrase_pairs = write_moses_phrase_table(phrase_table_file, corpus,
+                                            max_length)
+    lex_table = ppe.lexical_table(*lex_probabilities)
+    timings['phrase_pairs_to_file'], _ = best_time(repeat,
+        ppe.phrase_pairs_to_file, os.path.join(directory, 'out'),
+        ppe.CountProbabilities(phrase_freqs), lex_table, phrase_table_file)
+
+    # the lexical weight cache, on the phrase table with one line per phrase
+    # pair and on one with a line per occurrence
+    repeated_table_file = phrase_table_file + '.repeated'
+    write_moses_phrase_table(repeated_table_file, corpus, max_length, True)
+    hit_rates = {}
+    for name, table_file in (('phrase_pairs_to_file lex_cache',
+                              phrase_table_file),
+                             ('phrase_pairs_to_file repeated lex_cache',
+                              repeated_table_file)):
+        timings[name], lex_cache = best_time(repeat,
+            ppe.phrase_pairs_to_file, os.path.join(directory, 'out'),
+            ppe.CountProbabilities(phrase_freqs), lex_table, table_file,
+            None, LEX_CACHE_SIZE)
+        hit_rates[name] = lex_cache.hit_rate()
+    timings['phrase_pairs_to_file repeated'], _ = best_time(repeat,
+        ppe.phrase_pairs_to_file, os.path.join(directory, 'out'),
+        ppe.CountProbabilities(phrase_freqs), lex_table, repeated_table_file)
+
+    held_out_files = write_corpus(directory, num_sentences, length, density,
+                                  unaligned_rate, seed=seed+1)
+    held_out_file = os.path.join(directory, 'held-out.%d' % num_sentences)
+    write_ppc_table(held_out_file, write_moses_phrase_table(
+        held_out_file + '.moses', read_corpus(*held_out_files), max_length))
+    train_table = set(phrase_pairs)
+    for engine in sorted(ppc.COVERAGE_ENGINES):
+        timings['ppc.compare %s' % engine], _ = best_time(repeat,
+            ppc.compare, train_table, held_out_file, max_concat, engine)
+
+    return timings, hit_rates
+
+def run_benchmarks(scales, length, density, unaligned_rate, max_length,
+                   max_concat, repeat = 1, seed = 0):
+    """Run the benchmarks for each number of sentence pairs in scales.
+
+    Returns dictionary with the settings and, for each benchmark, a
+            dictionary mapping the number of sentence pairs to seconds, and
+            for each benchmark with a lexical weight cache a dictionary
+            mapping the number of sentence pairs to its hit rate
+    """
+    directory = tempfile.mkdtemp(prefix='ppe-bench-')
+    results = {}
+    cache_hit_rates = {}
+    try:
+        for num_sentences in scales:
+            print 'benchmark %d sentence pairs' % num_sentences
+            timings, hit_rates = benchmark_scale(directory, num_sentences,
+                length, density, unaligned_rate, max_length, max_concat,
+                repeat, seed)
+            for name, seconds in sorted(timings.iteritems()):
+                if name in hit_rates:
+                    print '  %-40s %.4fs hit rate %.3f' % (name, seconds,
+                                                           hit_rates[name])
+                    cache_hit_rates.setdefault(name, {})[
+                        str(num_sentences)] = hit_rates[name]
+                else:
+                    print '  %-40s %.4fs' % (name, seconds)
+                results.setdefault(name, {})[str(num_sentences)] = seconds
+    finally:
+        shutil.rmtree(directory)
+
+    return {'settings': {'length': length, 'density': density,
+                         'unaligned_rate': unaligned_rate,
+                         'max_length': max_length, 'max_concat': max_concat,
+                         'repeat': repeat, 'seed': seed},
+            'results': results, 'hit_rates': cache_hit_rates}
+
+def compare_results(baseline, current, threshold = 1.1):
+    """Print the ratio between the timings of two runs.
+
+    Keyword arguments:
+    baseline -- results of run_benchmarks of an earlier run
+    current -- results of run_benchmarks
+    threshold -- ratio above which a benchmark is reported as slower, or
+                 below the inverse of which it is reported as faster
+                 (default is 1.1)
+
+    Returns number of benchmarks that are slower
+    """
+    if baseline['settings'] != current['settings']:
+        print 'Warning: settings differ from the baseline: %s' % \
+            baseline['settings']
+
+    slower = 0
+    for name, timings in sorted(current['results'].iteritems()):
+        for scale, seconds in sorted(timings.iteritems(),
+                                     key=lambda item: int(item[0])):
+            base_seconds = baseline['results'].get(name, {}).get(scale)
+            if not base_seconds:
+                continue
+            ratio = seconds / base_seconds
+            if ratio > threshold:
+                verdict = 'slower'
+                slower += 1
+            elif ratio < 1 / threshold:
+                verdict = 'faster'
+            else:
+                verdict = ''
+            print '%-40s %8s %10.4fs %10.4fs %6.2fx %s' % (name, scale,
+                base_seconds, seconds, ratio, verdict)
+
+    return slower
+
+def main():
+    arg_parser = argparse.ArgumentParser()
+    arg_parser.add_argument("-s", "--scales", default='100,1000',
+        help="Comma separated numbers of sentence pairs")
+    arg_parser.add_argument("-l", "--length", type=int, default=10,
+        help="Mean number of words of a sentence")
+    arg_parser.add_argument("-d", "--density", type=float, default=1.2,
+        help="Mean number of links per aligned word")
+    arg_parser.add_argument("-u", "--unaligned_rate", type=float,
+        default=0.1, help="Probability that a word is unaligned")
+    arg_parser.add_argument("-m", "--max_length", type=int, default=5,
+        help="Maximum length of phrase pairs")
+    arg_parser.add_argument("-c", "--max_concat", type=int, default=1,
+        help="Maximum number of concatenations of ppc.compare")
+    arg_parser.add_argument("-r", "--repeat", type=int, default=3,
+        help="Number of times each benchmark is run, the best time counts")
+    arg_parser.add_argument("-seed", "--seed", type=int, default=0,
+        help="Seed of the synthetic corpora")
+    arg_parser.add_argument("-o", "--output",
+        help="Write the results to this JSON file")
+    arg_parser.add_argument("-b", "--baseline",
+        help="JSON file of an earlier run to compare the results with")
+    arg_parser.add_argument("-t", "--threshold", type=float, default=1.1,
+        help="Ratio of the timings above which a benchmark is slower")
+    args = arg_parser.parse_args()
+
+    scales = [int(scale) for scale in args.scales.split(',')]
+    results = run_benchmarks(scales, args.length, args.density,
+        args.unaligned_rate, args.max_length, args.max_concat, args.repeat,
+        args.seed)
+
+    if args.output:
+        doc = open(args.output, 'w')
+        json.dump(results, doc, indent=2, sort_keys=True)
+        doc.write('\n')
+        doc.close()
+        print 'Results written to %s.' % args.output
+
+    if args.baseline:
+        doc = open(args.baseline, 'r')
+        baseline = json.load(doc)
+        doc.close()
+        print ''
+        print '%-40s %8s %11s %11s %7s' % ('benchmark', 'scale', 'baseline',
+                                           'current', 'ratio')
+        slower = compare_results(baseline, results, args.threshold)
+        print '%d benchmarks slower than the baseline' % slower
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,73 @@
+# bloom filter
+
+"""
+Bloom filter of hashable items in a bytearray. A membership test is never
+wrong for an item that was added; an item that was not added is reported
+as present with a small probability, the false positive rate, which
+depends on the number of bits per item. The bit positions of an item are
+derived from its python hash by double hashing, so the filter is only
+valid within the process that built it and its forked children.
+"""
+
+import math
+
+class BloomFilter(object):
+    """Bloom filter with a fixed number of bits.
+
+    Keyword arguments:
+    num_items -- expected number of items
+    bits_per_item -- number of bits per expected item. The number of hash
+                     functions is chosen to minimize the false positive rate
+    """
+
+    def __init__(self, num_items, bits_per_item):
+        self.num_bits = max(int(math.ceil(num_items * bits_per_item)), 8)
+        self.num_hashes = max(int(round(bits_per_item * math.log(2))), 1)
+        self.bits = bytearray((self.num_bits + 7) // 8)
+        self.num_items = 0
+
+    def positions(self, item):
+        """Returns list of the bit positions of an item"""
+        item_hash = hash(item)
+        first = item_hash & 0xffffffff
+        step = (item_hash >> 32 & 0xffffffff) | 1
+        num_bits = self.num_bits
+        return [(first + i * step) % num_bits
+                for i in xrange(self.num_hashes)]
+
+    def add(self, item):
+        """Add an item to the filter"""
+        bits = self.bits
+        for position in self.positions(item):
+            bits[position >> 3] |= 1 << (position & 7)
+        self.num_items += 1
+
+    def update(self, items):
+        """Add all items of an iterable to the filter"""
+        for item in items:
+            self.add(item)
+
+    def __contains__(self, item):
+        # most items that were not added fail at one of the first positions,
+        # so the positions are generated one at a time
+        item_hash = hash(item)
+        position = item_hash & 0xffffffff
+        step = (item_hash >> 32 & 0xffffffff) | 1
+        num_bits = self.num_bits
+        bits = self.bits
+        for _ in xrange(self.num_hashes):
+            position %= num_bits
+            if not bits[position >> 3] & 1 << (position & 7):
+                return False
+            position += step
+
+        return True
+
+    def size(self):
+        """Returns number of bytes of the bits"""
+        return len(self.bits)
+
+    def false_positive_rate(self):
+        """Returns expected false positive rate for the items added so far"""
+        return (1 - math.exp(-self.num_hashes * self.num_items /
+                             float(self.num_bits))) ** self.num_hashes
@@ -0,0 +1,136 @@
+# compressed files
+
+"""
+Transparent reading and writing of gzip, bzip2 and xz compressed files. The
+compression is chosen by the extension of the file name. Compression and
+decompression run in a separate process of a command line tool, preferring
+the multi-threaded ones (pigz, pbzip2, xz -T0), so they run in parallel with
+the pipeline. If no tool is installed, the gzip and bz2 modules are used.
+"""
+
+import bz2
+import gzip
+import os
+import signal
+import subprocess
+from distutils.spawn import find_executable
+
+# extension -> list of (program, decompress arguments, compress arguments) in
+# order of preference
+PROGRAMS = {'.gz': [('pigz', ['-dc'], ['-c']),
+                    ('gzip', ['-dc'], ['-c'])],
+            '.bz2': [('pbzip2', ['-dc'], ['-c']),
+                     ('bzip2', ['-dc'], ['-c'])],
+            '.xz': [('xz', ['-dc', '-T0'], ['-c', '-T0'])]}
+
+# extension -> python module fallback
+MODULES = {'.gz': gzip.open,
+           '.bz2': bz2.BZ2File}
+
+def compression(file_name):
+    """Returns the extension of a compressed file name, or None if the file
+    is not compressed"""
+    extension = os.path.splitext(file_name)[1]
+    if extension in PROGRAMS:
+        return extension
+
+    return None
+
+def insert_suffix(file_name, suffix):
+    """Append suffix to a file name, before the compression extension.
+    E.g. insert_suffix('out.gz', '_lex_e2f') is 'out_lex_e2f.gz'."""
+    extension = compression(file_name)
+    if extension == None:
+        return file_name + suffix
+
+    return file_name[:-len(extension)] + suffix + extension
+
+def restore_sigpipe():
+    """Let the child process be terminated by SIGPIPE when a file is closed
+    before it is read completely, instead of inheriting python's ignored
+    SIGPIPE and reporting an error"""
+    signal.signal(signal.SIGPIPE, signal.SIG_DFL)
+
+def find_program(extension):
+    """Returns the first installed (program, decompress arguments, compress
+    arguments) for an extension, or None"""
+    for program, decompress, compress in PROGRAMS[extension]:
+        path = find_executable(program)
+        if path:
+            return path, decompress, compress
+
+    return None
+
+class PipeFile(object):
+    """File object for the output or input of a compression process. All
+    other attributes are those of the pipe.
+
+    Keyword arguments:
+    process -- subprocess.Popen of the program
+    pipe -- stdout of the process for reading, stdin for writing
+    name -- name of the compressed file
+    program -- name of the program
+    """
+
+    def __init__(self, process, pipe, name, program):
+        self.process = process
+        self.pipe = pipe
+        self.name = name
+        self.program = program
+
+    def __iter__(self):
+        return iter(self.pipe)
+
+    def __getattr__(self, attribute):
+        return getattr(self.pipe, attribute)
+
+    def close(self):
+        """Close the pipe and wait for the process to finish"""
+        if self.pipe.closed:
+            return
+
+        self.pipe.close()
+        if self.process.wait() not in (0, -13):
+            # -13 is SIGPIPE, when a file is closed before it is read
+            # completely
+            raise IOError('%s failed for %s' % (self.program, self.name))
+
+def open_file(file_name, mode = 'r', buffering = -1):
+    """Open a file for reading or writing, which is compressed if its
+    extension is in PROGRAMS. Compressed files can not be opened for
+    appending or seeking.
+
+    Keyword arguments:
+    file_name -- name of file
+    mode -- 'r', 'rb', 'w' or 'wb' for compressed files (default is 'r')
+    buffering -- buffer size, as for open (default is -1)
+
+    Returns file object
+    """
+    extension = compression(file_name)
+    if extension == None:
+        return open(file_name, mode, buffering)
+
+    program = find_program(extension)
+    writing = 'w' in mode
+    if program == None:
+        if extension not in MODULES:
+            raise IOError('No program installed to open %s' % file_name)
+        return MODULES[extension](file_name, 'wb' if writing else 'rb')
+
+    path, decompress, compress = program
+    if writing:
+        output = open(file_name, 'wb')
+        process = subprocess.Popen([path] + compress, stdin=subprocess.PIPE,
+                                   stdout=output, bufsize=buffering)
+        output.close()
+        pipe = process.stdin
+    else:
+        if not os.path.exists(file_name):
+            raise IOError(2, 'No such file or directory', file_name)
+        process = subprocess.Popen([path] + decompress + [file_name],
+                                   stdout=subprocess.PIPE, bufsize=buffering,
+                                   preexec_fn=restore_sigpipe)
+        pipe = process.stdout
+
+    return PipeFile(process, pipe, file_name, os.path.basename(path))
@@ -0,0 +1,132 @@
+# external sort
+
+"""
+Sorting and counting of records that do not fit in memory. Records are
+tuples of strings and numbers. They are written to sorted run files in a
+temporary directory and merged back into a single sorted stream.
+"""
+
+import heapq
+import itertools
+import marshal
+import os
+import tempfile
+
+# maximum number of run files that are read at once by a merge
+MAX_FAN_IN = 64
+
+def write_run(records, tmp_dir):
+    """Write sorted records to a new run file.
+
+    Keyword arguments:
+    records -- sorted iterable of tuples
+    tmp_dir -- directory for the run file
+
+    Returns name of the run file
+    """
+    handle, file_name = tempfile.mkstemp(suffix='.run', dir=tmp_dir)
+    run = os.fdopen(handle, 'wb')
+    for record in records:
+        marshal.dump(record, run)
+
+    run.close()
+    return file_name
+
+def read_run(file_name):
+    """Read the records of a run file.
+
+    Keyword arguments:
+    file_name -- name of a file written by write_run
+
+    Yield records in the order they were written
+    """
+    run = open(file_name, 'rb')
+    try:
+        while True:
+            try:
+                yield marshal.load(run)
+            except EOFError:
+                break
+    finally:
+        run.close()
+
+def merge_runs(run_files, tmp_dir = None, fan_in = MAX_FAN_IN):
+    """k-way merge of sorted run files. At most fan_in files are open at
+    once: as long as there are more runs, every fan_in runs are merged into
+    an intermediate run file, so the number of runs does not run into the
+    limit of open files. An intermediate run is removed when it is merged
+    in a next pass, the runs of the last pass are left in tmp_dir. The
+    given runs are kept.
+
+    Keyword arguments:
+    run_files -- list of names of files written by write_run
+    tmp_dir -- directory for the intermediate run files (default is the
+               directory of the first run file)
+    fan_in -- maximum number of runs that are merged at once, at least 2
+              (default is MAX_FAN_IN)
+
+    Returns iterator over all records in sorted order
+    """
+    if tmp_dir == None and run_files:
+        tmp_dir = os.path.dirname(run_files[0])
+    intermediate = set()
+    while len(run_files) > fan_in:
+        merged_files = []
+        for start in xrange(0, len(run_files), fan_in):
+            group = run_files[start:start + fan_in]
+            if len(group) == 1:
+                merged_files.extend(group)
+                continue
+            merged_file = write_run(heapq.merge(*[read_run(file_name)
+                                                  for file_name in group]),
+                                    tmp_dir)
+            for file_name in intermediate.intersection(group):
+                os.remove(file_name)
+            intermediate.add(merged_file)
+            merged_files.append(merged_file)
+        run_files = merged_files
+
+    return heapq.merge(*[read_run(file_name) for file_name in run_files])
+
+def external_sort(records, budget, tmp_dir, fan_in = MAX_FAN_IN):
+    """Sort records using at most budget records in memory.
+
+    Keyword arguments:
+    records -- iterable of tuples
+    budget -- maximum number of records kept in memory
+    tmp_dir -- directory for the run files
+    fan_in -- maximum number of runs that are merged at once (default is
+              MAX_FAN_IN)
+
+    Returns iterator over the records in sorted order
+    """
+    run_files = []
+    buf = []
+    for record in records:
+        buf.append(record)
+        if len(buf) >= budget:
+            buf.sort()
+            run_files.append(write_run(buf, tmp_dir))
+            buf = []
+
+    buf.sort()
+    if not run_files:
+        return iter(buf)
+
+    run_files.append(write_run(buf, tmp_dir))
+    return merge_runs(run_files, tmp_dir, fan_in)
+
+def sum_sorted(records):
+    """Sum the counts of consecutive records with the same key.
+
+    Keyword arguments:
+    records -- sorted iterable of tuples where the last element is a count
+               and the other elements are the key
+
+    Yield a tuple (key..., count) for every distinct key
+    """
+    for key, group in itertools.groupby(records, lambda record: record[:-1]):
+        total = 0
+        for record in group:
+            total += record[-1]
+        yield key + (total,)
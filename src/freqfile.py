@@ -0,0 +1,228 @@
+# binary frequency file
+
+"""
+Versioned binary file for phrase pair frequencies. The file is memory-mapped
+when it is read, so the arrays are used in place without parsing.
+
+Layout (little-endian, every section starts at a multiple of 8 bytes):
+
+header         magic 'PPEF', uint32 version, uint32 flags, uint32 reserved,
+               uint64 number of strings, uint64 number of tables
+table sizes    uint64 number of pairs for each table
+string offsets uint64[number of strings + 1] into the string data
+string data    the strings, concatenated
+string hashes  uint32[number of strings], sorted hashes of the strings (see
+               string_hash)
+hash ids       uint32[number of strings], id of the string of each hash
+for each table:
+  pair ids     int64[number of pairs], sorted. A pair id is
+               (l1 string id << 32) | l2 string id
+  pair counts  float64[number of pairs]
+  l1 counts    float64[number of strings], count of each string as l1
+  l2 counts    float64[number of strings], count of each string as l2
+"""
+
+import mmap
+import struct
+import zlib
+import numpy
+
+MAGIC = 'PPEF'
+VERSION = 2
+# flags
+INTEGER_COUNTS = 1
+
+HEADER = struct.Struct('<4sIIIQQ')
+
+def padding(size):
+    """Returns number of bytes needed to align size to 8 bytes"""
+    return -size % 8
+
+def string_hash(string):
+    """Returns the hash of a string in the hash index of the file"""
+    return zlib.crc32(string) & 0xffffffff
+
+def write_tables(file_name, strings, tables, flags = 0):
+    """Write strings and frequency tables to a binary file.
+
+    Keyword arguments:
+    file_name -- name of file for writing
+    strings -- list of strings. The ids in the tables are indices in it
+    tables -- list of 4-tuples of numpy arrays (pair ids, pair counts,
+              l1 counts, l2 counts) as described in the module docstring
+    flags -- combination of the flags of this module (default is 0)
+    """
+    doc = open(file_name, 'wb')
+    doc.write(HEADER.pack(MAGIC, VERSION, flags, 0, len(strings),
+                          len(tables)))
+    doc.write(numpy.array([len(table[0]) for table in tables],
+                          '<u8').tostring())
+
+    offsets = numpy.zeros(len(strings) + 1, '<u8')
+    numpy.cumsum([len(string) for string in strings], out=offsets[1:])
+    doc.write(offsets.tostring())
+    doc.write(''.join(strings))
+    doc.write('\0' * padding(int(offsets[-1])))
+
+    hashes = numpy.array([string_hash(string) for string in strings], '<u4')
+    order = numpy.argsort(hashes, kind='mergesort')
+    for section in (hashes[order], order.astype('<u4')):
+        doc.write(section.tostring())
+        doc.write('\0' * padding(section.nbytes))
+
+    for pair_ids, pair_counts, l1_counts, l2_counts in tables:
+        doc.write(numpy.asarray(pair_ids, '<i8').tostring())
+        doc.write(numpy.asarray(pair_counts, '<f8').tostring())
+        doc.write(numpy.asarray(l1_counts, '<f8').tostring())
+        doc.write(numpy.asarray(l2_counts, '<f8').tostring())
+
+    doc.close()
+
+class StringTable(object):
+    """Strings of a binary frequency file, decoded on access.
+
+    Keyword arguments:
+    data -- buffer containing the string data
+    offsets -- numpy array of offsets of the strings
+    base -- position in data the offsets are relative to
+    hashes -- sorted numpy array of the hashes of the strings
+    hash_ids -- numpy array of the id of the string of each hash
+    """
+
+    def __init__(self, data, offsets, base, hashes, hash_ids):
+        self.data = data
+        self.offsets = offsets
+        self.base = base
+        self.hashes = hashes
+        self.hash_ids = hash_ids
+
+    def __getitem__(self, string_id):
+        return self.data[self.base + int(self.offsets[string_id]):
+                         self.base + int(self.offsets[string_id+1])]
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def ids(self):
+        """Returns StringIds mapping each string to its id"""
+        return StringIds(self)
+
+class StringIds(object):
+    """Mapping of the strings of a StringTable to their ids, looked up in the
+    hash index of the file, so no dictionary of all strings is made when the
+    file is read.
+
+    Keyword arguments:
+    strings -- StringTable
+    """
+
+    def __init__(self, strings):
+        self.strings = strings
+
+    def get(self, string, default = None):
+        """Returns the id of string, or default if it is missing"""
+        strings = self.strings
+        hashes = strings.hashes
+        hashed = numpy.uint32(string_hash(string))
+        row = int(numpy.searchsorted(hashes, hashed))
+        # strings with the same hash are next to each other
+        while row < len(hashes) and hashes[row] == hashed:
+            string_id = int(strings.hash_ids[row])
+            if strings[string_id] == string:
+                return string_id
+            row += 1
+
+        return default
+
+    def ids_batch(self, strings):
+        """Find the ids of many strings at once by a single vectorized
+        search of the hash index.
+
+        Keyword arguments:
+        strings -- list of strings, or None for a string that is known to be
+                   missing
+
+        Returns numpy array of the id of each string, -1 if it is missing
+        """
+        hashes = self.strings.hashes
+        if not len(hashes):
+            return numpy.zeros(len(strings), numpy.int64) - 1
+
+        hashed = numpy.array([string_hash(string) if string != None else 0
+                              for string in strings], numpy.uint32)
+        rows = numpy.searchsorted(hashes, hashed)
+        rows[rows == len(hashes)] = 0
+        found = (hashes[rows] == hashed).tolist()
+        ids = []
+        for string, string_id, hash_found in zip(strings,
+                self.strings.hash_ids[rows].tolist(), found):
+            if string == None or not hash_found:
+                ids.append(-1)
+            elif self.strings[string_id] == string:
+                ids.append(string_id)
+            else:
+                # another string with the same hash comes first
+                ids.append(self.get(string, -1))
+
+        return numpy.array(ids, numpy.int64)
+
+    def __getitem__(self, string):
+        string_id = self.get(string)
+        if string_id == None:
+            raise KeyError(string)
+
+        return string_id
+
+    def __contains__(self, string):
+        return self.get(string) != None
+
+    def __len__(self):
+        return len(self.strings)
+
+def read_tables(file_name):
+    """Memory-map a binary frequency file.
+
+    Keyword arguments:
+    file_name -- name of file written by write_tables
+
+    Returns a 3-tuple (flags, StringTable, list of 4-tuples of numpy arrays
+            (pair ids, pair counts, l1 counts, l2 counts))
+    """
+    doc = open(file_name, 'rb')
+    data = mmap.mmap(doc.fileno(), 0, access=mmap.ACCESS_READ)
+    doc.close()
+    magic, version, flags, _, num_strings, num_tables = \
+        HEADER.unpack_from(data, 0)
+    if magic != MAGIC:
+        raise ValueError('%s is not a binary frequency file' % file_name)
+    if version != VERSION:
+        raise ValueError('%s has version %s, expected version %s' %
+                         (file_name, version, VERSION))
+
+    position = HEADER.size
+    num_pairs = numpy.frombuffer(data, '<u8', num_tables, position)
+    position += 8 * num_tables
+    offsets = numpy.frombuffer(data, '<u8', num_strings + 1, position)
+    position += 8 * (num_strings + 1)
+    strings_base = position
+    position += int(offsets[-1]) + padding(int(offsets[-1]))
+    hashes = numpy.frombuffer(data, '<u4', num_strings, position)
+    position += 4 * num_strings + padding(4 * num_strings)
+    hash_ids = numpy.frombuffer(data, '<u4', num_strings, position)
+    position += 4 * num_strings + padding(4 * num_strings)
+    strings = StringTable(data, offsets, strings_base, hashes, hash_ids)
+
+    tables = []
+    for size in num_pairs:
+        size = int(size)
+        pair_ids = numpy.frombuffer(data, '<i8', size, position)
+        position += 8 * size
+        pair_counts = numpy.frombuffer(data, '<f8', size, position)
+        position += 8 * size
+        l1_counts = numpy.frombuffer(data, '<f8', num_strings, position)
+        position += 8 * num_strings
+        l2_counts = numpy.frombuffer(data, '<f8', num_strings, position)
+        position += 8 * num_strings
+        tables.append((pair_ids, pair_counts, l1_counts, l2_counts))
+
+    return flags, strings, tables
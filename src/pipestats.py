@@ -0,0 +1,208 @@
+# pipeline statistics
+
+"""
+Per-stage timing and throughput of the ppe pipeline. A stage runs from its
+start until the next stage starts or the statistics are finished. The report
+is written as JSON.
+
+The peak memory of a stage is that of this process during the stage. On
+Linux 4.0 and later the peak that the kernel keeps (VmHWM) is reset at the
+start of every stage; otherwise the current resident set size is sampled
+by a thread, which can miss short peaks.
+"""
+
+import json
+import os
+import resource
+import threading
+import time
+
+# number of words per bucket of the sentence length histogram
+LENGTH_BUCKET = 10
+# seconds between samples of the resident set size
+RSS_INTERVAL = 0.05
+
+def cpu_time():
+    """Returns user and system time of this process and its finished child
+    processes in seconds"""
+    return sum(os.times()[:4])
+
+def children_peak_rss():
+    """Returns peak resident set size in kilobytes of the largest finished
+    child process"""
+    return resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
+
+def status_kb(field):
+    """Returns value in kilobytes of a field of /proc/self/status, e.g.
+    'VmRSS', or None if it is not available"""
+    try:
+        doc = open('/proc/self/status')
+    except IOError:
+        return None
+
+    try:
+        for line in doc:
+            if line.startswith(field + ':'):
+                return int(line.split()[1])
+    finally:
+        doc.close()
+
+    return None
+
+def reset_peak_rss():
+    """Reset the peak resident set size of this process to its current size.
+
+    Returns True if it was reset
+    """
+    try:
+        doc = open('/proc/self/clear_refs', 'w')
+        doc.write('5')
+        doc.close()
+    except (IOError, OSError):
+        return False
+
+    return status_kb('VmHWM') != None
+
+class StagePeakRSS(object):
+    """Peak resident set size of this process from its creation until
+    stop is called."""
+
+    def __init__(self):
+        self.peak = 0
+        self.thread = None
+        if not reset_peak_rss() and status_kb('VmRSS') != None:
+            self.stopped = threading.Event()
+            self.thread = threading.Thread(target=self.sample)
+            self.thread.daemon = True
+            self.thread.start()
+
+    def sample(self):
+        """Record the current resident set size until stopped"""
+        while not self.stopped.is_set():
+            self.peak = max(self.peak, status_kb('VmRSS'))
+            self.stopped.wait(RSS_INTERVAL)
+
+    def stop(self):
+        """Returns peak in kilobytes, or None if it can not be measured"""
+        if self.thread == None:
+            return status_kb('VmHWM')
+
+        self.stopped.set()
+        self.thread.join()
+        return max(self.peak, status_kb('VmRSS'))
+
+class PipelineStats(object):
+    """Wall and CPU time, item counts and peak memory of the stages of a
+    pipeline, and a histogram of the extraction time per sentence pair keyed
+    by sentence length.
+    """
+
+    def __init__(self):
+        self.stages = []
+        self.current = None
+        self.started = time.time()
+        self.started_cpu = cpu_time()
+        # the kernel's peak is reset by the stages, so the peak of the
+        # whole pipeline is kept here
+        self.peak_rss_kb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        # length bucket -> [sentence pairs, seconds, max seconds]
+        self.sentence_times = {}
+
+    def start(self, name):
+        """Finish the current stage and start a new one"""
+        self.stop()
+        self.current = {'name': name, 'counts': {}, 'values': {},
+                        'wall': time.time(), 'cpu': cpu_time(),
+                        'children_rss': children_peak_rss(),
+                        'rss': StagePeakRSS()}
+
+    def stop(self):
+        """Finish the current stage, if any"""
+        if self.current == None:
+            return
+
+        stage = self.current
+        self.current = None
+        wall_seconds = time.time() - stage['wall']
+        report = {'name': stage['name'],
+                  'wall_seconds': wall_seconds,
+                  'cpu_seconds': cpu_time() - stage['cpu']}
+        peak_rss_kb = stage['rss'].stop()
+        if peak_rss_kb != None:
+            report['peak_rss_kb'] = peak_rss_kb
+            self.peak_rss_kb = max(self.peak_rss_kb, peak_rss_kb)
+        else:
+            # ru_maxrss only grows, so this is the peak up to the end of the
+            # stage
+            report['cumulative_peak_rss_kb'] = resource.getrusage(
+                resource.RUSAGE_SELF).ru_maxrss
+        # the largest child process so far; if it grew, the child finished
+        # during this stage
+        children_rss = children_peak_rss()
+        if children_rss > stage['children_rss']:
+            report['children_peak_rss_kb'] = children_rss
+        for item, count in stage['counts'].iteritems():
+            report[item] = count
+            if wall_seconds > 0:
+                report[item + '_per_second'] = count / wall_seconds
+        report.update(stage['values'])
+        self.stages.append(report)
+
+    def add(self, item, count = 1):
+        """Add count to the number of items processed in the current stage"""
+        counts = self.current['counts']
+        counts[item] = counts.get(item, 0) + count
+
+    def set(self, item, value):
+        """Set a value of the current stage that is not a count of items,
+        e.g. a time or a queue length, so no throughput is derived from
+        it"""
+        self.current['values'][item] = value
+
+    def add_sentence(self, length, phrase_pairs, seconds):
+        """Record the extraction of a sentence pair in the current stage.
+
+        Keyword arguments:
+        length -- number of words of the longest sentence
+        phrase_pairs -- number of phrase pairs extracted
+        seconds -- time the extraction took
+        """
+        self.add('sentences')
+        self.add('phrase_pairs', phrase_pairs)
+        bucket = self.sentence_times.setdefault(length // LENGTH_BUCKET,
+                                                [0, 0.0, 0.0])
+        bucket[0] += 1
+        bucket[1] += seconds
+        bucket[2] = max(bucket[2], seconds)
+
+    def report(self):
+        """Finish the current stage and return the statistics as a
+        dictionary"""
+        self.stop()
+        histogram = []
+        for bucket, (count, seconds, max_seconds) in \
+                sorted(self.sentence_times.iteritems()):
+            histogram.append({
+                'min_length': bucket * LENGTH_BUCKET,
+                'max_length': (bucket + 1) * LENGTH_BUCKET - 1,
+                'sentences': count,
+                'seconds': seconds,
+                'mean_seconds': seconds / count,
+                'max_seconds': max_seconds})
+
+        return {'stages': self.stages,
+                'total': {'wall_seconds': time.time() - self.started,
+                          'cpu_seconds': cpu_time() - self.started_cpu,
+                          'peak_rss_kb': max(self.peak_rss_kb,
+                              resource.getrusage(
+                                  resource.RUSAGE_SELF).ru_maxrss),
+                          'children_peak_rss_kb': children_peak_rss()},
+                'sentence_length_histogram': histogram}
+
+    def write(self, file_name):
+        """Finish the current stage and write the statistics to a JSON
+        file"""
+        doc = open(file_name, 'w')
+        json.dump(self.report(), doc, indent=2, sort_keys=True)
+        doc.write('\n')
+        doc.close()
@@ -6,11 +6,42 @@ By Michael Cabot (6047262) and Sander Nugteren (6042023)
 
 import ast
 import argparse
+import mmap
+import multiprocessing
+import os
+import re
+import shutil
+import struct
+import tempfile
+import compressed
+import extsort
 import ppe
+import progress
+import bloom
 import sys
 import itertools
 
-def compare(train_table, held_out_file, max_concat):
+INDEX_MAGIC = 'PPCI'
+INDEX_VERSION = 1
+# magic, version, maximum phrase lengths (see pack_max_lengths), number of
+# phrase pairs
+INDEX_HEADER = struct.Struct('<4sIIQ')
+# start and end offset of a key
+INDEX_OFFSETS = struct.Struct('<QQ')
+INDEX_OFFSET = struct.Struct('<Q')
+
+# a line of a phrase table as written by repr: ((l1, l2), joint, l1_given_l2,
+# l2_given_l1). Strings with a backslash are left to ast.literal_eval
+TUPLE_LINE = re.compile(r'''^\(\((?:'([^'\\]*)'|"([^"\\]*)"), '''
+                        r'''(?:'([^'\\]*)'|"([^"\\]*)")\), '''
+                        r'''([^,]+), ([^,]+), ([^,)]+)\)$''')
+MOSES_SEPARATOR = ' ||| '
+
+# splits of phrases in span indices by (length, number of concatenations),
+# filled by split_spans
+SPLIT_SPANS = {}
+
+def compare(train_table, held_out_file, max_concat, engine = 'split'):
     """ Explore the coverage (sparsity) of the phrase table by computing 
     the percentage phrase pairs in a held-out set which:
     (a) are available in the training set phrase table, or
@@ -25,30 +56,202 @@ def compare(train_table, held_out_file, max_concat):
     max_concat -- maximum number of concatenations. If max_concat==0, then
                   then whole phrase pair in the held out set must be present
                   in the train table
+    engine -- name of the algorithm in COVERAGE_ENGINES
+              (default is 'split')
     
     Returns coverage of phrase pairs in the held out set
     """
-    held_out_table = read_phrase_table_gen(held_out_file)
+    bar = progress.file_progress(held_out_file)
     correct = 0
     incorrect = 0
-    num_lines = ppe.number_of_lines(held_out_file)
-    for i, phrase_pair in enumerate(held_out_table):
-        if i % (num_lines/100) is 0:
-            sys.stdout.write('\r%d%%' % (i*100/num_lines,))
-            sys.stdout.flush()
-
-        if construct_phrase_pair(phrase_pair, train_table, max_concat):
-            correct += 1
-        else:
-            incorrect += 1
+    for phrase_pairs, position in phrase_pairs_chunks_gen(held_out_file):
+        for phrase_pair in phrase_pairs:
+            if COVERAGE_ENGINES[engine](phrase_pair, train_table, max_concat):
+                correct += 1
+            else:
+                incorrect += 1
+        bar.update(position)
 
-    sys.stdout.write('\n')
+    bar.finish(position)
     return correct/float(correct+incorrect)
 
+def concatenation_histogram(train_table, held_out_file, max_concat,
+                            engine = 'split', workers = 1):
+    """Count the minimum number of concatenations needed to build each phrase
+    pair in a held out set from the phrase pairs in the training set, in a
+    single pass over the held out set.
+
+    Keywords arguments:
+    train_table -- table of phrase pairs from training data
+    held_out_file -- file name of file containing phrase pairs with their
+                     corresponding joint and conditional probabilities
+    max_concat -- largest maximum number of concatenations
+    engine -- name of the algorithm in MIN_CONCAT_ENGINES
+              (default is 'split')
+    workers -- number of processes. If workers > 1 the held out phrase pairs
+               are checked in chunks by a pool of processes (default is 1)
+
+    Returns list where element n is the number of phrase pairs that need n
+            concatenations, and the last element is the number of phrase
+            pairs that need more than max_concat concatenations
+    """
+    if workers > 1:
+        return concatenation_histogram_parallel(train_table, held_out_file,
+            max_concat, engine, workers)
+
+    min_concat = MIN_CONCAT_ENGINES[engine]
+    histogram = [0] * (max_concat + 2)
+    bar = progress.file_progress(held_out_file)
+    position = 0
+    for phrase_pairs, position in phrase_pairs_chunks_gen(held_out_file):
+        for phrase_pair in phrase_pairs:
+            concat_num = min_concat(phrase_pair, train_table, max_concat)
+            if concat_num == None:
+                histogram[-1] += 1
+            else:
+                histogram[concat_num] += 1
+        bar.update(position)
+
+    bar.finish(position)
+    return histogram
+
+# training table of concatenation_histogram_parallel. It is set before the
+# pool is created, so the forked processes share it instead of receiving a
+# pickled copy
+shared_train_table = None
+
+def chunk_histogram(args):
+    """Same as concatenation_histogram for a chunk of held out phrase pairs,
+    checked against shared_train_table. Runs in a pool process.
+
+    Keyword arguments:
+    args -- 4-tuple (list of phrase pairs, max_concat, engine, number of
+            bytes of the held out set read up to the chunk)
+
+    Returns 3-tuple (list with the number of phrase pairs per number of
+            concatenations, number of bytes read, list of the lookup counts
+            of a FilteredPhraseTable made for the chunk, or an empty list)
+    """
+    phrase_pairs, max_concat, engine, position = args
+    min_concat = MIN_CONCAT_ENGINES[engine]
+    histogram = [0] * (max_concat + 2)
+    lookups = getattr(shared_train_table, 'lookups', [])
+    before = list(lookups)
+    for phrase_pair in phrase_pairs:
+        concat_num = min_concat(phrase_pair, shared_train_table, max_concat)
+        if concat_num == None:
+            histogram[-1] += 1
+        else:
+            histogram[concat_num] += 1
+
+    return histogram, position, [count - previous for count, previous in
+                                 zip(lookups, before)]
+
+def chunks_gen(file_name, chunk_size):
+    """Read the phrase pairs of a phrase table in chunks of at most
+    chunk_size phrase pairs.
+
+    Yield 2-tuple (list of phrase pairs, number of bytes read up to the
+    chunk)
+    """
+    previous = 0
+    for phrase_pairs, position in phrase_pairs_chunks_gen(file_name):
+        for start in xrange(0, len(phrase_pairs), chunk_size):
+            end = start + chunk_size
+            yield (phrase_pairs[start:end],
+                   position if end >= len(phrase_pairs) else previous)
+        previous = position
+
+def concatenation_histogram_parallel(train_table, held_out_file, max_concat,
+                                     engine, workers, chunk_size = 1000):
+    """Same as concatenation_histogram, but the held out phrase pairs are
+    checked in chunks by a pool of forked processes that share the training
+    table. The histograms of the chunks are summed.
+
+    Keyword arguments:
+    workers -- number of processes
+    chunk_size -- number of phrase pairs sent to a process at once
+                  (default is 1000)
+
+    Returns the same as concatenation_histogram
+    """
+    global shared_train_table
+    shared_train_table = train_table
+    chunks = ((chunk, max_concat, engine, position) for chunk, position in
+              chunks_gen(held_out_file, chunk_size))
+    histogram = [0] * (max_concat + 2)
+    bar = progress.file_progress(held_out_file)
+    position = 0
+    pool = multiprocessing.Pool(workers)
+    try:
+        for chunk_result, position, lookups in pool.imap(chunk_histogram,
+                                                         chunks):
+            for concat_num, count in enumerate(chunk_result):
+                histogram[concat_num] += count
+            for i, count in enumerate(lookups):
+                train_table.lookups[i] += count
+            bar.update(position)
+    finally:
+        pool.close()
+        pool.join()
+        shared_train_table = None
+
+    bar.finish(position)
+    return histogram
+
+def histogram_coverage(histogram, max_concat):
+    """Compute the coverage for a maximum number of concatenations from the
+    histogram made by concatenation_histogram.
+
+    Keywords arguments:
+    histogram -- list of numbers of phrase pairs per number of concatenations
+    max_concat -- maximum number of concatenations, at most the one the
+                  histogram was made with
+
+    Returns coverage of phrase pairs in the held out set
+    """
+    return sum(histogram[:max_concat+1]) / float(sum(histogram))
+
+def min_concatenations_split(phrase, phrase_table, max_concat):
+    """Find the minimum number of concatenations of phrase pairs in the
+    phrase table that build a phrase pair, using construct_phrase_pair for
+    each number of concatenations.
+
+    Keywords arguments:
+    phrase -- a phrase pair
+    phrase table -- set of phrase pairs
+    max_concat -- maximum number of concatenations
+
+    Returns minimum number of concatenations, or None if it is larger than
+            max_concat
+    """
+    if phrase in phrase_table:
+        return 0
+
+    l1_words = phrase[0].split()
+    l2_words = phrase[1].split()
+    if max_concat < 1 or min(len(l1_words), len(l2_words)) < 2:
+        return None
+    if single_concatenation_match(l1_words, l2_words, phrase_table):
+        return 1
+
+    chart = None
+    for concat_num in xrange(2, min(max_concat, len(l1_words) - 1,
+                                    len(l2_words) - 1) + 1):
+        if chart == None:
+            chart = phrase_pair_chart(l1_words, l2_words, phrase_table)
+        if chart_permutation_match(chart, len(l1_words), len(l2_words),
+                                   concat_num):
+            return concat_num
+
+    return None
+
 def construct_phrase_pair(phrase, phrase_table, max_concat, concat_num = 0):
     """Build phrase pairs by splitting the phrases for each language and check
     if all the phrase pairs in one of the possible alignments between these splits 
-    are present in the phrase table
+    are present in the phrase table. A single concatenation is looked up
+    directly; for more concatenations the splits are checked against a
+    phrase pair chart, so each sub phrase pair is looked up once
     
     Keywords arguments:
     phrase -- a phrase pair
@@ -61,9 +264,317 @@ def construct_phrase_pair(phrase, phrase_table, max_concat, concat_num = 0):
     if concat_num > max_concat:
         return False
 
+    if concat_num == 0:
+        if phrase in phrase_table:
+            return True
+        concat_num = 1
+
+    l1_words = phrase[0].split()
+    l2_words = phrase[1].split()
+    if concat_num > max_concat or concat_num >= min(len(l1_words),
+                                                    len(l2_words)):
+        return False
+
+    if concat_num == 1:
+        if single_concatenation_match(l1_words, l2_words, phrase_table):
+            return True
+        concat_num = 2
+
+    chart = None
+    for concat_num in xrange(concat_num, min(max_concat, len(l1_words) - 1,
+                                             len(l2_words) - 1) + 1):
+        if chart == None:
+            chart = phrase_pair_chart(l1_words, l2_words, phrase_table)
+        if chart_permutation_match(chart, len(l1_words), len(l2_words),
+                                   concat_num):
+            return True
+
+    return False
+
+def single_concatenation_match(l1_words, l2_words, phrase_table):
+    """Check whether a phrase pair is the concatenation of two phrase pairs
+    in the phrase table, in either order of the l2 parts. The parts are
+    looked up directly and the search stops at the first match, which is
+    faster than a phrase pair chart for a single concatenation.
+
+    Keywords arguments:
+    l1_words -- words of the phrase in language 1
+    l2_words -- words of the phrase in language 2
+    phrase table -- set of phrase pairs, or PhraseIndex
+
+    Returns True if both parts of a split form phrase pairs in the table
+    """
+    max1, max2 = max_phrase_lengths(phrase_table)
+    l1_length = len(l1_words)
+    l2_length = len(l2_words)
+    # both parts of a split must be at most as long as the table's phrases
+    l2_splits = [(' '.join(l2_words[:j]), ' '.join(l2_words[j:]))
+                 for j in xrange(max(1, l2_length - max2),
+                                 min(l2_length - 1, max2) + 1)]
+    for i in xrange(max(1, l1_length - max1), min(l1_length - 1, max1) + 1):
+        l1_front = ' '.join(l1_words[:i])
+        l1_back = ' '.join(l1_words[i:])
+        for l2_front, l2_back in l2_splits:
+            if (l1_front, l2_front) in phrase_table and \
+                    (l1_back, l2_back) in phrase_table:
+                return True
+            if (l1_front, l2_back) in phrase_table and \
+                    (l1_back, l2_front) in phrase_table:
+                return True
+
+    return False
+
+def chart_permutation_match(chart, l1_length, l2_length, concat_num):
+    """Check all splits of both phrases in concat_num+1 parts and all
+    alignments between the parts against a phrase pair chart.
+
+    Keywords arguments:
+    chart -- phrase pair chart as made by phrase_pair_chart
+    l1_length -- number of words of the phrase in language 1
+    l2_length -- number of words of the phrase in language 2
+    concat_num -- number of concatenations
+
+    Returns True if all parts of a split form phrase pairs in the chart
+    """
+    for l1_spans in split_spans(l1_length, concat_num):
+        l2_bits = [chart[l1_index] for l1_index in l1_spans]
+        for l2_spans in split_spans(l2_length, concat_num):
+            for permutation in itertools.permutations(l2_spans):
+                match = True
+                for i in xrange(concat_num+1):
+                    if not l2_bits[i] >> permutation[i] & 1:
+                        match = False
+                        break
+
+                if match:
+                    return True
+
+    return False
+
+def split_spans(length, concat_num):
+    """Split a phrase in concat_num+1 parts in all possible ways. The splits
+    only depend on the length, so they are made once and kept in
+    SPLIT_SPANS.
+
+    Keywords arguments:
+    length -- number of words of the phrase
+    concat_num -- number of concatenations
+
+    Returns list of tuples of the span indices (see span_index) of the parts
+    """
+    splits = SPLIT_SPANS.get((length, concat_num))
+    if splits == None:
+        splits = []
+        for cuts in itertools.combinations(xrange(1, length), concat_num):
+            bounds = (0,) + cuts + (length,)
+            splits.append(tuple(span_index(length, bounds[i], bounds[i+1])
+                                for i in xrange(concat_num+1)))
+        SPLIT_SPANS[length, concat_num] = splits
+
+    return splits
+
+def span_index(length, start, end):
+    """Index of the span [start, end) of a phrase of length words in a
+    phrase pair chart"""
+    return start * length + end - 1
+
+def span_strings(words, max_length):
+    """Find the sub-phrases of a phrase, joining the words of each span only
+    once.
+
+    Keywords arguments:
+    words -- words of the phrase
+    max_length -- maximum number of words of a sub-phrase
+
+    Returns dictionary mapping each sub-phrase to the list of its span
+            indices (see span_index)
+    """
+    length = len(words)
+    spans = {}
+    for start in xrange(length):
+        sub_phrase = words[start]
+        # span_index of [start, start+1)
+        index = start * length + start
+        last = min(start + max_length, length)
+        for end in xrange(start+1, last + 1):
+            if end > start + 1:
+                sub_phrase += ' ' + words[end-1]
+            if sub_phrase in spans:
+                spans[sub_phrase].append(index)
+            else:
+                spans[sub_phrase] = [index]
+            index += 1
+
+    return spans
+
+def max_phrase_lengths(phrase_table):
+    """Returns 2-tuple of the maximum number of words of the phrases in
+    each language of a phrase table, or of unlimited lengths if the table
+    does not know them"""
+    max_lengths = getattr(phrase_table, 'max_lengths', None)
+    if not max_lengths:
+        return float('inf'), float('inf')
+
+    return max_lengths
+
+def phrase_pair_chart(l1_words, l2_words, phrase_table):
+    """Find which pairs of sub-phrases of a phrase pair are in the phrase
+    table. Sub-phrases longer than the phrases of the table are skipped and
+    the other pairs are looked up at once.
+
+    Keywords arguments:
+    l1_words -- words of the phrase in language 1
+    l2_words -- words of the phrase in language 2
+    phrase table -- set of phrase pairs, or PhraseIndex
+
+    Returns list that has for each l1 span index (see span_index) a bitset
+            of the l2 span indices that form a phrase pair in the table
+    """
+    max1, max2 = max_phrase_lengths(phrase_table)
+    l1_spans = span_strings(l1_words, max1)
+    l2_spans = span_strings(l2_words, max2)
+    chart = [0] * (len(l1_words) * len(l1_words))
+    for l1_phrase, l2_phrase in phrase_table.intersection(
+            itertools.product(l1_spans, l2_spans)):
+        for l1_index in l1_spans[l1_phrase]:
+            for l2_index in l2_spans[l2_phrase]:
+                chart[l1_index] |= 1 << l2_index
+
+    return chart
+
+
+def min_concatenations(phrase, phrase_table, max_concat):
+    """Find the minimum number of concatenations of phrase pairs in the
+    phrase table that build a phrase pair, in the same way as
+    construct_phrase_pair. Uses a breadth-first search over the position in
+    the l1 phrase and the set of covered l2 words, where the l2 sub-phrases
+    may be in any order, with the sub-phrase pairs of a phrase pair chart.
+
+    Keywords arguments:
+    phrase -- a phrase pair
+    phrase table -- set of phrase pairs
+    max_concat -- maximum number of concatenations
+
+    Returns minimum number of concatenations, or None if it is larger than
+            max_concat
+    """
+    if phrase in phrase_table:
+        return 0
+
+    l1_words = phrase[0].split()
+    l2_words = phrase[1].split()
+    l1_length = len(l1_words)
+    l2_length = len(l2_words)
+    if max_concat < 1 or min(l1_length, l2_length) < 2:
+        return None
+    if single_concatenation_match(l1_words, l2_words, phrase_table):
+        return 1
+    if max_concat < 2 or min(l1_length, l2_length) < 3:
+        return None
+
+    chart = phrase_pair_chart(l1_words, l2_words, phrase_table)
+    # l2 words covered by each l2 span index
+    l2_covered = [0] * (l2_length * l2_length)
+    for start2 in xrange(l2_length):
+        for end2 in xrange(start2+1, l2_length+1):
+            l2_covered[span_index(l2_length, start2, end2)] = \
+                ((1 << end2) - 1) ^ ((1 << start2) - 1)
+    all_covered = (1 << l2_length) - 1
+
+    # states (start of the uncovered l1 words, covered l2 words) after
+    # concat_num concatenations
+    states = set([(0, 0)])
+    for concat_num in xrange(max_concat+1):
+        next_states = set()
+        for start1, covered in states:
+            for end1 in xrange(start1+1, l1_length+1):
+                l2_bits = chart[span_index(l1_length, start1, end1)]
+                while l2_bits:
+                    l2_bit = l2_bits & -l2_bits
+                    l2_bits ^= l2_bit
+                    span = l2_covered[l2_bit.bit_length() - 1]
+                    if covered & span:
+                        continue
+                    if end1 == l1_length:
+                        if covered | span == all_covered:
+                            return concat_num
+                    else:
+                        next_states.add((end1, covered | span))
+        states = next_states
+
+    return None
+
+def construct_phrase_pair_chart(phrase, phrase_table, max_concat):
+    """Same as construct_phrase_pair, but uses min_concatenations instead of
+    trying all splits and permutations.
+
+    Keywords arguments:
+    phrase -- a phrase pair
+    phrase table -- set of phrase pairs
+    max_concat -- maximum number of concatenations
+
+    Returns True if all sub phrase pairs are in the phrase table
+    """
+    return min_concatenations(phrase, phrase_table, max_concat) != None
+
+def construct_phrase_pair_bruteforce(phrase, phrase_table, max_concat,
+                                     concat_num = 0):
+    """Same as construct_phrase_pair, but tries every split of both phrases
+    and every permutation of the l2 split, looking up each sub phrase pair
+    on its own. Slow, but independent of the charts of the other engines,
+    so it is the reference of test_coverage_parity.
+
+    Keywords arguments:
+    phrase -- a phrase pair
+    phrase table -- set of phrase pairs
+    max_concat -- maximum number of concatenations
+    concat_num -- current number of concatenation (default is 0)
+
+    Returns True if all sub phrase pairs are in the phrase table
+    """
+    if concat_num > max_concat:
+        return False
+
+    if permutation_match(phrase, phrase_table, concat_num):
+        return True
+
+    return construct_phrase_pair_bruteforce(phrase, phrase_table, max_concat,
+                                            concat_num+1)
+
+def min_concatenations_bruteforce(phrase, phrase_table, max_concat):
+    """Same as min_concatenations, but tries every split and permutation
+    as construct_phrase_pair_bruteforce.
+
+    Keywords arguments:
+    phrase -- a phrase pair
+    phrase table -- set of phrase pairs
+    max_concat -- maximum number of concatenations
+
+    Returns minimum number of concatenations, or None if it is larger than
+            max_concat
+    """
+    for concat_num in xrange(max_concat+1):
+        if permutation_match(phrase, phrase_table, concat_num):
+            return concat_num
+
+    return None
+
+def permutation_match(phrase, phrase_table, concat_num):
+    """Check every split of both phrases in concat_num+1 parts and every
+    permutation of the l2 parts, looking up each sub phrase pair in the
+    phrase table.
+
+    Keywords arguments:
+    phrase -- a phrase pair
+    phrase table -- set of phrase pairs
+    concat_num -- number of concatenations
+
+    Returns True if all parts of a split form phrase pairs in the table
+    """
     l1_phrase_splits = all_splits(concat_num, phrase[0])
     l2_phrase_splits = all_splits(concat_num, phrase[1])
-    for l1_phrase, l2_phrase in itertools.product(l1_phrase_splits, l2_phrase_splits):
+    for l1_phrase, l2_phrase in itertools.product(l1_phrase_splits,
+                                                  l2_phrase_splits):
         for permutation in itertools.permutations(l2_phrase):
             match = True
             for i in xrange(concat_num+1):
@@ -71,12 +582,60 @@ def construct_phrase_pair(phrase, phrase_table, max_concat, concat_num = 0):
                 if sub_phrase not in phrase_table:
                     match = False
                     break
-        
+
             if match:
                 return True
 
-    return construct_phrase_pair(phrase, phrase_table, max_concat, concat_num+1)
-    
+    return False
+
+# algorithms for checking whether a phrase pair can be constructed from the
+# phrase table, selected by name: 'permutation' looks up every split and
+# permutation of the sub phrase pairs on its own, 'split' checks every split
+# and permutation against a phrase pair chart and 'chart' searches the chart
+# breadth-first
+COVERAGE_ENGINES = {'permutation': construct_phrase_pair_bruteforce,
+                    'split': construct_phrase_pair,
+                    'chart': construct_phrase_pair_chart}
+
+# algorithms for finding the minimum number of concatenations, selected by
+# the same names as COVERAGE_ENGINES
+MIN_CONCAT_ENGINES = {'permutation': min_concatenations_bruteforce,
+                      'split': min_concatenations_split,
+                      'chart': min_concatenations}
+
+def test_coverage_parity(phrase_table, held_out_file, max_concats = (0, 1, 2)):
+    """Check that all engines in COVERAGE_ENGINES agree with
+    construct_phrase_pair_bruteforce, and all engines in MIN_CONCAT_ENGINES
+    with min_concatenations_bruteforce, for the phrase pairs in a held out
+    set.
+
+    Keywords arguments:
+    phrase_table -- set of phrase pairs
+    held_out_file -- name of file containing phrase table
+    max_concats -- maximum numbers of concatenations to test with
+
+    Returns True if all engines agree
+    """
+    agree = True
+    for phrase_pair in read_phrase_table_gen(held_out_file):
+        for max_concat in max_concats:
+            expected = construct_phrase_pair_bruteforce(phrase_pair,
+                phrase_table, max_concat)
+            for name, engine in sorted(COVERAGE_ENGINES.iteritems()):
+                if engine(phrase_pair, phrase_table, max_concat) != expected:
+                    agree = False
+                    print '%s differs (max concat %s): %s' % (name,
+                        max_concat, phrase_pair)
+            expected = min_concatenations_bruteforce(phrase_pair,
+                phrase_table, max_concat)
+            for name, engine in sorted(MIN_CONCAT_ENGINES.iteritems()):
+                if engine(phrase_pair, phrase_table, max_concat) != expected:
+                    agree = False
+                    print '%s min concatenations differ (max concat %s): ' \
+                        '%s' % (name, max_concat, phrase_pair)
+
+    return agree
+
 def all_splits(splits, str_words):
     """Construct all possible splits of a phrase
     
@@ -102,20 +661,152 @@ def all_splits(splits, str_words):
 
     return split_words
 
+def parse_number(string):
+    """Parse an int or float as written by repr"""
+    if '.' in string or 'e' in string or 'n' in string:
+        return float(string)
+
+    return int(string)
+
+def parse_tuple_line(line):
+    """Parse a line of a phrase table in the tuple format. Same as
+    ast.literal_eval, but matches the common case with a regular expression.
+
+    Keywords arguments:
+    line -- line containing ((l1, l2), joint, l1_given_l2, l2_given_l1)
+
+    Returns 4-tuple (phrase pair, joint, l1_given_l2, l2_given_l1)
+    """
+    match = TUPLE_LINE.match(line.rstrip())
+    if match == None:
+        return ast.literal_eval(line.strip())
+
+    l1, l1_double, l2, l2_double, joint, l1_given_l2, l2_given_l1 = \
+        match.groups()
+    if l1 == None:
+        l1 = l1_double
+    if l2 == None:
+        l2 = l2_double
+
+    return ((l1, l2), parse_number(joint), parse_number(l1_given_l2),
+            parse_number(l2_given_l1))
+
+def parse_moses_line(line):
+    """Parse a line of a phrase table in the moses format, as written by
+    ppe.phrase_pairs_to_file.
+
+    Keywords arguments:
+    line -- line containing l1 ||| l2 ||| scores ||| ...
+
+    Returns 2-tuple (phrase pair, list of scores)
+    """
+    fields = line.rstrip('\n').split(MOSES_SEPARATOR, 3)
+    return (fields[0], fields[1]), [float(score) for score in
+                                    fields[2].split()]
+
+def phrase_table_format(file_name):
+    """Detect the format of a phrase table from its first line.
+
+    Returns 'moses' or 'tuple'
+    """
+    doc = compressed.open_file(file_name, 'r')
+    line = doc.readline()
+    doc.close()
+    if not line.startswith('((') and MOSES_SEPARATOR in line:
+        return 'moses'
+
+    return 'tuple'
+
+def read_lines_gen(file_name, buffer_size = ppe.BUFFER_SIZE):
+    """Read a file in chunks of lines.
+
+    Keywords arguments:
+    file_name -- name of file
+    buffer_size -- approximate number of bytes per chunk
+                   (default is ppe.BUFFER_SIZE)
+
+    Yield 2-tuple (list of lines, number of bytes read so far)
+    """
+    doc = compressed.open_file(file_name, 'r', buffer_size)
+    position = 0
+    while True:
+        lines = doc.readlines(buffer_size)
+        if not lines:
+            break
+        position += sum(len(line) for line in lines)
+        yield lines, position
+
+    doc.close()
+
+def phrase_pairs_chunks_gen(file_name):
+    """Read the phrase pairs of a phrase table in the tuple or moses format
+    in chunks.
+
+    Keywords arguments:
+    file_name -- name of file containing phrase table
+
+    Yield 2-tuple (list of phrase pairs, number of bytes read so far)
+    """
+    if phrase_table_format(file_name) == 'moses':
+        for lines, position in read_lines_gen(file_name):
+            yield ([tuple(line.split(MOSES_SEPARATOR, 2)[:2])
+                    for line in lines], position)
+    else:
+        match = TUPLE_LINE.match
+        for lines, position in read_lines_gen(file_name):
+            phrase_pairs = []
+            for line in lines:
+                groups = match(line.rstrip())
+                if groups == None:
+                    phrase_pairs.append(parse_tuple_line(line)[0])
+                else:
+                    l1, l1_double, l2, l2_double = groups.group(1, 2, 3, 4)
+                    phrase_pairs.append((l1 if l1 != None else l1_double,
+                                         l2 if l2 != None else l2_double))
+            yield phrase_pairs, position
+
 def read_phrase_table_gen(file_name):
-    """Read phrase pairs from a file
+    """Read phrase pairs from a file in the tuple or moses format
     
     Keywords arguments:
     file_name -- name of file containing phrase table
     
     Yield phrase pair
     """
-    doc = open(file_name, 'r')
-    for line in doc:
-        phrase_pair, _, _, _ = ast.literal_eval(line.strip())
-        yield phrase_pair
+    for phrase_pairs, _ in phrase_pairs_chunks_gen(file_name):
+        for phrase_pair in phrase_pairs:
+            yield phrase_pair
 
-    doc.close()
+class PhrasePairSet(set):
+    """Set of phrase pairs that knows the maximum number of words of its
+    phrases in each language, so longer sub-phrases are not looked up by
+    phrase_pair_chart.
+
+    Keywords arguments:
+    phrase_pairs -- iterable of phrase pairs (default is ())
+    """
+
+    def __init__(self, phrase_pairs = ()):
+        set.__init__(self)
+        self.max_lengths = (0, 0)
+        self.update(phrase_pairs)
+
+    def update(self, phrase_pairs):
+        """Add phrase pairs to the set"""
+        phrase_pairs = list(phrase_pairs)
+        set.update(self, phrase_pairs)
+        self.max_lengths = max_phrase_pair_lengths(phrase_pairs,
+                                                   self.max_lengths)
+
+def max_phrase_pair_lengths(phrase_pairs, max_lengths = (0, 0)):
+    """Returns 2-tuple of the maximum number of words of the phrases in
+    each language of phrase pairs and max_lengths"""
+    max1, max2 = max_lengths
+    for l1_phrase, l2_phrase in phrase_pairs:
+        max1 = max(max1, l1_phrase.count(' ') + 1)
+        max2 = max(max2, l2_phrase.count(' ') + 1)
+
+    return max1, max2
 
 def read_phrase_table(file_name):
     """Read phrase pairs from a file
@@ -123,62 +814,392 @@ def read_phrase_table(file_name):
     Keywords arguments:
     file_name -- name of file containing phrase table
     
-    Set of all phrase pairs
+    PhrasePairSet of all phrase pairs
     """
     print 'Reading %s ' % file_name
-    doc = open(file_name, 'r')
-    phrase_table = set()
-    num_lines = ppe.number_of_lines(file_name)
-    i = 0
-    for line in doc:
-        if i % (num_lines/100) is 0:
-            sys.stdout.write('\r%d%%' % (i*100/num_lines,))
-            sys.stdout.flush()
-
-        phrase_pair, _, _, _ = ast.literal_eval(line.strip())
-        phrase_table.add(phrase_pair)
-        i += 1
-
-    sys.stdout.write('\n')
-    doc.close()
+    phrase_table = PhrasePairSet()
+    bar = progress.file_progress(file_name)
+    position = 0
+    for phrase_pairs, position in phrase_pairs_chunks_gen(file_name):
+        phrase_table.update(phrase_pairs)
+        bar.update(position)
+
+    bar.finish(position)
     return phrase_table
 
+def test_phrase_table_parser(file_name):
+    """Check that parse_tuple_line and read_phrase_table_gen give the same
+    result as ast.literal_eval, and that the moses phrase table written by
+    phrase_table_to_moses is read back by parse_moses_line and
+    read_phrase_table_gen with the same phrase pairs and P(l2 | l1).
+    Converting the moses phrase table again must give the same file.
+
+    Keywords arguments:
+    file_name -- name of file containing phrase table in the tuple format
+
+    Returns True if the results are the same
+    """
+    expected = [ast.literal_eval(line.strip()) for line in open(file_name)]
+    parsed = [parse_tuple_line(line) for line in open(file_name)]
+    phrase_pairs = list(read_phrase_table_gen(file_name))
+    tmp_dir = tempfile.mkdtemp(prefix='ppc-')
+    try:
+        moses_file = os.path.join(tmp_dir, 'moses')
+        phrase_table_to_moses(file_name, moses_file)
+        moses_lines = [parse_moses_line(line) for line in open(moses_file)]
+        moses_pairs = list(read_phrase_table_gen(moses_file))
+        phrase_table_to_moses(moses_file, moses_file + '.again')
+        same = open(moses_file).read() == open(moses_file + '.again').read()
+    finally:
+        shutil.rmtree(tmp_dir)
+
+    if not same:
+        print 'converting the moses phrase table again changes it'
+    for i, (line_tuple, parsed_tuple) in enumerate(zip(expected, parsed)):
+        if line_tuple != parsed_tuple or \
+                map(type, line_tuple) != map(type, parsed_tuple) or \
+                line_tuple[0] != phrase_pairs[i]:
+            print 'line %d differs: %s %s' % (i+1, line_tuple, parsed_tuple)
+            same = False
+    for i, (line_tuple, (phrase_pair, scores)) in enumerate(zip(expected,
+                                                                moses_lines)):
+        # the score is written as str of the float
+        if phrase_pair != line_tuple[0] or moses_pairs[i] != phrase_pair or \
+                scores != [float(str(line_tuple[3]))]:
+            print 'moses line %d differs: %s %s %s' % (i+1, line_tuple,
+                                                       phrase_pair, scores)
+            same = False
+
+    return same and len(expected) == len(parsed) == len(phrase_pairs) == \
+        len(moses_lines) == len(moses_pairs)
+
+def index_key(phrase_pair):
+    """Key of a phrase pair in a phrase index. The NUL separator makes keys
+    sort like phrase pair tuples."""
+    return '%s\0%s' % phrase_pair
+
+def build_phrase_index(file_name, index_name, budget = 1000000):
+    """Build a phrase index from a phrase table. The index file contains
+    the sorted keys of all phrase pairs and their offsets, so it can be
+    memory-mapped and searched by PhraseIndex.
+
+    Layout (little-endian): header (magic 'PPCI', uint32 version,
+    uint32 maximum phrase lengths (see pack_max_lengths), uint64 number of
+    phrase pairs), uint64 offsets of the keys relative to the start of the
+    key data (number of phrase pairs + 1), key data.
+
+    Keywords arguments:
+    file_name -- name of file containing phrase table
+    index_name -- name of file for writing the index
+    budget -- maximum number of phrase pairs kept in memory for sorting
+    """
+    print 'Building index %s of %s' % (index_name, file_name)
+    tmp_dir = tempfile.mkdtemp(prefix='ppc-')
+    max_lengths = [(0, 0)]
+    def keys_gen():
+        for phrase_pairs, _ in phrase_pairs_chunks_gen(file_name):
+            max_lengths[0] = max_phrase_pair_lengths(phrase_pairs,
+                                                     max_lengths[0])
+            for phrase_pair in phrase_pairs:
+                yield (index_key(phrase_pair),)
+
+    try:
+        keys = extsort.external_sort(keys_gen(), budget, tmp_dir)
+        offsets = open(os.path.join(tmp_dir, 'offsets'), 'wb',
+                       ppe.BUFFER_SIZE)
+        data = open(os.path.join(tmp_dir, 'data'), 'wb', ppe.BUFFER_SIZE)
+        size = 0
+        offset = 0
+        offsets.write(INDEX_OFFSET.pack(offset))
+        for (key,), _ in itertools.groupby(keys):
+            data.write(key)
+            offset += len(key)
+            offsets.write(INDEX_OFFSET.pack(offset))
+            size += 1
+        offsets.close()
+        data.close()
+
+        index = open(index_name, 'wb')
+        index.write(INDEX_HEADER.pack(INDEX_MAGIC, INDEX_VERSION,
+            pack_max_lengths(max_lengths[0]), size))
+        for part in ('offsets', 'data'):
+            doc = open(os.path.join(tmp_dir, part), 'rb')
+            shutil.copyfileobj(doc, index, ppe.BUFFER_SIZE)
+            doc.close()
+        index.close()
+    finally:
+        shutil.rmtree(tmp_dir)
+
+def pack_max_lengths(max_lengths):
+    """Pack the maximum phrase lengths of a phrase index in the uint32 of
+    its header. Lengths of 0xffff words or more are stored as unknown (0).
+    """
+    max1, max2 = max_lengths
+    if max(max1, max2) >= 0xffff:
+        return 0
+
+    return max1 << 16 | max2
+
+def unpack_max_lengths(packed):
+    """Unpack the maximum phrase lengths packed by pack_max_lengths.
+
+    Returns 2-tuple of lengths, or None if they are unknown, as in indexes
+    built before they were stored
+    """
+    if packed == 0:
+        return None
+
+    return packed >> 16, packed & 0xffff
+
+def is_phrase_index(file_name):
+    """Check whether a file is a phrase index made by build_phrase_index."""
+    doc = open(file_name, 'rb')
+    magic = doc.read(len(INDEX_MAGIC))
+    doc.close()
+    return magic == INDEX_MAGIC
+
+class PhraseIndex(object):
+    """Memory-mapped phrase index made by build_phrase_index. Supports
+    membership tests of phrase pairs by binary search, so it can be used
+    instead of the set returned by read_phrase_table. The mapped pages are
+    shared by all processes that open the same index.
+
+    Keywords arguments:
+    file_name -- name of the index file
+    """
+
+    def __init__(self, file_name):
+        doc = open(file_name, 'rb')
+        self.data = mmap.mmap(doc.fileno(), 0, access=mmap.ACCESS_READ)
+        doc.close()
+        magic, version, max_lengths, self.size = INDEX_HEADER.unpack_from(
+            self.data, 0)
+        if magic != INDEX_MAGIC:
+            raise ValueError('%s is not a phrase index' % file_name)
+        if version != INDEX_VERSION:
+            raise ValueError('%s has version %s, expected version %s' %
+                             (file_name, version, INDEX_VERSION))
+        self.max_lengths = unpack_max_lengths(max_lengths)
+        self.offsets_start = INDEX_HEADER.size
+        self.keys_start = self.offsets_start + INDEX_OFFSET.size * \
+            (self.size + 1)
+
+    def key(self, i):
+        """Returns the i-th key in sorted order"""
+        start, end = INDEX_OFFSETS.unpack_from(self.data,
+            self.offsets_start + INDEX_OFFSET.size * i)
+        return self.data[self.keys_start + start:self.keys_start + end]
+
+    def __contains__(self, phrase_pair):
+        key = index_key(phrase_pair)
+        low = 0
+        high = self.size
+        while low < high:
+            middle = (low + high) // 2
+            if self.key(middle) < key:
+                low = middle + 1
+            else:
+                high = middle
+
+        return low < self.size and self.key(low) == key
+
+    def intersection(self, phrase_pairs):
+        """Find which of the given phrase pairs are in the index, in one
+        pass: the keys are sorted, so each binary search starts where the
+        previous one ended.
+
+        Returns set of phrase pairs
+        """
+        found = set()
+        low = 0
+        for key, phrase_pair in sorted((index_key(phrase_pair), phrase_pair)
+                                       for phrase_pair in phrase_pairs):
+            high = self.size
+            while low < high:
+                middle = (low + high) // 2
+                if self.key(middle) < key:
+                    low = middle + 1
+                else:
+                    high = middle
+            if low < self.size and self.key(low) == key:
+                found.add(phrase_pair)
+
+        return found
+
+    def __iter__(self):
+        for i in xrange(self.size):
+            yield tuple(self.key(i).split('\0', 1))
+
+    def __len__(self):
+        return self.size
+
+class FilteredPhraseTable(object):
+    """Phrase table with a Bloom filter of its phrase pairs in front of it.
+    Most sub-phrase pairs that are looked up are not in the table; the
+    filter rejects nearly all of them, and only the pairs that pass it are
+    looked up in the table itself. This helps most with a PhraseIndex, whose
+    lookups are binary searches in a memory-mapped file. The numbers of
+    lookups, of pairs that passed the filter and of pairs that were found
+    are counted in lookups, to measure the false positive rate.
+
+    Keywords arguments:
+    phrase_table -- set of phrase pairs, or PhraseIndex
+    bits_per_pair -- number of bits of the filter per phrase pair
+    """
+
+    def __init__(self, phrase_table, bits_per_pair):
+        self.phrase_table = phrase_table
+        self.max_lengths = getattr(phrase_table, 'max_lengths', None)
+        self.filter = bloom.BloomFilter(len(phrase_table), bits_per_pair)
+        self.filter.update(phrase_table)
+        self.lookups = [0, 0, 0]
+
+    def __contains__(self, phrase_pair):
+        self.lookups[0] += 1
+        if phrase_pair not in self.filter:
+            return False
+
+        self.lookups[1] += 1
+        if phrase_pair in self.phrase_table:
+            self.lookups[2] += 1
+            return True
+
+        return False
+
+    def intersection(self, phrase_pairs):
+        """Find which of the given phrase pairs are in the table, looking up
+        only those that pass the filter.
+
+        Returns set of phrase pairs
+        """
+        phrase_filter = self.filter
+        candidates = list(phrase_pairs)
+        passed = [phrase_pair for phrase_pair in candidates
+                  if phrase_pair in phrase_filter]
+        found = self.phrase_table.intersection(passed)
+        self.lookups[0] += len(candidates)
+        self.lookups[1] += len(passed)
+        self.lookups[2] += len(found)
+        return found
+
+    def __len__(self):
+        return len(self.phrase_table)
+
+def filter_report(phrase_table):
+    """Show the size and the expected and measured false positive rates of
+    the filter of a FilteredPhraseTable. The measured rate is the fraction
+    of the looked up phrase pairs that are not in the table, but passed
+    the filter."""
+    phrase_filter = phrase_table.filter
+    lookups, passed, found = phrase_table.lookups
+    print 'bloom filter: %s, %d hashes' % (
+        progress.format_bytes(phrase_filter.size()), phrase_filter.num_hashes)
+    print 'expected false positive rate: %.6f' % \
+        phrase_filter.false_positive_rate()
+    if lookups > found:
+        print 'measured false positive rate: %.6f (%d of %d lookups ' \
+              'passed the filter)' % ((passed - found) /
+                                      float(lookups - found), passed, lookups)
+
+def load_train_table(file_name, bloom_bits = 0):
+    """Load the phrase pairs of the training set from a phrase index, or
+    from a phrase table if the file is not an index.
+
+    Keywords arguments:
+    file_name -- name of file containing phrase table or phrase index
+    bloom_bits -- number of bits per phrase pair of a Bloom filter in front
+                  of the table, or 0 for no filter (default is 0)
+
+    Returns PhraseIndex, set of phrase pairs or FilteredPhraseTable
+    """
+    if is_phrase_index(file_name):
+        print 'Using index %s' % file_name
+        train_table = PhraseIndex(file_name)
+    else:
+        train_table = read_phrase_table(file_name)
+    if bloom_bits > 0:
+        print 'Building bloom filter of %d phrase pairs' % len(train_table)
+        train_table = FilteredPhraseTable(train_table, bloom_bits)
+
+    return train_table
+
 def phrase_table_to_moses(file_name, out_name):
-    """Read a phrase table and write it to a file using the moses format
+    """Read a phrase table in the tuple or moses format and write it to a
+    file using the moses format with P(l2 | l1) as its only score. In the
+    moses format P(l2 | l1) is the third score, as written by
+    ppe.phrase_pairs_to_file, or the only score, as written by this
+    function.
     
     Keywords arguments:
     file_name -- name of file containing phrase table
     out_name -- name of file for writing phrase table in moses format
     """
-    doc = open(file_name, 'r')
-    out = open(out_name, 'w')
-    for line in doc:
-        phrase_pair, _, _, l2_given_l1 = ast.literal_eval(line.strip())
-        l1, l2 = phrase_pair
-        out.write('%s ||| %s ||| %s ||| |||\n' % (l1, l2, l2_given_l1))
+    moses = phrase_table_format(file_name) == 'moses'
+    out = compressed.open_file(out_name, 'w', ppe.BUFFER_SIZE)
+    for lines, _ in read_lines_gen(file_name):
+        batch = []
+        for line in lines:
+            if moses:
+                phrase_pair, scores = parse_moses_line(line)
+                l2_given_l1 = scores[2] if len(scores) > 2 else scores[0]
+            else:
+                phrase_pair, _, _, l2_given_l1 = parse_tuple_line(line)
+            l1, l2 = phrase_pair
+            batch.append('%s ||| %s ||| %s ||| |||\n' % (l1, l2, l2_given_l1))
+        out.writelines(batch)
 
-    doc.close()
     out.close()
 
 def main():
     arg_parser = argparse.ArgumentParser()
     arg_parser.add_argument("-t", "--trainfile", required=True,
-        help="File containing phrases from the training set")
-    arg_parser.add_argument("-v", "--heldoutfile", required=True,
+        help="File containing phrases from the training set, or a phrase "
+             "index built with --build_index")
+    arg_parser.add_argument("-v", "--heldoutfile",
         help="File containing phrases from the held out set")
-    arg_parser.add_argument("-m", "--max_concat", required=True,
+    arg_parser.add_argument("-m", "--max_concat",
         help="Maximum number of concatenations")
+    arg_parser.add_argument("-i", "--build_index",
+        help="Build a phrase index of the training set, write it to this "
+             "file and exit")
+    arg_parser.add_argument("-e", "--engine", default='split',
+        choices=sorted(COVERAGE_ENGINES),
+        help="Algorithm for checking whether a phrase pair can be built: "
+             "permutation looks up every split and permutation on its own, "
+             "split checks them against a chart of sub phrase pairs, chart "
+             "searches that chart breadth-first")
+    arg_parser.add_argument("-w", "--workers", type=int, default=1,
+        help="Number of processes used for checking the held out phrase "
+             "pairs")
+    arg_parser.add_argument("-b", "--bloom_bits", type=float, default=0,
+        help="Bits per training phrase pair of a Bloom filter that is "
+             "checked before the training table (0 disables the filter)")
     args = arg_parser.parse_args()
+
+    if args.build_index:
+        build_phrase_index(args.trainfile, args.build_index)
+        return
+    if not args.heldoutfile or not args.max_concat:
+        arg_parser.error("--heldoutfile and --max_concat are required")
     
     max_concat_list = [int(m) for m in args.max_concat.split(',')]
     
     print 'train file: %s' % args.trainfile
     print 'held-out file: %s' % args.heldoutfile
     print 'max concat list: %s' % max_concat_list
+    print 'engine: %s' % args.engine
+    print 'workers: %s' % args.workers
+    print 'bloom bits: %s' % args.bloom_bits
     
-    train_table = read_phrase_table(args.trainfile)
+    train_table = load_train_table(args.trainfile, args.bloom_bits)
+    histogram = concatenation_histogram(train_table, args.heldoutfile,
+                                        max(max_concat_list), args.engine,
+                                        args.workers)
+    if args.bloom_bits > 0:
+        filter_report(train_table)
+    print 'concatenations histogram: %s' % histogram
     for max_concat in max_concat_list:
-        coverage = compare(train_table, args.heldoutfile, max_concat)
+        coverage = histogram_coverage(histogram, max_concat)
         print 'max concat: %s' % max_concat
         print 'coverage: %s' % coverage
 
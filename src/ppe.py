@@ -5,38 +5,154 @@ By Michael Cabot (6047262) and Sander Nugteren (6042023)
 """
 
 import argparse
-from collections import Counter
+import array
+import bisect
+from collections import Counter, defaultdict
+import gc
+import hashlib
+import itertools
+import math
+import multiprocessing
+import os
+import shutil
 import sys
 import pickle
+import tempfile
+import threading
+import time
+import traceback
+import compressed
+import extsort
+import pipestats
+import progress
+import prune
+try:
+    import numpy
+    import freqfile
+except ImportError:
+    numpy = None
+
+# buffer size in bytes for reading and writing large files
+BUFFER_SIZE = 1 << 20
+# number of lines that are written to a file at once
+BATCH_SIZE = 10000
+# number of sentence pairs per batch of extract_phrase_pair_freqs_pipelined
+PIPELINE_BATCH_SIZE = 1000
+# number of bytes at the start and end of the extracted part of a corpus file
+# that are hashed for its fingerprint
+FINGERPRINT_SIZE = 1 << 16
+
+class LRUCache(object):
+    """Mapping with a maximum size that discards the least recently used
+    item when it is full. Counts the number of hits and misses.
+
+    Keyword arguments:
+    size -- maximum number of items
+    """
+
+    def __init__(self, size):
+        self.size = size
+        self.hits = 0
+        self.misses = 0
+        # circular doubly linked list of [previous, next, key, value]
+        # starting at the least recently used item
+        self.root = []
+        self.root[:] = [self.root, self.root, None, None]
+        self.links = {}
+
+    def get(self, key, default = None):
+        """Find the value of key and mark it as most recently used.
+
+        Returns value, or default if key is not in the cache
+        """
+        link = self.links.get(key)
+        if link == None:
+            self.misses += 1
+            return default
+
+        self.hits += 1
+        previous, following, _, value = link
+        previous[1] = following
+        following[0] = previous
+        last = self.root[0]
+        last[1] = self.root[0] = link
+        link[0] = last
+        link[1] = self.root
+        return value
+
+    def put(self, key, value):
+        """Add a key to the cache as the most recently used item, discarding
+        the least recently used item if the cache is full. If the key is
+        in the cache already, its value is replaced."""
+        if self.size <= 0:
+            return
+
+        link = self.links.get(key)
+        if link != None:
+            previous, following, _, _ = link
+            previous[1] = following
+            following[0] = previous
+            last = self.root[0]
+            last[1] = self.root[0] = link
+            link[0] = last
+            link[1] = self.root
+            link[3] = value
+            return
+
+        if len(self.links) >= self.size:
+            oldest = self.root[1]
+            self.root[1] = oldest[1]
+            oldest[1][0] = self.root
+            del self.links[oldest[2]]
+
+        last = self.root[0]
+        link = [last, self.root, key, value]
+        last[1] = self.root[0] = self.links[key] = link
+
+    def hit_rate(self):
+        """Returns fraction of lookups that were hits"""
+        lookups = self.hits + self.misses
+        if lookups == 0:
+            return 0.0
+
+        return self.hits / float(lookups)
+
+    def __len__(self):
+        return len(self.links)
 
 def conditional_probabilities(phrase_pair_freqs,
-                              l1_phrase_freqs, l2_phrase_freqs):
+                              l1_phrase_freqs, l2_phrase_freqs,
+                              vocabulary = None):
     """Calculate the conditional probability of phrase pairs in both directions.
 
     Keyword arguments:
     phrase_pair_freqs -- counter of phrase pairs
     l1_phrase_freqs -- counter of phrases in language 1
     l2_phraes_freqs -- counter of phrases in lanuage 2
+    vocabulary -- vocabulary of the phrase ids the counters are keyed by,
+                  or None if they are keyed by strings (default is None)
 
     Returns 2 dictionaries mapping a phrase pair to P(l1 | l2) and P(l2 | l1)
     """
     l1_given_l2 = {}
     l2_given_l1 = {}
-    num_lines = len(phrase_pair_freqs)
+    bar = progress.Progress(len(phrase_pair_freqs), 'pairs')
     for i, (phrase_pair, freq) in enumerate(phrase_pair_freqs.iteritems()):
-        if i % (num_lines/100) == 0:
-            sys.stdout.write('\r%d%%' % (i*100/num_lines,))
-            sys.stdout.flush()
+        bar.update(i)
 
         try:
-            l1_given_l2[phrase_pair] = float(freq) / l1_phrase_freqs[phrase_pair[0]]
-            l2_given_l1[phrase_pair] = float(freq) / l2_phrase_freqs[phrase_pair[1]]
+            if vocabulary:
+                l1_phrase, l2_phrase = id_to_pair(phrase_pair)
+            else:
+                l1_phrase, l2_phrase = phrase_pair
+            l1_given_l2[phrase_pair] = float(freq) / l1_phrase_freqs[l1_phrase]
+            l2_given_l1[phrase_pair] = float(freq) / l2_phrase_freqs[l2_phrase]
         except:
             print 'phrase pair: %s' % (phrase_pair,)
             print 'i: %s' % i
             raise
 
-    sys.stdout.write('\n')
+    bar.finish()
     return l1_given_l2, l2_given_l1
 
 def phrase_probabilities(phrase_freqs):
@@ -71,6 +187,721 @@ def joint_probabilities(l1_given_l2, l2_phrase_probs):
 
     return joint_probs
 
+def phrase_ids_batch(ids, phrases):
+    """Look up the ids of many phrases at once.
+
+    Keyword arguments:
+    ids -- dictionary or freqfile.StringIds mapping phrases to ids
+    phrases -- list of phrases, or None for a phrase that is known to be
+               missing
+
+    Returns numpy array of the id of each phrase, -1 if it is missing
+    """
+    if isinstance(ids, freqfile.StringIds):
+        return ids.ids_batch(phrases)
+
+    return numpy.array([ids.get(phrase, -1) if phrase != None else -1
+                        for phrase in phrases], numpy.int64)
+
+class PairTable(object):
+    """Array-backed table mapping phrase pairs to probabilities. Used instead
+    of a dictionary by array_probabilities.
+
+    Keyword arguments:
+    index -- sorted numpy array of phrase pair ids (see pair_to_id). The
+             position of a pair id is its row
+    values -- numpy array with the probability of each row
+    phrase_rows -- 2-tuple of dictionaries or freqfile.StringIds mapping
+                   phrases in language 1 and 2 to the phrase ids in index, if
+                   the table is looked up by phrase strings (default is None)
+    """
+
+    def __init__(self, index, values, phrase_rows = None):
+        self.index = index
+        self.values = values
+        self.phrase_rows = phrase_rows
+
+    def row(self, pair):
+        """Find the row of a phrase pair. Raises KeyError if it is missing."""
+        if self.phrase_rows:
+            l1_rows, l2_rows = self.phrase_rows
+            pair_id = pair_to_id(l1_rows[pair[0]], l2_rows[pair[1]])
+        else:
+            pair_id = pair
+
+        row = int(numpy.searchsorted(self.index, pair_id))
+        if row == len(self.index) or self.index[row] != pair_id:
+            raise KeyError(pair)
+
+        return row
+
+    def rows_batch(self, pairs):
+        """Find the rows of many phrase pairs at once by a single
+        vectorized binary search.
+
+        Keyword arguments:
+        pairs -- list of phrase pairs, or None for a pair that is known to
+                 be missing
+
+        Returns numpy array of the row of each pair, -1 if it is missing
+        """
+        if self.phrase_rows:
+            l1_ids, l2_ids = [phrase_ids_batch(rows, [
+                pair[side] if pair != None else None for pair in pairs])
+                for side, rows in enumerate(self.phrase_rows)]
+            pair_ids = numpy.where((l1_ids >= 0) & (l2_ids >= 0),
+                                   l1_ids << 32 | l2_ids, -1)
+        else:
+            pair_ids = numpy.array([-1 if pair == None else pair
+                                    for pair in pairs], numpy.int64)
+        if not len(self.index):
+            return numpy.zeros(len(pair_ids), numpy.int64) - 1
+
+        rows = numpy.searchsorted(self.index, pair_ids)
+        rows[rows == len(self.index)] = 0
+        rows[self.index[rows] != pair_ids] = -1
+        return rows
+
+    def __getitem__(self, pair):
+        return float(self.values[self.row(pair)])
+
+    def __contains__(self, pair):
+        try:
+            self.row(pair)
+        except KeyError:
+            return False
+
+        return True
+
+    def __len__(self):
+        return len(self.values)
+
+class CountProbabilities(object):
+    """Conditional probabilities of phrase pairs that are calculated from
+    their counts when they are looked up, with the same values as
+    conditional_probabilities, so no dictionaries of probabilities are made.
+
+    Keyword arguments:
+    freqs -- 3-tuple of counters (phrase pairs, phrases in language 1,
+             phrases in language 2)
+    vocabulary -- vocabulary of the phrase ids the counters are keyed by,
+                  or None if they are keyed by strings (default is None)
+    """
+
+    def __init__(self, freqs, vocabulary = None):
+        self.pair_freqs, self.l1_freqs, self.l2_freqs = freqs
+        self.vocabulary = vocabulary
+
+    def probabilities_batch(self, keys):
+        """Calculate the probabilities of many phrase pairs at once.
+
+        Keyword arguments:
+        keys -- list of phrase pair keys as returned by pair_key
+
+        Returns 2 lists of P(l1 | l2) and P(l2 | l1), with None for a pair
+                that is not counted
+        """
+        pair_freqs = self.pair_freqs
+        freqs = [pair_freqs.get(key) for key in keys]
+        if self.vocabulary:
+            l1_phrases = [key >> 32 if key != None else None for key in keys]
+            l2_phrases = [key & 0xffffffff if key != None else None
+                          for key in keys]
+        else:
+            l1_phrases = [key[0] for key in keys]
+            l2_phrases = [key[1] for key in keys]
+        l1_freqs = self.l1_freqs
+        l2_freqs = self.l2_freqs
+        return ([float(freq) / l1_freqs[phrase] if freq != None else None
+                 for freq, phrase in itertools.izip(freqs, l1_phrases)],
+                [float(freq) / l2_freqs[phrase] if freq != None else None
+                 for freq, phrase in itertools.izip(freqs, l2_phrases)])
+
+    def __len__(self):
+        return len(self.pair_freqs)
+
+class PairTableProbabilities(object):
+    """Conditional probabilities of phrase pairs in two PairTables with the
+    same index, as returned by array_probabilities, looked up in batches.
+
+    Keyword arguments:
+    l1_given_l2 -- PairTable mapping a phrase pair to P(l1 | l2)
+    l2_given_l1 -- PairTable mapping a phrase pair to P(l2 | l1)
+    """
+
+    def __init__(self, l1_given_l2, l2_given_l1):
+        self.l1_given_l2 = l1_given_l2
+        self.l2_given_l1 = l2_given_l1
+
+    def probabilities_batch(self, keys):
+        """Same as CountProbabilities.probabilities_batch"""
+        if not len(self.l1_given_l2):
+            return [None] * len(keys), [None] * len(keys)
+
+        rows = self.l1_given_l2.rows_batch(keys)
+        found = (rows >= 0).tolist()
+        rows[rows < 0] = 0
+        return tuple([[value if row_found else None for value, row_found
+                       in itertools.izip(table.values[rows].tolist(), found)]
+                      for table in (self.l1_given_l2, self.l2_given_l1)])
+
+    def __len__(self):
+        return len(self.l1_given_l2)
+
+class LexicalTable(object):
+    """Lexical translation table mapping word pairs to P(l1 | l2) and
+    P(l2 | l1). The words of each language are numbered and the word pairs
+    are stored by pair id (see pair_to_id) in a sorted array, with the
+    probabilities in two arrays of the same order, so no word pair or
+    probability is a python object. Made by lexical_table.
+
+    Keyword arguments:
+    index -- sorted array of word pair ids: a numpy array, or an array of
+             type 'l' if numpy is not installed
+    l1_given_l2 -- array of P(l1 | l2) of each word pair in index
+    l2_given_l1 -- array of P(l2 | l1) of each word pair in index
+    word_ids -- 2-tuple of dictionaries mapping the words of language 1 and
+                2 to the ids in index
+    """
+
+    def __init__(self, index, l1_given_l2, l2_given_l1, word_ids):
+        self.index = index
+        self.l1_given_l2 = l1_given_l2
+        self.l2_given_l1 = l2_given_l1
+        self.word_ids = word_ids
+
+    def probabilities_batch(self, word_pairs):
+        """Look up the probabilities of many word pairs at once.
+
+        Keyword arguments:
+        word_pairs -- list of 2-tuples (l1 word, l2 word)
+
+        Returns 2 lists of P(l1 | l2) and P(l2 | l1). Raises KeyError if a
+                word pair is not in the table
+        """
+        l1_ids, l2_ids = self.word_ids
+        pair_ids = [pair_to_id(l1_ids[l1_word], l2_ids[l2_word])
+                    for l1_word, l2_word in word_pairs]
+        if numpy != None:
+            pair_ids = numpy.array(pair_ids, numpy.int64)
+            rows = numpy.searchsorted(self.index, pair_ids)
+            rows[rows == len(self.index)] = 0
+            missing = numpy.flatnonzero(self.index[rows] != pair_ids)
+            if len(missing):
+                raise KeyError(word_pairs[missing[0]])
+            return (self.l1_given_l2[rows].tolist(),
+                    self.l2_given_l1[rows].tolist())
+
+        rows = [bisect.bisect_left(self.index, pair_id)
+                for pair_id in pair_ids]
+        for i, row in enumerate(rows):
+            if row == len(self.index) or self.index[row] != pair_ids[i]:
+                raise KeyError(word_pairs[i])
+        return ([self.l1_given_l2[row] for row in rows],
+                [self.l2_given_l1[row] for row in rows])
+
+    def lexical_weights_batch(self, phrase_pairs, alignments):
+        """Calculate the lexical weights of many phrase pairs at once, in
+        the same way as calc_lexical_weights. With numpy the alignments of
+        all phrase pairs are parsed at once, their word pairs are looked up
+        together and the probabilities of each phrase pair are multiplied
+        by a vectorized reduction.
+
+        Keyword arguments:
+        phrase_pairs -- list of 2-tuples (l1 phrase, l2 phrase)
+        alignments -- list of the word alignment of each phrase pair, as a
+                      string of the moses phrase table, e.g. '0-0 1-2'
+
+        Returns list of 2-tuples (lexical weight of P(l1 | l2), lexical
+                weight of P(l2 | l1)). Raises KeyError if a word pair is not
+                in the table, IndexError if an alignment links a word that
+                is not in its phrase pair
+        """
+        if numpy == None:
+            return [self.lexical_weights(phrase_pair,
+                                         str_to_alignments(alignment))
+                    for phrase_pair, alignment in zip(phrase_pairs,
+                                                      alignments)]
+        if not phrase_pairs:
+            return []
+
+        num_pairs = len(phrase_pairs)
+        word_ids = []
+        phrase_lengths = []
+        starts = []
+        phrase_of_word = []
+        for side, ids in enumerate(self.word_ids):
+            phrases = [phrase_pair[side] for phrase_pair in phrase_pairs]
+            words = ' '.join(phrases).split()
+            lengths = numpy.array([phrase.count(' ') + 1
+                                   for phrase in phrases], numpy.int64)
+            if lengths.sum() != len(words):
+                # not all words are separated by single spaces
+                lengths = numpy.array([len(phrase.split())
+                                       for phrase in phrases], numpy.int64)
+            side_ids = phrase_ids_batch(ids, words)
+            if len(side_ids) and side_ids.min() < 0:
+                raise KeyError(words[int(numpy.argmin(side_ids))])
+            word_ids.append(side_ids)
+            phrase_lengths.append(lengths)
+            starts.append(numpy.cumsum(lengths) - lengths)
+            phrase_of_word.append(numpy.repeat(numpy.arange(num_pairs),
+                                               lengths))
+
+        # positions of the aligned words among all words of the batch
+        link_counts = [alignment.count('-') for alignment in alignments]
+        if sum(link_counts):
+            links = numpy.fromstring(' '.join(alignments).replace('-', ' '),
+                                     numpy.int64, sep=' ').reshape(-1, 2)
+        else:
+            links = numpy.zeros((0, 2), numpy.int64)
+        phrase_of_link = numpy.repeat(numpy.arange(num_pairs), link_counts)
+        outside = (links < 0).any(1) | \
+            (links[:, 0] >= phrase_lengths[0][phrase_of_link]) | \
+            (links[:, 1] >= phrase_lengths[1][phrase_of_link])
+        if outside.any():
+            i = phrase_of_link[numpy.flatnonzero(outside)[0]]
+            raise IndexError('alignment %s does not fit phrase pair %s' %
+                             (alignments[i], phrase_pairs[i]))
+        aligned = [starts[0][phrase_of_link] + links[:, 0],
+                   starts[1][phrase_of_link] + links[:, 1]]
+
+        # word pairs of the links, of the unaligned l1 words with NULL and of
+        # NULL with the unaligned l2 words, in the order of
+        # calc_lexical_weights within each phrase pair. NULL is looked up
+        # only if there are unaligned words, as a table of a fully aligned
+        # corpus does not have it
+        pair_ids = [word_ids[0][aligned[0]] << 32 | word_ids[1][aligned[1]]]
+        phrase_of_pair = [phrase_of_link]
+        for side in (0, 1):
+            unaligned = numpy.ones(len(word_ids[side]), bool)
+            unaligned[aligned[side]] = False
+            unaligned = numpy.flatnonzero(unaligned)
+            if not len(unaligned):
+                continue
+            null = self.word_ids[1 - side]['NULL']
+            if side == 0:
+                pair_ids.append(word_ids[0][unaligned] << 32 | null)
+            else:
+                pair_ids.append(null << 32 | word_ids[1][unaligned])
+            phrase_of_pair.append(phrase_of_word[side][unaligned])
+        pair_ids = numpy.concatenate(pair_ids)
+        phrase_of_pair = numpy.concatenate(phrase_of_pair)
+        order = numpy.argsort(phrase_of_pair, kind='mergesort')
+        pair_ids = pair_ids[order]
+        phrase_of_pair = phrase_of_pair[order]
+
+        rows = numpy.searchsorted(self.index, pair_ids)
+        rows[rows == len(self.index)] = 0
+        missing = numpy.flatnonzero(self.index[rows] != pair_ids)
+        if len(missing):
+            raise KeyError(phrase_pairs[phrase_of_pair[missing[0]]],
+                           id_to_pair(int(pair_ids[missing[0]])))
+
+        # every phrase pair has at least one word pair, so no segment of the
+        # reduction is empty
+        segments = numpy.searchsorted(phrase_of_pair, numpy.arange(num_pairs))
+        l1_l2 = numpy.multiply.reduceat(self.l1_given_l2[rows], segments)
+        l2_l1 = numpy.multiply.reduceat(self.l2_given_l1[rows], segments)
+        return zip(l1_l2.tolist(), l2_l1.tolist())
+
+    def lexical_weights(self, phrase_pair, alignment):
+        """Calculate the lexical weights of a phrase pair in the same way as
+        calc_lexical_weights, by binary search of each word pair.
+
+        Keyword arguments:
+        phrase_pair -- 2-tuple (l1 phrase, l2 phrase)
+        alignment -- word alignment as returned by str_to_alignments
+
+        Returns 2-tuple (lexical weight of P(l1 | l2), lexical weight of
+                P(l2 | l1)). Raises KeyError if a word pair is not in the
+                table, IndexError if the alignment links a word that is not
+                in the phrase pair
+        """
+        l1_ids, l2_ids = self.word_ids
+        l1_words = [l1_ids[word] for word in phrase_pair[0].split()]
+        l2_words = [l2_ids[word] for word in phrase_pair[1].split()]
+        for i1, i2 in alignment:
+            if not (0 <= i1 < len(l1_words) and 0 <= i2 < len(l2_words)):
+                raise IndexError('alignment %s does not fit phrase pair %s' %
+                                 (alignment, phrase_pair))
+        pair_ids = [pair_to_id(l1_words[i1], l2_words[i2])
+                    for i1, i2 in alignment]
+        unaligned, unaligned2 = unaligned_words(alignment, len(l1_words),
+                                                len(l2_words))
+        pair_ids.extend([pair_to_id(l1_words[i1], l2_ids['NULL'])
+                         for i1, _ in unaligned])
+        pair_ids.extend([pair_to_id(l1_ids['NULL'], l2_words[i2])
+                         for _, i2 in unaligned2])
+
+        lex_l1_l2 = 1
+        lex_l2_l1 = 1
+        for pair_id in pair_ids:
+            row = bisect.bisect_left(self.index, pair_id)
+            if row == len(self.index) or self.index[row] != pair_id:
+                raise KeyError(phrase_pair, id_to_pair(pair_id))
+            lex_l1_l2 *= self.l1_given_l2[row]
+            lex_l2_l1 *= self.l2_given_l1[row]
+
+        return lex_l1_l2, lex_l2_l1
+
+    def __len__(self):
+        return len(self.index)
+
+def lexical_table(l1_given_l2, l2_given_l1, vocabulary = None):
+    """Make a LexicalTable of the lexical probabilities returned by
+    conditional_probabilities, conditional_probabilities_runs or
+    array_probabilities. The probabilities can be discarded afterwards.
+
+    Keyword arguments:
+    l1_given_l2 -- dictionary or PairTable mapping a word pair to P(l1 | l2)
+    l2_given_l1 -- dictionary or PairTable mapping a word pair to P(l2 | l1)
+    vocabulary -- vocabulary of the phrase ids the probabilities are keyed
+                  by, or None if they are keyed by strings (default is None)
+
+    Returns LexicalTable
+    """
+    if isinstance(l1_given_l2, PairTable):
+        # the arrays are sorted on pair id already
+        if l1_given_l2.phrase_rows:
+            word_ids = l1_given_l2.phrase_rows
+        else:
+            word_ids = ({}, {})
+            for ids, phrase_ids in zip(word_ids, (l1_given_l2.index >> 32,
+                    l1_given_l2.index & 0xffffffff)):
+                for phrase_id in numpy.unique(phrase_ids).tolist():
+                    ids[decode_phrase(vocabulary, phrase_id)] = phrase_id
+        return LexicalTable(l1_given_l2.index, l1_given_l2.values,
+                            l2_given_l1.values, word_ids)
+
+    keys = l1_given_l2.keys()
+    return keyed_lexical_table(keys, [l1_given_l2[key] for key in keys],
+                               [l2_given_l1[key] for key in keys], vocabulary)
+
+def lexical_table_freqs(lex_freqs, vocabulary = None):
+    """Make a LexicalTable directly from the counts of the lexical pairs,
+    with the probabilities of CountProbabilities.
+
+    Keyword arguments:
+    lex_freqs -- 3-tuple of counters (word pairs, words in language 1,
+                 words in language 2)
+    vocabulary -- vocabulary of the phrase ids the counters are keyed by,
+                  or None if they are keyed by strings (default is None)
+
+    Returns LexicalTable
+    """
+    keys = lex_freqs[0].keys()
+    l1_given_l2, l2_given_l1 = CountProbabilities(lex_freqs,
+        vocabulary).probabilities_batch(keys)
+    return keyed_lexical_table(keys, l1_given_l2, l2_given_l1, vocabulary)
+
+def keyed_lexical_table(keys, l1_given_l2, l2_given_l1, vocabulary = None):
+    """Make a LexicalTable of word pairs keyed as in the counters.
+
+    Keyword arguments:
+    keys -- list of word pairs, or of pair ids if vocabulary is given
+    l1_given_l2 -- list of P(l1 | l2) of each key
+    l2_given_l1 -- list of P(l2 | l1) of each key
+    vocabulary -- vocabulary of the pair ids (default is None)
+
+    Returns LexicalTable
+    """
+    word_ids = ({}, {})
+    index = array.array('l')
+    for key in keys:
+        if vocabulary:
+            pair = [decode_phrase(vocabulary, phrase_id)
+                    for phrase_id in id_to_pair(key)]
+        else:
+            pair = key
+        index.append(pair_to_id(*[ids.setdefault(word, len(ids))
+                                  for ids, word in zip(word_ids, pair)]))
+    values = (array.array('d', l1_given_l2), array.array('d', l2_given_l1))
+
+    if numpy != None:
+        index = numpy.frombuffer(index, numpy.int64)
+        order = numpy.argsort(index)
+        return LexicalTable(index[order],
+                            numpy.frombuffer(values[0], numpy.float64)[order],
+                            numpy.frombuffer(values[1], numpy.float64)[order],
+                            word_ids)
+
+    order = sorted(xrange(len(index)), key=index.__getitem__)
+    return LexicalTable(array.array('l', [index[i] for i in order]),
+                        array.array('d', [values[0][i] for i in order]),
+                        array.array('d', [values[1][i] for i in order]),
+                        word_ids)
+
+def array_probabilities(phrase_pair_freqs, l1_phrase_freqs, l2_phrase_freqs,
+                        vocabulary = None, joint = False):
+    """Same as conditional_probabilities and joint_probabilities, but the
+    counts are gathered in numpy arrays indexed by pair id and the
+    probabilities are calculated with vectorized operations.
+
+    Keyword arguments:
+    phrase_pair_freqs -- counter of phrase pairs
+    l1_phrase_freqs -- counter of phrases in language 1
+    l2_phrase_freqs -- counter of phrases in language 2
+    vocabulary -- vocabulary of the phrase ids the counters are keyed by,
+                  or None if they are keyed by strings (default is None)
+    joint -- whether the joint probabilities are calculated as well
+             (default is False)
+
+    Returns 2 PairTables mapping a phrase pair to the same values as
+            conditional_probabilities, and a third with the values of
+            joint_probabilities if joint is True
+    """
+    num_pairs = len(phrase_pair_freqs)
+    if vocabulary:
+        phrase_rows = None
+        index = numpy.fromiter(phrase_pair_freqs.iterkeys(), numpy.int64,
+                               num_pairs)
+        num_phrases = len(vocabulary[1][1])
+        l1_freqs = numpy.zeros(num_phrases, numpy.float64)
+        l2_freqs = numpy.zeros(num_phrases, numpy.float64)
+        for freqs, phrase_freqs in ((l1_freqs, l1_phrase_freqs),
+                                    (l2_freqs, l2_phrase_freqs)):
+            phrase_ids = numpy.fromiter(phrase_freqs.iterkeys(), numpy.int64,
+                                        len(phrase_freqs))
+            freqs[phrase_ids] = numpy.fromiter(phrase_freqs.itervalues(),
+                numpy.float64, len(phrase_freqs))
+    else:
+        # number the phrases to create pair ids like those of a vocabulary
+        l1_row_of = dict(itertools.izip(l1_phrase_freqs.iterkeys(),
+                                        itertools.count()))
+        l2_row_of = dict(itertools.izip(l2_phrase_freqs.iterkeys(),
+                                        itertools.count()))
+        phrase_rows = (l1_row_of, l2_row_of)
+        index = numpy.fromiter((pair_to_id(l1_row_of[l1], l2_row_of[l2])
+                                for l1, l2 in phrase_pair_freqs.iterkeys()),
+                               numpy.int64, num_pairs)
+        l1_freqs = numpy.fromiter(l1_phrase_freqs.itervalues(),
+                                  numpy.float64, len(l1_phrase_freqs))
+        l2_freqs = numpy.fromiter(l2_phrase_freqs.itervalues(),
+                                  numpy.float64, len(l2_phrase_freqs))
+
+    # sort the pair ids for lookup by binary search
+    pair_freqs = numpy.fromiter(phrase_pair_freqs.itervalues(),
+                                numpy.float64, num_pairs)
+    order = numpy.argsort(index)
+    if joint:
+        # summed in the same order as phrase_probabilities
+        l2_total = sum(l2_phrase_freqs.values())
+    else:
+        l2_total = None
+    return sorted_array_probabilities(index[order], pair_freqs[order],
+                                      l1_freqs, l2_freqs, phrase_rows, joint,
+                                      l2_total)
+
+def sorted_array_probabilities(index, pair_freqs, l1_freqs, l2_freqs,
+                               phrase_rows = None, joint = False,
+                               l2_total = None):
+    """Calculate the probabilities of array_probabilities from count arrays.
+
+    Keyword arguments:
+    index -- sorted numpy array of phrase pair ids
+    pair_freqs -- numpy array of the count of each phrase pair in index
+    l1_freqs -- numpy array of the count of each l1 phrase id
+    l2_freqs -- numpy array of the count of each l2 phrase id
+    phrase_rows -- see PairTable (default is None)
+    joint -- whether the joint probabilities are calculated as well
+             (default is False)
+    l2_total -- sum of l2_freqs for the joint probabilities, or None to
+                sum them with math.fsum (default is None)
+
+    Returns the same as array_probabilities
+    """
+    l1_ids = index >> 32
+    l2_ids = index & 0xffffffff
+
+    l1_given_l2 = pair_freqs / l1_freqs[l1_ids]
+    l2_given_l1 = pair_freqs / l2_freqs[l2_ids]
+    tables = (PairTable(index, l1_given_l2, phrase_rows),
+              PairTable(index, l2_given_l1, phrase_rows))
+    if not joint:
+        return tables
+
+    if l2_total == None:
+        l2_total = math.fsum(l2_freqs.tolist())
+    if l2_total:
+        joint_probs = l1_given_l2 * (l2_freqs[l2_ids] / float(l2_total))
+    else:
+        # no phrase pairs
+        joint_probs = numpy.zeros(len(index), numpy.float64)
+    return tables + (PairTable(index, joint_probs, phrase_rows),)
+
+class ArrayCounts(object):
+    """Counts of phrase pairs keyed by pair id (see pair_to_id), stored in
+    numpy arrays instead of a Counter, so no count is a python object.
+    Added counts are buffered in typed arrays of (pair id, weight) and merged
+    into a sorted array of pair ids and an array of counts when the buffer
+    is full. The buffer grows with the number of pairs, so merging takes
+    linear time overall. The marginal counts of the phrases are kept in
+    float64 arrays indexed by phrase id. The weights are added one by one in
+    corpus order, so float64 counts are the same as those of a Counter, also
+    with sentence weights. float32 rounds every weight (0.6 is counted as
+    0.600000023842) and every count to float32, so weighted float32 counts
+    differ from those of a Counter by about 1e-7 relative, and float32
+    counts of more than 2**24 are not exact.
+
+    Keyword arguments:
+    dtype -- numpy type of the counts: 'float32' or 'float64'
+             (default is 'float32')
+    buffer_size -- minimum number of counts that are buffered before they
+                   are merged (default is 1 << 16)
+    """
+
+    def __init__(self, dtype = 'float32', buffer_size = 1 << 16):
+        self.dtype = numpy.dtype(dtype)
+        self.buffer_size = buffer_size
+        self.index = numpy.zeros(0, numpy.int64)
+        self.counts = numpy.zeros(0, self.dtype)
+        self.marginals = [numpy.zeros(0, numpy.float64),
+                          numpy.zeros(0, numpy.float64)]
+        self.pair_ids = array.array('l')
+        self.weights = array.array('f' if self.dtype.itemsize == 4 else 'd')
+
+    def extend(self, pair_ids, weight = 1):
+        """Add weight to the count of each pair id in a list"""
+        self.pair_ids.extend(pair_ids)
+        self.weights.extend([weight] * len(pair_ids))
+        if len(self.pair_ids) >= max(self.buffer_size, len(self.index) // 8):
+            self.flush()
+
+    def flush(self):
+        """Merge the buffered counts into the arrays of counts. float64
+        counts and the marginal counts are added with numpy.add.at, which adds
+        the weights one by one in buffer order. float32 counts are summed by
+        bincount in float64 first, so they are rounded once per flush instead
+        of once per weight."""
+        if not self.pair_ids:
+            return
+
+        buffered_ids = numpy.frombuffer(self.pair_ids, numpy.int64)
+        weights = numpy.frombuffer(self.weights, self.dtype)
+        pair_ids = numpy.unique(buffered_ids)
+        rows = numpy.searchsorted(self.index, pair_ids)
+        found = rows < len(self.index)
+        found[found] = self.index[rows[found]] == pair_ids[found]
+        new = ~found
+        if new.any():
+            self.index = numpy.insert(self.index, rows[new], pair_ids[new])
+            self.counts = numpy.insert(self.counts, rows[new], 0)
+        rows = numpy.searchsorted(self.index, buffered_ids)
+        if self.dtype == numpy.float64:
+            numpy.add.at(self.counts, rows, weights)
+        else:
+            self.counts += numpy.bincount(rows, weights,
+                                          len(self.index)).astype(self.dtype)
+        phrase_ids = (buffered_ids >> 32, buffered_ids & 0xffffffff)
+        for side, ids in enumerate(phrase_ids):
+            self.marginals[side] = grown(self.marginals[side], ids.max() + 1)
+            numpy.add.at(self.marginals[side], ids, weights)
+        self.pair_ids = array.array(self.pair_ids.typecode)
+        self.weights = array.array(self.weights.typecode)
+
+    def table(self, num_phrases):
+        """Merge the buffered counts and return the counts as a table.
+
+        Keyword arguments:
+        num_phrases -- number of phrase ids of the vocabulary
+
+        Returns 4-tuple of numpy arrays (pair ids, pair counts, l1 counts,
+                l2 counts) as in a binary frequency file (see freqfile)
+        """
+        self.flush()
+        l1_counts, l2_counts = [grown(marginal, num_phrases)
+                                for marginal in self.marginals]
+        return self.index, self.counts, l1_counts, l2_counts
+
+    def __len__(self):
+        self.flush()
+        return len(self.index)
+
+def grown(counts, size):
+    """Return a numpy array of counts padded with zeros to at least size"""
+    if len(counts) >= size:
+        return counts
+    return numpy.concatenate((counts, numpy.zeros(size - len(counts),
+                                                  counts.dtype)))
+
+def new_array_freqs(dtype = 'float32'):
+    """Create empty phrase and lexical ArrayCounts, used instead of the
+    counters of new_freqs.
+
+    Returns 2-tuple (phrase counts, lex counts)
+    """
+    return ArrayCounts(dtype), ArrayCounts(dtype)
+
+def freqs_to_binary(file_name, freqs, vocabulary = None):
+    """Write phrase and lexical frequencies to a binary frequency file
+    (see freqfile).
+
+    Keyword arguments:
+    file_name -- name of file for writing
+    freqs -- 2-tuple of phrase and lexical counters as made by new_freqs
+    vocabulary -- vocabulary of the phrase ids the counters are keyed by,
+                  or None if they are keyed by strings (default is None)
+    """
+    if vocabulary:
+        strings = [decode_phrase(vocabulary, phrase_id)
+                   for phrase_id in xrange(len(vocabulary[1][1]))]
+        string_ids = None
+    else:
+        string_ids = {}
+        strings = []
+        for _, l1_freqs, l2_freqs in freqs:
+            for phrase in itertools.chain(l1_freqs, l2_freqs):
+                key_to_id((string_ids, strings), phrase)
+
+    integer_counts = True
+    tables = []
+    for pair_freqs, l1_freqs, l2_freqs in freqs:
+        if vocabulary:
+            index = numpy.fromiter(pair_freqs.iterkeys(), numpy.int64,
+                                   len(pair_freqs))
+        else:
+            index = numpy.fromiter((pair_to_id(string_ids[l1],
+                                               string_ids[l2])
+                                    for l1, l2 in pair_freqs.iterkeys()),
+                                   numpy.int64, len(pair_freqs))
+        counts = numpy.fromiter(pair_freqs.itervalues(), numpy.float64,
+                                len(pair_freqs))
+        order = numpy.argsort(index)
+        marginals = []
+        for phrase_freqs in (l1_freqs, l2_freqs):
+            marginal = numpy.zeros(len(strings), numpy.float64)
+            for phrase, freq in phrase_freqs.iteritems():
+                if string_ids != None:
+                    phrase = string_ids[phrase]
+                marginal[phrase] = freq
+                integer_counts &= isinstance(freq, (int, long))
+            marginals.append(marginal)
+        tables.append((index[order], counts[order]) + tuple(marginals))
+
+    flags = 0
+    if integer_counts:
+        flags |= freqfile.INTEGER_COUNTS
+    freqfile.write_tables(file_name, strings, tables, flags)
+
+def binary_probabilities(strings, table, joint = False):
+    """Same as array_probabilities, but for a table of a binary frequency
+    file.
+
+    Keyword arguments:
+    strings -- StringTable of the binary frequency file
+    table -- 4-tuple of numpy arrays (pair ids, pair counts, l1 counts,
+             l2 counts)
+    joint -- whether the joint probabilities are calculated as well
+             (default is False)
+
+    Returns 2 or 3 PairTables that are looked up by phrase strings
+    """
+    string_ids = strings.ids()
+    return sorted_array_probabilities(table[0], table[1], table[2],
+                                      table[3], (string_ids, string_ids),
+                                      joint)
+
 def add_phrase_alignment(collection, phrase, max_length,
                          l1_length, l2_length):
     """Add a phrase alignment to a collection if:
@@ -96,9 +927,431 @@ def add_phrase_alignment(collection, phrase, max_length,
         else:
             return NotImplemented
 
+def new_vocabulary():
+    """Create an empty vocabulary that maps words and phrases to integer ids.
+
+    Returns a 2-tuple (word ids, phrase ids). Each element is a 2-tuple of a
+    dictionary mapping a key to its id and a list mapping an id to its key.
+    A word is keyed by its string and a phrase by its word ids packed in a
+    string (see phrase_key).
+    """
+    return (({}, []), ({}, []))
+
+def key_to_id(ids, key):
+    """Find the id of a key, adding the key if it has no id yet.
+
+    Keyword arguments:
+    ids -- 2-tuple of a dictionary mapping a key to its id and a list
+           mapping an id to its key
+
+    Returns id of the key
+    """
+    id_of_key, keys = ids
+    key_id = id_of_key.get(key)
+    if key_id == None:
+        key_id = id_of_key[key] = len(keys)
+        keys.append(key)
+
+    return key_id
+
+def phrase_key(word_ids):
+    """Pack the word ids of a phrase in a compact string."""
+    return array.array('i', word_ids).tostring()
+
+def phrase_key_word_ids(key):
+    """Unpack the word ids of a phrase from a string made by phrase_key."""
+    word_ids = array.array('i')
+    word_ids.fromstring(key)
+    return word_ids
+
+def pair_to_id(l1_phrase_id, l2_phrase_id):
+    """Pack the phrase ids of a phrase pair in a single integer."""
+    return (l1_phrase_id << 32) | l2_phrase_id
+
+def id_to_pair(pair_id):
+    """Unpack a phrase pair id made by pair_to_id.
+
+    Returns 2-tuple of phrase ids
+    """
+    return pair_id >> 32, pair_id & 0xffffffff
+
+def encode_words(vocabulary, words):
+    """Map each word to the id of the phrase consisting of only that word.
+
+    Keyword arguments:
+    vocabulary -- vocabulary as made by new_vocabulary
+    words -- list of words
+
+    Returns 2-tuple (list of word ids, list of phrase ids)
+    """
+    word_ids, phrase_ids = vocabulary
+    l_word_ids = [key_to_id(word_ids, word) for word in words]
+    return l_word_ids, [key_to_id(phrase_ids, phrase_key((word_id,)))
+                        for word_id in l_word_ids]
+
+def encode_phrase(vocabulary, phrase):
+    """Find the id of a phrase, adding it if it is not in the vocabulary.
+
+    Keyword arguments:
+    vocabulary -- vocabulary as made by new_vocabulary
+    phrase -- string of words separated by spaces
+
+    Returns phrase id
+    """
+    word_ids, phrase_ids = vocabulary
+    return key_to_id(phrase_ids, phrase_key([key_to_id(word_ids, word)
+                                             for word in phrase.split()]))
+
+def lookup_phrase(vocabulary, phrase):
+    """Find the id of a phrase without adding it to the vocabulary.
+
+    Keyword arguments:
+    vocabulary -- vocabulary as made by new_vocabulary
+    phrase -- string of words separated by spaces
+
+    Returns phrase id or None if the phrase is not in the vocabulary
+    """
+    (id_of_word, _), (id_of_phrase, _) = vocabulary
+    try:
+        return id_of_phrase.get(phrase_key([id_of_word[word]
+                                            for word in phrase.split()]))
+    except KeyError:
+        return None
+
+def decode_phrase(vocabulary, phrase_id):
+    """Find the string of a phrase id.
+
+    Keyword arguments:
+    vocabulary -- vocabulary as made by new_vocabulary
+    phrase_id -- id of a phrase
+
+    Returns string of words separated by spaces
+    """
+    (_, words), (_, phrases) = vocabulary
+    return ' '.join([words[word_id]
+                     for word_id in phrase_key_word_ids(phrases[phrase_id])])
+
+def pair_key(vocabulary, pair):
+    """Find the key of a phrase pair in the frequency counters.
+
+    Keyword arguments:
+    vocabulary -- vocabulary as made by new_vocabulary or None
+    pair -- 2-tuple of phrase strings
+
+    Returns phrase pair id, or pair itself if vocabulary is None. None if
+            one of the phrases is not in the vocabulary
+    """
+    if vocabulary == None:
+        return pair
+
+    l1_phrase_id = lookup_phrase(vocabulary, pair[0])
+    l2_phrase_id = lookup_phrase(vocabulary, pair[1])
+    if l1_phrase_id == None or l2_phrase_id == None:
+        return None
+
+    return pair_to_id(l1_phrase_id, l2_phrase_id)
+
+def pair_keys(vocabulary, pairs):
+    """Same as pair_key for a list of phrase pairs, but every distinct
+    phrase is looked up once.
+
+    Returns list of keys
+    """
+    if vocabulary == None:
+        return pairs
+
+    phrase_ids = dict((phrase, lookup_phrase(vocabulary, phrase))
+                      for phrase in set(itertools.chain(*pairs)))
+    l1_phrase_ids = [phrase_ids[pair[0]] for pair in pairs]
+    l2_phrase_ids = [phrase_ids[pair[1]] for pair in pairs]
+    # the pair ids of pair_to_id
+    return [l1_phrase_id << 32 | l2_phrase_id
+            if l1_phrase_id != None and l2_phrase_id != None else None
+            for l1_phrase_id, l2_phrase_id in itertools.izip(l1_phrase_ids,
+                                                             l2_phrase_ids)]
+
+def translate_freqs(freqs, from_vocabulary, to_vocabulary):
+    """Map the phrase ids of frequency counters from one vocabulary to
+    another.
+
+    Keyword arguments:
+    freqs -- 2-tuple of phrase and lexical counters as made by new_freqs
+             or new_weight_freqs
+    from_vocabulary -- vocabulary the phrase ids in freqs belong to
+    to_vocabulary -- vocabulary the phrase ids are mapped to
+
+    Returns freqs with the phrase ids of to_vocabulary
+    """
+    (_, words), (_, phrases) = from_vocabulary
+    word_map = [key_to_id(to_vocabulary[0], word) for word in words]
+    phrase_map = [key_to_id(to_vocabulary[1],
+                            phrase_key([word_map[word_id] for word_id
+                                        in phrase_key_word_ids(phrase)]))
+                  for phrase in phrases]
+    translated = tuple(tuple(type(counter)() for counter in counters)
+                       for counters in freqs)
+    for counters, new_counters in zip(freqs, translated):
+        pair_freqs, l1_freqs, l2_freqs = counters
+        new_pair_freqs, new_l1_freqs, new_l2_freqs = new_counters
+        for pair_id, freq in pair_freqs.iteritems():
+            id1, id2 = id_to_pair(pair_id)
+            new_pair_freqs[pair_to_id(phrase_map[id1], phrase_map[id2])] = freq
+        for phrase_id, freq in l1_freqs.iteritems():
+            new_l1_freqs[phrase_map[phrase_id]] = freq
+        for phrase_id, freq in l2_freqs.iteritems():
+            new_l2_freqs[phrase_map[phrase_id]] = freq
+
+    return translated
+
+def new_freqs():
+    """Create empty phrase and lexical frequency counters.
+
+    Returns a 2-tuple (phrase freqs, lex freqs) where each element is a
+    3-tuple of counters (pairs, l1 phrases, l2 phrases)
+    """
+    return ((Counter(), Counter(), Counter()),
+            (Counter(), Counter(), Counter()))
+
+class WeightList(list):
+    """Weights added to a count, in the order in which they were added.
+    Used instead of the count by new_weight_freqs, so that merge_freqs can
+    add the weights of a part of the corpus to the counts one by one."""
+
+    def __iadd__(self, weight):
+        self.append(weight)
+        return self
+
+def new_weight_freqs():
+    """Same as new_freqs, but every key is mapped to a WeightList of the
+    weights added to it instead of their sum. Adding the weights of the
+    parts of a corpus one by one in corpus order gives exactly the sums of
+    a serial extraction, which adding the sums of the parts does not.
+
+    Returns a 2-tuple (phrase freqs, lex freqs) where each element is a
+    3-tuple of dictionaries (pairs, l1 phrases, l2 phrases)
+    """
+    return ((defaultdict(WeightList), defaultdict(WeightList),
+             defaultdict(WeightList)),
+            (defaultdict(WeightList), defaultdict(WeightList),
+             defaultdict(WeightList)))
+
+def merge_freqs(freqs, other_freqs):
+    """Add the counts of other_freqs to freqs.
+
+    Keyword arguments:
+    freqs -- 2-tuple of phrase and lexical counters as made by new_freqs
+    other_freqs -- same as freqs, or as made by new_weight_freqs. Its
+                   weights are added one by one, so merging the parts of a
+                   corpus in corpus order gives the same counts as counting
+                   the whole corpus
+
+    Returns freqs
+    """
+    for counters, other_counters in zip(freqs, other_freqs):
+        for counter, other_counter in zip(counters, other_counters):
+            if not isinstance(next(other_counter.itervalues(), None),
+                              WeightList):
+                counter.update(other_counter)
+                continue
+
+            for key, weights in other_counter.iteritems():
+                count = counter[key]
+                for weight in weights:
+                    count += weight
+                counter[key] = count
+
+    return freqs
+
+def add_sentence_freqs(freqs, str_align, l1_line, l2_line, max_length,
+                       weight = 1, algorithm = 'expand', vocabulary = None,
+                       alignment_cache = None):
+    """Extract the phrase pairs of one sentence pair and add them to freqs.
+
+    Keyword arguments:
+    freqs -- 2-tuple of phrase and lexical counters as made by new_freqs,
+             or of ArrayCounts as made by new_array_freqs, which requires
+             vocabulary
+    str_align -- line containing the word alignment
+    l1_line -- line containing the sentence in language 1
+    l2_line -- line containing the sentence in language 2
+    max_length -- maximum length of phrase pairs
+    weight -- weight of the sentence pair (default is 1)
+    algorithm -- name of the phrase alignment extractor in EXTRACTORS
+                 (default is 'expand')
+    vocabulary -- if given, phrases are counted by their id in this
+                  vocabulary instead of by their string (default is None)
+    alignment_cache -- LRUCache of phrase alignments as used by
+                       cached_phrase_alignments, or None (default is None)
+
+    Returns number of phrase pairs extracted
+    """
+    l1_words = l1_line.strip().split()
+    l2_words = l2_line.strip().split()
+    l1_length = len(l1_words)
+    l2_length = len(l2_words)
+
+    align = str_to_alignments(str_align)
+    if alignment_cache != None:
+        phrase_alignments = cached_phrase_alignments(alignment_cache, align,
+            l1_length, l2_length, max_length, algorithm)
+    else:
+        phrase_alignments = EXTRACTORS[algorithm](set(align), l1_length,
+            l2_length, max_length)
+
+    if vocabulary:
+        l1_word_ids, l1_keys = encode_words(vocabulary, l1_words)
+        l2_word_ids, l2_keys = encode_words(vocabulary, l2_words)
+        phrase_pairs = extract_phrase_id_pairs_gen(phrase_alignments,
+            l1_word_ids, l2_word_ids, vocabulary)
+        null = encode_phrase(vocabulary, 'NULL')
+    else:
+        l1_keys = l1_words
+        l2_keys = l2_words
+        phrase_pairs = extract_phrase_pairs_gen(phrase_alignments,
+                                                l1_words, l2_words)
+        null = 'NULL'
+
+    unaligned, unaligned2 = unaligned_words(align, l1_length, l2_length)
+    unaligned.extend(unaligned2)
+    if isinstance(freqs[0], ArrayCounts):
+        phrase_counts, lex_counts = freqs
+        pair_ids = [pair_to_id(l1_phrase, l2_phrase)
+                    for l1_phrase, l2_phrase in phrase_pairs]
+        phrase_counts.extend(pair_ids, weight)
+        lex_pair_ids = [pair_id for pair_id, (min1, min2, max1, max2)
+                        in itertools.izip(pair_ids, phrase_alignments)
+                        if min1 == max1 and min2 == max2]
+        lex_pair_ids.extend(pair_to_id(l1_phrase, l2_phrase)
+            for l1_phrase, l2_phrase in unaligned_phrase_pairs_gen(unaligned,
+                l1_keys, l2_keys, null))
+        lex_counts.extend(lex_pair_ids, weight)
+        return len(phrase_alignments)
+
+    (phrase_pair_freqs, l1_phrase_freqs, l2_phrase_freqs), \
+        (lex_pair_freqs, l1_lex_freqs, l2_lex_freqs) = freqs
+    for (min1, min2, max1, max2), (l1_phrase, l2_phrase) in itertools.izip(
+            phrase_alignments, phrase_pairs):
+        if vocabulary:
+            phrase_pair = pair_to_id(l1_phrase, l2_phrase)
+        else:
+            phrase_pair = (l1_phrase, l2_phrase)
+        phrase_pair_freqs[phrase_pair] += weight
+        l1_phrase_freqs[l1_phrase] += weight
+        l2_phrase_freqs[l2_phrase] += weight
+        if min1 == max1 and min2 == max2:
+            lex_pair_freqs[phrase_pair] += weight
+            l1_lex_freqs[l1_phrase] += weight
+            l2_lex_freqs[l2_phrase] += weight
+
+    for l1_phrase, l2_phrase in unaligned_phrase_pairs_gen(unaligned,
+            l1_keys, l2_keys, null):
+        if vocabulary:
+            phrase_pair = pair_to_id(l1_phrase, l2_phrase)
+        else:
+            phrase_pair = (l1_phrase, l2_phrase)
+        #phrase_pair_freqs[phrase_pair] += weight
+        #l1_phrase_freqs[l1_phrase] += weight
+        #l2_phrase_freqs[l2_phrase] += weight
+        lex_pair_freqs[phrase_pair] += weight
+        l1_lex_freqs[l1_phrase] += weight
+        l2_lex_freqs[l2_phrase] += weight
+
+    return len(phrase_alignments)
+
+def cached_phrase_alignments(alignment_cache, align, l1_length, l2_length,
+                             max_length, algorithm = 'expand'):
+    """Same as the extractors in EXTRACTORS, but the phrase alignments are
+    looked up in a cache first. Sentence pairs with the same word alignment
+    and lengths have the same phrase alignments.
+
+    Keyword arguments:
+    alignment_cache -- LRUCache mapping (word alignment, l1_length,
+                       l2_length, max_length, algorithm) to phrase
+                       alignments
+    align -- list of word alignments
+    l1_length -- length of sentence 1
+    l2_length -- length of sentence 2
+    max_length -- maximum length of a phrase pair
+    algorithm -- name of the phrase alignment extractor in EXTRACTORS
+                 (default is 'expand')
+
+    Returns phrase alignments. They are shared with the cache and must not
+    be modified
+    """
+    word_alignments = frozenset(align)
+    key = (word_alignments, l1_length, l2_length, max_length, algorithm)
+    phrase_alignments = alignment_cache.get(key)
+    if phrase_alignments == None:
+        phrase_alignments = EXTRACTORS[algorithm](set(word_alignments),
+            l1_length, l2_length, max_length)
+        alignment_cache.put(key, phrase_alignments)
+
+    return phrase_alignments
+
+def report_alignment_cache(alignment_cache, stats = None):
+    """Show the hit rate of the phrase alignment cache and record its hits
+    and misses in stats if it is not None."""
+    if alignment_cache == None:
+        return
+
+    print 'alignment cache: %d hits, %d misses, hit rate %.3f' % \
+        (alignment_cache.hits, alignment_cache.misses,
+         alignment_cache.hit_rate())
+    if stats != None:
+        stats.add('alignment_cache_hits', alignment_cache.hits)
+        stats.add('alignment_cache_misses', alignment_cache.misses)
+
+def report_lex_cache(lex_cache, stats = None):
+    """Show the hit rate of the lexical weight cache and record its hits and
+    misses in stats if it is not None."""
+    if lex_cache == None:
+        return
+
+    print 'lex cache: %d hits, %d misses, hit rate %.3f' % \
+        (lex_cache.hits, lex_cache.misses, lex_cache.hit_rate())
+    if stats != None:
+        stats.add('lex_cache_hits', lex_cache.hits)
+        stats.add('lex_cache_misses', lex_cache.misses)
+
+def timed_sentence_freqs(stats, freqs, str_align, l1_line, l2_line,
+                         max_length, weight = 1, algorithm = 'expand',
+                         vocabulary = None, alignment_cache = None):
+    """Same as add_sentence_freqs, but the time it takes is recorded in
+    stats.
+
+    Keyword arguments:
+    stats -- pipestats.PipelineStats or None
+    """
+    if stats == None:
+        add_sentence_freqs(freqs, str_align, l1_line, l2_line, max_length,
+                           weight, algorithm, vocabulary, alignment_cache)
+        return
+
+    start = time.time()
+    num_pairs = add_sentence_freqs(freqs, str_align, l1_line, l2_line,
+                                   max_length, weight, algorithm, vocabulary,
+                                   alignment_cache)
+    seconds = time.time() - start
+    stats.add_sentence(max(len(l1_line.split()), len(l2_line.split())),
+                       num_pairs, seconds)
+
+def start_stage(stats, name):
+    """Show the name of a stage of the pipeline and start timing it.
+
+    Keyword arguments:
+    stats -- pipestats.PipelineStats or None
+    name -- name of the stage
+    """
+    print name
+    if stats != None:
+        stats.start(name)
+
 def extract_phrase_pair_freqs(alignments_file, language1_file,
                               language2_file, max_length,
-                              sentence_weights_file = None):
+                              sentence_weights_file = None, workers = 1,
+                              algorithm = 'expand', vocabulary = None,
+                              stats = None, alignment_cache = None,
+                              array_counts = None, pipeline = None):
     """Extract and count the frequency of all phrase pairs given an
     alignment between sentences.
 
@@ -108,78 +1361,967 @@ def extract_phrase_pair_freqs(alignments_file, language1_file,
     language2_file -- file containing sentences from language 2
     max_length -- maximum length of phrase pairs
     sentence_weights -- file containing weights for each sentence pair
+    workers -- number of processes. If workers > 1 the corpus is split
+               into shards that are extracted in parallel, or read in
+               batches by extract_phrase_pair_freqs_pipelined if a file is
+               compressed (default is 1)
+    algorithm -- name of the phrase alignment extractor in EXTRACTORS
+                 (default is 'expand')
+    vocabulary -- if given, the counters are keyed by phrase ids that are
+                  added to this vocabulary instead of by strings
+                  (default is None)
+    stats -- pipestats.PipelineStats the extraction time of each sentence
+             pair is recorded in. With workers > 1 only the number of
+             sentence pairs is recorded, with pipeline also the times and
+             queue lengths of the stages (default is None)
+    alignment_cache -- LRUCache of phrase alignments, or None. With
+                       workers > 1 every shard uses a cache of the same
+                       size and their hits and misses are added to it
+                       (default is None)
+    array_counts -- if given, the counts are ArrayCounts of this numpy type
+                    as made by new_array_freqs instead of counters. Requires
+                    vocabulary and workers == 1 (default is None)
+    pipeline -- if given, a 2-tuple (batch size, queue size) to extract the
+                phrase pairs with extract_phrase_pair_freqs_pipelined by
+                workers processes. Can not be combined with array_counts
+                (default is None)
 
     Returns counter of phrase-pairs, counter of phrases in language1
-            and counter of phrases in language2
-    """
-    # phrase frequencies
-    phrase_pair_freqs = Counter()
-    l1_phrase_freqs = Counter()
-    l2_phrase_freqs = Counter()
-    # lexical frequencies
-    lex_pair_freqs = Counter()
-    l1_lex_freqs = Counter()
-    l2_lex_freqs = Counter()
+            and counter of phrases in language2, or ArrayCounts of phrase
+            and lexical pairs if array_counts is given
+    """
+    if pipeline:
+        return extract_phrase_pair_freqs_pipelined(alignments_file,
+            language1_file, language2_file, max_length,
+            sentence_weights_file, workers, pipeline[0], pipeline[1],
+            algorithm, vocabulary, stats, alignment_cache)
+
+    if workers > 1:
+        file_names = [alignments_file, language1_file, language2_file,
+                      sentence_weights_file]
+        if any(compressed.compression(name) for name in file_names if name):
+            # compressed files can not be split by seeking, so they are read
+            # by one process that hands out batches
+            return extract_phrase_pair_freqs_pipelined(alignments_file,
+                language1_file, language2_file, max_length,
+                sentence_weights_file, workers, PIPELINE_BATCH_SIZE,
+                2 * workers, algorithm, vocabulary, stats, alignment_cache)
+        return extract_phrase_pair_freqs_parallel(alignments_file,
+            language1_file, language2_file, max_length,
+            sentence_weights_file, workers, algorithm, vocabulary, stats,
+            alignment_cache)
+
+    if array_counts:
+        freqs = new_array_freqs(array_counts)
+    else:
+        freqs = new_freqs()
+    for str_align, l1_line, l2_line, weight in sentence_pairs_gen(
+            alignments_file, language1_file, language2_file,
+            sentence_weights_file):
+        timed_sentence_freqs(stats, freqs, str_align, l1_line, l2_line,
+                             max_length, weight, algorithm, vocabulary,
+                             alignment_cache)
+
+    return freqs
+
+def sentence_pairs_gen(alignments_file, language1_file, language2_file,
+                       sentence_weights_file):
+    """Read the sentence pairs of a corpus and show the progress, measured
+    in bytes of the alignments file.
+
+    Keyword arguments:
+    alignments_file -- file that contains the alignments
+    language1_file -- file containing sentences from language 1
+    language2_file -- file containing sentences from language 2
+    sentence_weights -- file containing weights for each sentence pair or
+                        None
+
+    Yield 4-tuple (alignment line, l1 line, l2 line, weight)
+    """
     # open files
-    num_lines = number_of_lines(alignments_file)
-    alignments = open(alignments_file, 'r')
-    language1 = open(language1_file, 'r')
-    language2 = open(language2_file, 'r')
+    alignments = compressed.open_file(alignments_file, 'r')
+    language1 = compressed.open_file(language1_file, 'r')
+    language2 = compressed.open_file(language2_file, 'r')
     if sentence_weights_file:
-        sentence_weights = open(sentence_weights_file, 'r')
+        sentence_weights = compressed.open_file(sentence_weights_file, 'r')
+
+    bar = progress.file_progress(alignments_file)
+    position = 0
+    for str_align in alignments:
+        position += len(str_align)
+        bar.update(position)
 
-    if num_lines/100 == 0:
-        frac = 1
-    else:
-        frac = num_lines/100
-    for i, str_align in enumerate(alignments):
-        if i % frac == 0:
-            sys.stdout.write('\r%d%%' % (i*100/num_lines,))
-            sys.stdout.flush()
-
-        l1_words = language1.next().strip().split()
-        l2_words = language2.next().strip().split()
-        l1_length = len(l1_words)
-        l2_length = len(l2_words)
         if sentence_weights_file:
             weight = float(sentence_weights.next().strip())
         else:
             weight = 1
 
-        align = str_to_alignments(str_align)
-        phrase_alignments = extract_alignments(set(align), l1_length,
-            l2_length, max_length)
-
-        for phrase_pair in extract_phrase_pairs_gen(phrase_alignments,
-                                                    l1_words, l2_words):
-            phrase_pair_freqs[phrase_pair] += weight
-            l1_phrase_freqs[phrase_pair[0]] += weight
-            l2_phrase_freqs[phrase_pair[1]] += weight
-            if len(phrase_pair[0].split()) == len(phrase_pair[1].split()) == 1:
-                lex_pair_freqs[phrase_pair] += weight
-                l1_lex_freqs[phrase_pair[0]] += weight
-                l2_lex_freqs[phrase_pair[1]] += weight
-
-        unaligned, unaligned2 = unaligned_words(align, l1_length, l2_length)
-        unaligned.extend(unaligned2)
-        for phrase_pair in unaligned_phrase_pairs_gen(unaligned, l1_words,
-                                                      l2_words):
-            #phrase_pair_freqs[phrase_pair] += weight
-            #l1_phrase_freqs[phrase_pair[0]] += weight
-            #l2_phrase_freqs[phrase_pair[1]] += weight
-            lex_pair_freqs[phrase_pair] += weight
-            l1_lex_freqs[phrase_pair[0]] += weight
-            l2_lex_freqs[phrase_pair[1]] += weight
+        yield str_align, language1.next(), language2.next(), weight
 
     alignments.close()
     language1.close()
     language2.close()
     if sentence_weights_file:
         sentence_weights.close()
+    bar.finish(position)
+
+def new_runs():
+    """Create empty lists of run files for spilled phrase and lexical pair
+    counts.
+
+    Returns a 2-tuple (phrase runs, lex runs) where each element is a
+    2-tuple of lists of run files (sorted on (l1, l2), sorted on (l2, l1))
+    """
+    return (([], []), ([], []))
+
+def spill_freqs(freqs, runs, tmp_dir):
+    """Write the phrase and lexical pair counters to sorted run files.
+
+    Keyword arguments:
+    freqs -- 2-tuple of phrase and lexical counters as made by new_freqs
+    runs -- lists of run files as made by new_runs. The new run files are
+            appended
+    tmp_dir -- directory for the run files
+    """
+    for counters, (direct_runs, inverse_runs) in zip(freqs, runs):
+        pair_freqs = counters[0]
+        direct_runs.append(extsort.write_run(sorted([(l1, l2, freq)
+            for (l1, l2), freq in pair_freqs.iteritems()]), tmp_dir))
+        inverse_runs.append(extsort.write_run(sorted([(l2, l1, freq)
+            for (l1, l2), freq in pair_freqs.iteritems()]), tmp_dir))
+
+def extract_phrase_pair_runs(alignments_file, language1_file, language2_file,
+                             max_length, sentence_weights_file,
+                             memory_budget, tmp_dir, algorithm = 'expand',
+                             stats = None, alignment_cache = None):
+    """Same as extract_phrase_pair_freqs, but the counts are spilled to
+    sorted run files whenever more than memory_budget distinct pairs are
+    counted. The weights of the sentence pairs are summed per run, so
+    weighted counts can differ from those of extract_phrase_pair_freqs in
+    the last digits (see test_freqs_parity).
+
+    Keyword arguments:
+    memory_budget -- maximum number of distinct phrase and lexical pairs
+                     kept in memory
+    tmp_dir -- directory for the run files
+    stats -- pipestats.PipelineStats or None (default is None)
+    alignment_cache -- LRUCache of phrase alignments, or None
+                       (default is None)
+
+    Returns lists of run files as made by new_runs
+    """
+    runs = new_runs()
+    freqs = new_freqs()
+    for str_align, l1_line, l2_line, weight in sentence_pairs_gen(
+            alignments_file, language1_file, language2_file,
+            sentence_weights_file):
+        timed_sentence_freqs(stats, freqs, str_align, l1_line, l2_line,
+                             max_length, weight, algorithm, None,
+                             alignment_cache)
+        if len(freqs[0][0]) + len(freqs[1][0]) >= memory_budget:
+            spill_freqs(freqs, runs, tmp_dir)
+            freqs = new_freqs()
+
+    spill_freqs(freqs, runs, tmp_dir)
+    return runs
+
+def conditional_probabilities_sorted(pair_freqs):
+    """Calculate the conditional probability P(b | a) of pairs (a, b) that
+    are sorted on a.
+
+    Keyword arguments:
+    pair_freqs -- iterable of 3-tuples (a, b, count) sorted on a
+
+    Yield 4-tuple (a, b, count, P(b | a))
+    """
+    for _, group in itertools.groupby(pair_freqs, lambda pair: pair[0]):
+        group = list(group)
+        total = sum([freq for _, _, freq in group])
+        for a, b, freq in group:
+            yield a, b, freq, float(freq) / total
+
+def score_runs(runs, budget, tmp_dir):
+    """Streaming equivalent of conditional_probabilities for counts that are
+    spilled to run files. The pair counts are divided by the l1 phrase
+    counts using the runs sorted on (l1, l2) and by the l2 phrase counts
+    using the runs sorted on (l2, l1), after which the latter are sorted on
+    (l1, l2) again.
+
+    Keyword arguments:
+    runs -- 2-tuple of lists of run files (sorted on (l1, l2),
+            sorted on (l2, l1))
+    budget -- maximum number of records kept in memory for sorting
+    tmp_dir -- directory for run files
+
+    Yield 5-tuple (l1, l2, count, l1_given_l2, l2_given_l1) sorted on
+          (l1, l2), where the probabilities are the same as those returned
+          by conditional_probabilities. The phrase counts are the sums of
+          the pair counts, so for weighted counts they can differ in the
+          last digits
+    """
+    direct_runs, inverse_runs = runs
+    direct = conditional_probabilities_sorted(
+        extsort.sum_sorted(extsort.merge_runs(direct_runs)))
+    inverse = conditional_probabilities_sorted(
+        extsort.sum_sorted(extsort.merge_runs(inverse_runs)))
+    l2_given_l1 = extsort.external_sort(((l1, l2, prob)
+        for l2, l1, _, prob in inverse), budget, tmp_dir)
+    for (l1, l2, freq, l1_l2), (_, _, l2_l1) in itertools.izip(direct,
+                                                               l2_given_l1):
+        yield l1, l2, freq, l1_l2, l2_l1
+
+def conditional_probabilities_runs(runs, budget, tmp_dir):
+    """Same as conditional_probabilities, but for counts that are spilled to
+    run files. Used for lexical pairs, which are looked up at random.
+
+    Returns 2 dictionaries mapping a pair to P(l1 | l2) and P(l2 | l1)
+    """
+    l1_given_l2 = {}
+    l2_given_l1 = {}
+    for l1, l2, _, l1_l2, l2_l1 in score_runs(runs, budget, tmp_dir):
+        l1_given_l2[(l1, l2)] = l1_l2
+        l2_given_l1[(l1, l2)] = l2_l1
+
+    return l1_given_l2, l2_given_l1
+
+def prune_freqs(phrase_freqs, pruning, vocabulary = None, stats = None):
+    """Remove the phrase pairs that are pruned by prune.prune_groups_gen
+    from the counter of phrase pairs. The phrase counters are not changed,
+    so the kept pairs have the same probabilities as without pruning.
+
+    Keyword arguments:
+    phrase_freqs -- 3-tuple of counters (pairs, l1 phrases, l2 phrases)
+    pruning -- 3-tuple (min_count, top_k, min_significance) of
+               prune.prune_groups_gen
+    vocabulary -- vocabulary of the phrase ids the counters are keyed by,
+                  or None if they are keyed by strings (default is None)
+    stats -- pipestats.PipelineStats or None (default is None)
+    """
+    phrase_pair_freqs, l1_phrase_freqs, l2_phrase_freqs = phrase_freqs
+    if vocabulary:
+        split = id_to_pair
+    else:
+        split = lambda pair: pair
+    # sorted keys are grouped by l1 phrase, both for pair ids and tuples
+    keys = sorted(phrase_pair_freqs)
+    groups = ([(key, phrase_pair_freqs[key], l1_phrase_freqs[split(key)[0]],
+                l2_phrase_freqs[split(key)[1]]) for key in group]
+              for _, group in itertools.groupby(keys,
+                                                lambda key: split(key)[0]))
+    num_pruned = 0
+    for key, kept in prune.prune_groups_gen(groups,
+            sum(l1_phrase_freqs.itervalues()), *pruning):
+        if not kept:
+            del phrase_pair_freqs[key]
+            num_pruned += 1
+
+    prune.report(num_pruned, len(keys), stats)
+
+def prune_table(table, pruning, stats = None):
+    """Same as prune_freqs, but for a table of a binary frequency file.
+
+    Keyword arguments:
+    table -- 4-tuple of numpy arrays (pair ids, pair counts, l1 counts,
+             l2 counts)
+
+    Returns table without the pruned phrase pairs
+    """
+    index, counts, l1_counts, l2_counts = table
+    l1_ids = (index >> 32).tolist()
+    l2_ids = (index & 0xffffffff).tolist()
+    pair_counts = counts.tolist()
+    groups = ([(row, pair_counts[row], l1_counts[l1_ids[row]],
+                l2_counts[l2_ids[row]]) for row in group]
+              for _, group in itertools.groupby(xrange(len(l1_ids)),
+                                                l1_ids.__getitem__))
+    kept = numpy.fromiter((kept for _, kept in prune.prune_groups_gen(
+        groups, float(l1_counts.sum()), *pruning)), numpy.bool_, len(index))
+    prune.report(len(index) - int(kept.sum()), len(index), stats)
+    return index[kept], counts[kept], l1_counts, l2_counts
+
+def prune_scored_gen(scored_pairs, pruning, stats = None):
+    """Same as prune_freqs, but for the stream of scored phrase pairs of
+    score_runs. The phrase counts are derived from the probabilities. The
+    significance can not be used, since it needs the count of all phrase
+    pairs before the stream starts.
+
+    Keyword arguments:
+    scored_pairs -- iterable of 5-tuples as yielded by score_runs
+    pruning -- 2-tuple (min_count, top_k)
+
+    Yield the 5-tuples of the kept phrase pairs
+    """
+    groups = ([(scored, scored[2], scored[2] / scored[3],
+                scored[2] / scored[4]) for scored in group]
+              for _, group in itertools.groupby(scored_pairs,
+                                                lambda scored: scored[0]))
+    num_pairs = 0
+    num_pruned = 0
+    for scored, kept in prune.prune_groups_gen(groups, None, *pruning):
+        num_pairs += 1
+        if kept:
+            yield scored
+        else:
+            num_pruned += 1
+
+    prune.report(num_pruned, num_pairs, stats)
+
+def extract_shard_freqs((alignments_file, language1_file, language2_file,
+                         max_length, sentence_weights_file, algorithm,
+                         use_vocabulary, cache_size, num_lines, offsets)):
+    """Extract phrase pair frequencies of num_lines sentence pairs, or of
+    all sentence pairs up to the end of the files if num_lines is None,
+    starting at offsets, the byte offsets of the first line of the shard in
+    the files. Used as worker by extract_phrase_pair_freqs_parallel. With
+    sentence weights the freqs are made by new_weight_freqs, so they can be
+    merged exactly.
+
+    Returns the same as extract_phrase_pair_freqs, the vocabulary of the
+            shard if use_vocabulary is True, otherwise None, the hits and
+            misses of the phrase alignment cache of the shard and the
+            number of sentence pairs extracted
+    """
+    if sentence_weights_file:
+        freqs = new_weight_freqs()
+    else:
+        freqs = new_freqs()
+    if use_vocabulary:
+        vocabulary = new_vocabulary()
+    else:
+        vocabulary = None
+    if cache_size:
+        alignment_cache = LRUCache(cache_size)
+    else:
+        alignment_cache = None
+    files = [open(alignments_file, 'r', BUFFER_SIZE),
+             open(language1_file, 'r', BUFFER_SIZE),
+             open(language2_file, 'r', BUFFER_SIZE)]
+    if sentence_weights_file:
+        files.append(open(sentence_weights_file, 'r', BUFFER_SIZE))
+
+    for doc, offset in zip(files, offsets):
+        doc.seek(offset)
+    num_sentences = 0
+    for line_tuple in itertools.islice(itertools.izip(*files), num_lines):
+        if sentence_weights_file:
+            weight = float(line_tuple[3].strip())
+        else:
+            weight = 1
+
+        add_sentence_freqs(freqs, line_tuple[0], line_tuple[1],
+                           line_tuple[2], max_length, weight, algorithm,
+                           vocabulary, alignment_cache)
+        num_sentences += 1
+
+    for doc in files:
+        doc.close()
+
+    if alignment_cache != None:
+        cache_counts = (alignment_cache.hits, alignment_cache.misses)
+    else:
+        cache_counts = (0, 0)
+    return freqs, vocabulary, cache_counts, num_sentences
+
+def lines_at_offsets(file_name, byte_offsets):
+    """Find the first line that starts at or after each of a sorted list of
+    byte offsets. The lines before the last offset are counted in a single
+    pass over the file, reading it in blocks.
+
+    Keyword arguments:
+    file_name -- name of an uncompressed file
+    byte_offsets -- sorted list of byte offsets
+
+    Returns list of 2-tuples (line number, byte offset at which the line
+            starts). The line number is the number of lines of the file if
+            no line starts at or after the offset
+    """
+    starts = []
+    doc = open(file_name, 'rb')
+    # number of lines before position
+    line = 0
+    position = 0
+    for byte_offset in byte_offsets:
+        if byte_offset > position:
+            doc.seek(byte_offset - 1)
+            doc.readline()
+            line_start = doc.tell()
+            doc.seek(position)
+            while position < line_start:
+                block = doc.read(min(BUFFER_SIZE, line_start - position))
+                if not block:
+                    # the offset is beyond the end of the file
+                    break
+                line += block.count('\n')
+                position += len(block)
+        starts.append((line, position))
+
+    doc.close()
+    return starts
+
+def line_offsets(file_name, line_numbers):
+    """Find the byte offsets at which lines of a file start, by counting the
+    newlines in blocks of the file.
+
+    Keyword arguments:
+    file_name -- name of an uncompressed file
+    line_numbers -- sorted list of line numbers
+
+    Returns list of the byte offset of each line number
+    """
+    offsets = []
+    doc = open(file_name, 'rb')
+    block = ''
+    block_offset = 0
+    # the line with number line starts at position start of block
+    start = 0
+    line = 0
+    for line_number in line_numbers:
+        while line < line_number:
+            newlines = block.count('\n', start)
+            if line + newlines < line_number:
+                line += newlines
+                block_offset += len(block)
+                block = doc.read(BUFFER_SIZE)
+                start = 0
+                if not block:
+                    doc.close()
+                    raise ValueError('%s has only %d lines' % (file_name,
+                                                               line))
+            else:
+                start = block.index('\n', start) + 1
+                line += 1
+        offsets.append(block_offset + start)
+
+    doc.close()
+    return offsets
+
+def extract_phrase_pair_freqs_parallel(alignments_file, language1_file,
+                                       language2_file, max_length,
+                                       sentence_weights_file, workers,
+                                       algorithm = 'expand',
+                                       vocabulary = None, stats = None,
+                                       alignment_cache = None):
+    """Same as extract_phrase_pair_freqs, but the corpus is split in shards
+    that are extracted by a pool of processes. The shards are about equally
+    large parts of the alignments file: the lines at which they start are
+    found in one pass over the alignments file, and their byte offsets in
+    the other files in one pass over each of them, so every process seeks
+    to its own shard and the corpus is not counted beforehand. The files
+    must be uncompressed. The counters of the shards are merged in corpus
+    order, and with sentence weights the shards keep the weights of every
+    count (see new_weight_freqs), so the counts are the same as those of
+    extract_phrase_pair_freqs. The progress is measured in bytes of the
+    alignments file of the merged shards.
+
+    Keyword arguments:
+    workers -- number of processes
+    algorithm -- name of the phrase alignment extractor in EXTRACTORS
+    vocabulary -- vocabulary the phrase ids of all shards are mapped to
+    stats -- pipestats.PipelineStats the number of sentence pairs is
+             recorded in, or None
+    alignment_cache -- LRUCache whose size is used for the caches of the
+                       shards and to which their hits and misses are added,
+                       or None
+
+    Returns the same as extract_phrase_pair_freqs
+    """
+    if alignment_cache != None:
+        cache_size = alignment_cache.size
+    else:
+        cache_size = 0
+    file_names = [alignments_file, language1_file, language2_file]
+    if sentence_weights_file:
+        file_names.append(sentence_weights_file)
+    # more shards than workers so that slow shards do not stall the pool
+    num_shards = workers * 4
+    size = os.path.getsize(alignments_file)
+    starts = [(0, 0)]
+    for line, offset in lines_at_offsets(alignments_file,
+            [size * i // num_shards for i in xrange(1, num_shards)]):
+        if offset < size and line > starts[-1][0]:
+            starts.append((line, offset))
+    line_numbers = [line for line, _ in starts]
+    offsets = zip(*[[offset for _, offset in starts]] +
+                  [line_offsets(name, line_numbers)
+                   for name in file_names[1:]])
+    ends = line_numbers[1:] + [None]
+    byte_ends = [offset for _, offset in starts[1:]] + [size]
+    shards = [(alignments_file, language1_file, language2_file, max_length,
+               sentence_weights_file, algorithm, vocabulary != None,
+               cache_size, end - start if end != None else None,
+               shard_offsets)
+              for start, end, shard_offsets in zip(line_numbers, ends,
+                                                   offsets)]
+    freqs = new_freqs()
+    bar = progress.file_progress(alignments_file)
+    pool = multiprocessing.Pool(workers)
+    try:
+        for byte_end, (shard_freqs, shard_vocabulary, (hits, misses),
+                       num_sentences) in zip(byte_ends,
+                pool.imap(extract_shard_freqs, shards)):
+            if alignment_cache != None:
+                alignment_cache.hits += hits
+                alignment_cache.misses += misses
+            if vocabulary != None:
+                shard_freqs = translate_freqs(shard_freqs, shard_vocabulary,
+                                              vocabulary)
+            merge_freqs(freqs, shard_freqs)
+            if stats != None:
+                stats.add('sentences', num_sentences)
+            bar.update(byte_end)
+    finally:
+        pool.close()
+        pool.join()
+
+    bar.finish(size)
+    return freqs
+
+def sentence_batches_gen(sentence_pairs, batch_size):
+    """Group sentence pairs in lists of batch_size, the last one may be
+    shorter."""
+    batch = []
+    for sentence_pair in sentence_pairs:
+        batch.append(sentence_pair)
+        if len(batch) >= batch_size:
+            yield batch
+            batch = []
+
+    if batch:
+        yield batch
+
+def read_batches(batches, tasks, num_workers, in_flight, metrics):
+    """Reader stage of extract_phrase_pair_freqs_pipelined, run by a thread.
+    Put the numbered batches in the task queue, followed by a None for every
+    worker. A batch is only read when the number of batches that are not
+    merged yet is below the limit of in_flight.
+
+    Keyword arguments:
+    batches -- iterator of lists of sentence pairs
+    tasks -- queue of 2-tuples (batch number, list of sentence pairs)
+    num_workers -- number of extraction workers
+    in_flight -- threading.Semaphore released when a batch is merged
+    metrics -- dictionary in which the seconds spent reading and stalled
+               and an exception of the reader are stored
+    """
+    try:
+        for number in itertools.count():
+            start = time.time()
+            batch = next(batches, None)
+            metrics['read_seconds'] += time.time() - start
+            if batch == None:
+                break
+
+            start = time.time()
+            in_flight.acquire()
+            tasks.put((number, batch))
+            metrics['stall_seconds'] += time.time() - start
+    except Exception:
+        metrics['error'] = traceback.format_exc()
+    finally:
+        for _ in xrange(num_workers):
+            tasks.put(None)
+
+def extract_batches(tasks, results, max_length, algorithm, use_vocabulary,
+                    cache_size, weighted = False):
+    """Extraction stage of extract_phrase_pair_freqs_pipelined, run by a
+    process. Extract phrase pair frequencies of the batches of the task
+    queue until it gets None, and put them in the result queue. If weighted
+    is True the freqs are made by new_weight_freqs, so they can be merged
+    exactly.
+
+    Puts 4-tuples (batch number, freqs, vocabulary of the batch or None,
+    number of sentence pairs). Finally puts a 2-tuple (None, dictionary of
+    the seconds spent extracting, waiting for a batch and stalled on a full
+    result queue and the hits and misses of the phrase alignment cache), or
+    (None, traceback) if the extraction failed.
+    """
+    metrics = {'busy_seconds': 0.0, 'wait_seconds': 0.0,
+               'stall_seconds': 0.0, 'cache_hits': 0, 'cache_misses': 0}
+    if cache_size:
+        alignment_cache = LRUCache(cache_size)
+    else:
+        alignment_cache = None
+    try:
+        while True:
+            start = time.time()
+            task = tasks.get()
+            metrics['wait_seconds'] += time.time() - start
+            if task == None:
+                break
+
+            start = time.time()
+            number, batch = task
+            if weighted:
+                freqs = new_weight_freqs()
+            else:
+                freqs = new_freqs()
+            if use_vocabulary:
+                vocabulary = new_vocabulary()
+            else:
+                vocabulary = None
+            for str_align, l1_line, l2_line, weight in batch:
+                add_sentence_freqs(freqs, str_align, l1_line, l2_line,
+                                   max_length, weight, algorithm, vocabulary,
+                                   alignment_cache)
+            metrics['busy_seconds'] += time.time() - start
+
+            start = time.time()
+            results.put((number, freqs, vocabulary, len(batch)))
+            metrics['stall_seconds'] += time.time() - start
+    except Exception:
+        results.put((None, traceback.format_exc()))
+        return
+
+    if alignment_cache != None:
+        metrics['cache_hits'] = alignment_cache.hits
+        metrics['cache_misses'] = alignment_cache.misses
+    results.put((None, metrics))
+
+def queue_length(queue):
+    """Returns approximate number of items in a multiprocessing queue, or
+    None on platforms that can not tell"""
+    try:
+        return queue.qsize()
+    except NotImplementedError:
+        return None
+
+def extract_phrase_pair_freqs_pipelined(alignments_file, language1_file,
+                                        language2_file, max_length,
+                                        sentence_weights_file, workers,
+                                        batch_size, queue_size,
+                                        algorithm = 'expand',
+                                        vocabulary = None, stats = None,
+                                        alignment_cache = None):
+    """Same as extract_phrase_pair_freqs, but the reading, extraction and
+    counting run at the same time as the stages of a pipeline: a thread
+    reads batches of sentence pairs, a pool of processes extracts their
+    phrase pairs and this process merges the counters of the batches in
+    corpus order. With sentence weights the batches keep the weights of
+    every count (see new_weight_freqs), so the counts are the same as those
+    of extract_phrase_pair_freqs. The stages are connected by queues of at most queue_size
+    batches, and at most 2 * queue_size + workers batches are read but not
+    merged, so the memory is bounded however fast the corpus is read. The
+    time each stage spends working and waiting and the lengths of the
+    queues are shown and recorded in stats if it is not None.
+
+    Keyword arguments:
+    workers -- number of extraction processes
+    batch_size -- number of sentence pairs per batch
+    queue_size -- maximum number of batches in each queue
+    algorithm -- name of the phrase alignment extractor in EXTRACTORS
+    vocabulary -- vocabulary the phrase ids of all batches are mapped to
+    alignment_cache -- LRUCache whose size is used for the caches of the
+                       workers and to which their hits and misses are added,
+                       or None
+
+    Returns the same as extract_phrase_pair_freqs
+    """
+    if alignment_cache != None:
+        cache_size = alignment_cache.size
+    else:
+        cache_size = 0
+    tasks = multiprocessing.Queue(queue_size)
+    results = multiprocessing.Queue(queue_size)
+    in_flight = threading.Semaphore(2 * queue_size + workers)
+    reader_metrics = {'read_seconds': 0.0, 'stall_seconds': 0.0}
+    reader = threading.Thread(target=read_batches, args=(
+        sentence_batches_gen(sentence_pairs_gen(alignments_file,
+            language1_file, language2_file, sentence_weights_file),
+            batch_size),
+        tasks, workers, in_flight, reader_metrics))
+    reader.daemon = True
+    processes = [multiprocessing.Process(target=extract_batches,
+                                         args=(tasks, results, max_length,
+                                               algorithm,
+                                               vocabulary != None,
+                                               cache_size,
+                                               bool(sentence_weights_file)))
+                 for _ in xrange(workers)]
+    for process in processes:
+        process.daemon = True
+        process.start()
+    reader.start()
+
+    freqs = new_freqs()
+    worker_metrics = []
+    # batches that are extracted before those preceding them
+    pending = {}
+    next_number = 0
+    merge_metrics = {'busy_seconds': 0.0, 'wait_seconds': 0.0}
+    num_batches = 0
+    queue_lengths = ([], [])
+    try:
+        while len(worker_metrics) < workers:
+            start = time.time()
+            result = results.get()
+            merge_metrics['wait_seconds'] += time.time() - start
+            for lengths, queue in zip(queue_lengths, (tasks, results)):
+                length = queue_length(queue)
+                if length != None:
+                    lengths.append(length)
+
+            if result[0] == None:
+                if not isinstance(result[1], dict):
+                    raise RuntimeError('extraction worker failed:\n%s' %
+                                       result[1])
+                worker_metrics.append(result[1])
+                continue
+
+            pending[result[0]] = result[1:]
+            start = time.time()
+            while next_number in pending:
+                batch_freqs, batch_vocabulary, num_sentences = \
+                    pending.pop(next_number)
+                if vocabulary != None:
+                    batch_freqs = translate_freqs(batch_freqs,
+                        batch_vocabulary, vocabulary)
+                merge_freqs(freqs, batch_freqs)
+                if stats != None:
+                    stats.add('sentences', num_sentences)
+                next_number += 1
+                num_batches += 1
+                in_flight.release()
+            merge_metrics['busy_seconds'] += time.time() - start
+    finally:
+        for process in processes:
+            if process.is_alive():
+                process.terminate()
+            process.join()
+
+    reader.join()
+    if 'error' in reader_metrics:
+        raise RuntimeError('reading the corpus failed:\n%s' %
+                           reader_metrics['error'])
+
+    if alignment_cache != None:
+        alignment_cache.hits += sum([metrics['cache_hits']
+                                     for metrics in worker_metrics])
+        alignment_cache.misses += sum([metrics['cache_misses']
+                                       for metrics in worker_metrics])
+    report_pipeline(num_batches, queue_size, queue_lengths, reader_metrics,
+                    worker_metrics, merge_metrics, stats)
+    return freqs
+
+def report_pipeline(num_batches, queue_size, queue_lengths, reader_metrics,
+                    worker_metrics, merge_metrics, stats = None):
+    """Show the time the stages of extract_phrase_pair_freqs_pipelined
+    spent working and waiting, and the mean and maximum length of its
+    queues, and record them in stats if it is not None. A stage that is
+    often stalled on a full queue is faster than the next stage; one that
+    waits a lot for its queue is slower than the previous one.
 
-    sys.stdout.write('\n')
-    return ((phrase_pair_freqs, l1_phrase_freqs, l2_phrase_freqs),
-            (lex_pair_freqs, l1_lex_freqs, l2_lex_freqs))
+    Keyword arguments:
+    num_batches -- number of batches of sentence pairs
+    queue_size -- maximum number of batches in each queue
+    queue_lengths -- 2-tuple of lists of the lengths of the task and
+                     result queue, sampled whenever a result was taken
+    reader_metrics -- dictionary of the seconds of the reader
+    worker_metrics -- list of dictionaries of the seconds of each worker
+    merge_metrics -- dictionary of the seconds of the merging stage
+    """
+    worker_totals = dict((item, sum([metrics[item]
+                                     for metrics in worker_metrics]))
+                         for item in ('busy_seconds', 'wait_seconds',
+                                      'stall_seconds'))
+    print 'pipeline: %d batches, %d extraction workers, queue size %d' % \
+        (num_batches, len(worker_metrics), queue_size)
+    print '  reader: %.1fs reading, %.1fs stalled on the task queue' % \
+        (reader_metrics['read_seconds'], reader_metrics['stall_seconds'])
+    print '  extraction (all workers): %.1fs extracting, %.1fs waiting for ' \
+        'batches, %.1fs stalled on the result queue' % \
+        (worker_totals['busy_seconds'], worker_totals['wait_seconds'],
+         worker_totals['stall_seconds'])
+    print '  merge: %.1fs merging, %.1fs waiting for results' % \
+        (merge_metrics['busy_seconds'], merge_metrics['wait_seconds'])
+    values = {'batches': num_batches}
+    for name, metrics in (('reader', reader_metrics),
+                          ('extract', worker_totals),
+                          ('merge', merge_metrics)):
+        for item, seconds in metrics.iteritems():
+            values['%s_%s' % (name, item)] = seconds
+    for name, lengths in zip(('task', 'result'), queue_lengths):
+        if lengths:
+            mean_length = sum(lengths) / float(len(lengths))
+            print '  %s queue: mean length %.1f, max %d' % \
+                (name, mean_length, max(lengths))
+            values['%s_queue_mean_length' % name] = mean_length
+            values['%s_queue_max_length' % name] = max(lengths)
+
+    if stats != None:
+        for item, value in values.iteritems():
+            stats.set('pipeline_' + item, value)
+
+def file_fingerprint(file_name, offset):
+    """Hash the first and last FINGERPRINT_SIZE bytes before offset of a
+    file, to detect whether that part has changed.
+
+    Keyword arguments:
+    file_name -- name of file
+    offset -- number of bytes of the file that are fingerprinted
+
+    Returns hex digest, or None if the file is shorter than offset
+    """
+    if os.path.getsize(file_name) < offset:
+        return None
+
+    digest = hashlib.sha1(str(offset))
+    doc = open(file_name, 'rb')
+    digest.update(doc.read(min(offset, FINGERPRINT_SIZE)))
+    doc.seek(max(offset - FINGERPRINT_SIZE, 0))
+    digest.update(doc.read(min(offset, FINGERPRINT_SIZE)))
+    doc.close()
+    return digest.hexdigest()
+
+def new_checkpoint(corpus_files, settings):
+    """Create a checkpoint of a corpus of which nothing is extracted yet.
+
+    Keyword arguments:
+    corpus_files -- list of names of the alignments, language 1, language 2
+                    and optionally sentence weights files
+    settings -- tuple of the settings the counts depend on
+
+    Returns dictionary with the number of extracted sentence pairs ('lines'),
+            the settings ('settings') and a list of 3-tuples (file name,
+            offset, fingerprint) of the corpus files ('files')
+    """
+    return {'lines': 0, 'settings': settings,
+            'files': [(file_name, 0, file_fingerprint(file_name, 0))
+                      for file_name in corpus_files]}
+
+def checkpoint_problem(checkpoint, corpus_files, settings):
+    """Check whether the counts of a checkpoint can be updated with the
+    sentence pairs that are appended to the corpus files.
+
+    Returns a description of the problem, or None if there is none
+    """
+    if checkpoint['settings'] != settings:
+        return 'settings changed from %s to %s' % (checkpoint['settings'],
+                                                   settings)
+    if [file_name for file_name, _, _ in checkpoint['files']] != \
+            corpus_files:
+        return 'corpus files changed'
+    for file_name, offset, fingerprint in checkpoint['files']:
+        if file_fingerprint(file_name, offset) != fingerprint:
+            return '%s was modified before offset %d' % (file_name, offset)
+
+    return None
+
+def extract_appended_freqs(freqs, checkpoint, max_length, algorithm =
+                           'expand', vocabulary = None, stats = None,
+                           alignment_cache = None):
+    """Add the frequencies of the sentence pairs that were appended to the
+    corpus files after a checkpoint. The extraction stops before the first
+    sentence pair of which a line does not end with a newline, which may
+    still be being written, so it is extracted in the next update.
+
+    Keyword arguments:
+    freqs -- 2-tuple of phrase and lexical counters as made by new_freqs,
+             containing the counts up to the checkpoint
+    checkpoint -- checkpoint as made by new_checkpoint
+    max_length -- maximum length of phrase pairs
+    algorithm -- name of the phrase alignment extractor in EXTRACTORS
+                 (default is 'expand')
+    vocabulary -- vocabulary the counters are keyed by (default is None)
+    stats -- pipestats.PipelineStats or None (default is None)
+    alignment_cache -- LRUCache of phrase alignments, or None
+                       (default is None)
+
+    Returns new checkpoint after the last sentence pair
+    """
+    files = []
+    for file_name, offset, _ in checkpoint['files']:
+        doc = open(file_name, 'r', BUFFER_SIZE)
+        doc.seek(offset)
+        files.append(doc)
+
+    offsets = [offset for _, offset, _ in checkpoint['files']]
+    num_lines = checkpoint['lines']
+    alignments_file, start = checkpoint['files'][0][:2]
+    bar = progress.Progress(os.path.getsize(alignments_file) - start)
+    for line_tuple in itertools.izip(*files):
+        if [line for line in line_tuple if not line.endswith('\n')]:
+            print 'Stopping before incomplete line %d.' % (num_lines + 1,)
+            break
+
+        if len(line_tuple) > 3:
+            weight = float(line_tuple[3].strip())
+        else:
+            weight = 1
+        timed_sentence_freqs(stats, freqs, line_tuple[0], line_tuple[1],
+                             line_tuple[2], max_length, weight, algorithm,
+                             vocabulary, alignment_cache)
+        offsets = [offset + len(line)
+                   for offset, line in zip(offsets, line_tuple)]
+        num_lines += 1
+        bar.update(offsets[0] - start)
+
+    for doc in files:
+        doc.close()
+
+    bar.finish(offsets[0] - start)
+    print '%d new sentence pairs' % (num_lines - checkpoint['lines'],)
+    return {'lines': num_lines, 'settings': checkpoint['settings'],
+            'files': [(file_name, offset, file_fingerprint(file_name, offset))
+                      for (file_name, _, _), offset in
+                      zip(checkpoint['files'], offsets)]}
+
+def update_incremental(state_file, corpus_files, max_length, algorithm,
+                       use_vocabulary, stats = None, alignment_cache = None):
+    """Update the counts stored in a state file with the sentence pairs that
+    were appended to the corpus since it was written. If the state file
+    does not exist or does not match the corpus, the whole corpus is
+    extracted.
+
+    Keyword arguments:
+    state_file -- name of pickle file containing the checkpoint, the counts
+                  and the vocabulary
+    corpus_files -- list of names of the alignments, language 1, language 2
+                    and optionally sentence weights files
+    max_length -- maximum length of phrase pairs
+    algorithm -- name of the phrase alignment extractor in EXTRACTORS
+    use_vocabulary -- whether the counters are keyed by phrase ids
+    stats -- pipestats.PipelineStats or None (default is None)
+    alignment_cache -- LRUCache of phrase alignments, or None
+                       (default is None)
+
+    Returns phrase freqs, lex freqs and vocabulary (or None)
+    """
+    settings = (max_length, algorithm, use_vocabulary, len(corpus_files))
+    state = None
+    if os.path.exists(state_file):
+        state_doc = open(state_file, 'rb')
+        state = pickle.load(state_doc)
+        state_doc.close()
+        problem = checkpoint_problem(state[0], corpus_files, settings)
+        if problem:
+            print 'Extracting the whole corpus: %s.' % problem
+            state = None
+        else:
+            print 'Extracting sentence pairs after line %d.' % \
+                state[0]['lines']
+
+    if state == None:
+        if use_vocabulary:
+            vocabulary = new_vocabulary()
+        else:
+            vocabulary = None
+        state = (new_checkpoint(corpus_files, settings), new_freqs(),
+                 vocabulary)
+
+    checkpoint, freqs, vocabulary = state
+    checkpoint = extract_appended_freqs(freqs, checkpoint, max_length,
+                                        algorithm, vocabulary, stats,
+                                        alignment_cache)
+
+    # write to a temporary file first, so an interrupted run keeps the old
+    # state
+    state_doc = open(state_file + '.temp', 'wb')
+    pickle.dump((checkpoint, freqs, vocabulary), state_doc,
+                pickle.HIGHEST_PROTOCOL)
+    state_doc.close()
+    os.rename(state_file + '.temp', state_file)
+    phrase_freqs, lex_freqs = freqs
+    return phrase_freqs, lex_freqs, vocabulary
 
 def extract_phrase_pairs_gen(phrase_alignments, l1_words, l2_words):
     """Given alignments, extract phrase pairs from 2 sentences
@@ -196,13 +2338,30 @@ def extract_phrase_pairs_gen(phrase_alignments, l1_words, l2_words):
         yield (' '.join(l1_words[min1:max1+1]),
                ' '.join(l2_words[min2:max2+1]))
 
-def unaligned_phrase_pairs_gen(unaligned, l1_words, l2_words):
+def extract_phrase_id_pairs_gen(phrase_alignments, l1_word_ids, l2_word_ids,
+                                vocabulary):
+    """Same as extract_phrase_pairs_gen, but the phrases are given by their
+    id in the vocabulary.
+
+    Keyword arguments:
+    l1_word_ids -- ids of the words in language 1
+    l2_word_ids -- ids of the words in language 2
+    vocabulary -- vocabulary as made by new_vocabulary
+
+    Yield a 2-tuple containing the phrase ids of a phrase pair
+    """
+    phrase_ids = vocabulary[1]
+    for min1, min2, max1, max2 in phrase_alignments:
+        yield (key_to_id(phrase_ids, phrase_key(l1_word_ids[min1:max1+1])),
+               key_to_id(phrase_ids, phrase_key(l2_word_ids[min2:max2+1])))
+
+def unaligned_phrase_pairs_gen(unaligned, l1_words, l2_words, null = 'NULL'):
     """For unaligned words create an alignment with 'NULL'."""
     for (a1, a2) in unaligned:
         if a1 == None:
-            yield ('NULL', l2_words[a2])
+            yield (null, l2_words[a2])
         elif a2 == None:
-            yield (l1_words[a1], 'NULL')
+            yield (l1_words[a1], null)
 
 def str_to_alignments(string):
     """Parse an alignment from a string
@@ -368,16 +2527,99 @@ def extract_alignments(word_alignments, l1_length, l2_length, max_length):
 
     return phrase_alignment_list
 
+def extract_alignments_projection(word_alignments, l1_length, l2_length,
+                                  max_length):
+    """Extracts all alignments between 2 sentences given a word alignment.
+    Gives the same result as extract_alignments, but each span in language 1
+    is projected onto language 2 and checked for consistency in constant
+    time.
+
+    Keyword arguments:
+    word_alignemnts -- set of 2-tuples denoting alignment between words in
+                       2 sentences
+    l1_length -- length of sentence 1
+    l2_length -- length of sentence 2
+    max_length -- maximum length of a phrase pair
+
+    Returns set of 4-tuples denoting the range of phrase_alignments
+    """
+    # per position in language 1 the min and max aligned position in
+    # language 2, and per language the cumulative number of alignments
+    l2_min = [None] * l1_length
+    l2_max = [None] * l1_length
+    l1_aligned = [0] * (l1_length+1)
+    l2_aligned = [0] * (l2_length+1)
+    for (a1, a2) in word_alignments:
+        if l2_min[a1] == None or a2 < l2_min[a1]:
+            l2_min[a1] = a2
+        if l2_max[a1] == None or a2 > l2_max[a1]:
+            l2_max[a1] = a2
+        l1_aligned[a1+1] += 1
+        l2_aligned[a2+1] += 1
+    for i in xrange(l1_length):
+        l1_aligned[i+1] += l1_aligned[i]
+    for i in xrange(l2_length):
+        l2_aligned[i+1] += l2_aligned[i]
+
+    phrase_alignment_list = set()
+    for min1 in xrange(l1_length):
+        min2 = max2 = None
+        for max1 in xrange(min1, l1_length):
+            if max1-min1+1 > max_length:
+                break
+            if l2_min[max1] != None:
+                if min2 == None or l2_min[max1] < min2:
+                    min2 = l2_min[max1]
+                if max2 == None or l2_max[max1] > max2:
+                    max2 = l2_max[max1]
+            if min2 == None or max2-min2+1 > max_length:
+                continue
+            # consistent if no word in the l2 span is aligned outside the
+            # l1 span, i.e. both spans contain the same alignments
+            if l2_aligned[max2+1] - l2_aligned[min2] != \
+                    l1_aligned[max1+1] - l1_aligned[min1]:
+                continue
+
+            # extend the l2 span with unaligned words
+            ext_min2 = min2
+            while ext_min2 >= 0 and max2-ext_min2+1 <= max_length:
+                ext_max2 = max2
+                while ext_max2 < l2_length and \
+                        ext_max2-ext_min2+1 <= max_length:
+                    phrase_alignment_list.add((min1, ext_min2, max1,
+                                               ext_max2))
+                    ext_max2 += 1
+                    if ext_max2 < l2_length and \
+                            l2_aligned[ext_max2+1] != l2_aligned[ext_max2]:
+                        break
+
+                ext_min2 -= 1
+                if ext_min2 >= 0 and \
+                        l2_aligned[ext_min2+1] != l2_aligned[ext_min2]:
+                    break
+
+    # add word alignments
+    phrase_alignment_list |= set([phrase_range([a])
+                                  for a in word_alignments])
+
+    return phrase_alignment_list
+
+# algorithms for extracting phrase alignments, selected by name
+EXTRACTORS = {'expand': extract_alignments,
+              'projection': extract_alignments_projection}
+
 def unaligned_words(word_alignments, l1_length, l2_length):
-    """Find unaligned words."""
+    """Find unaligned words, in the order of the sentence."""
     aligned1 = set([])
     aligned2 = set([])
     for (a1, a2) in word_alignments:
         aligned1.add(a1)
         aligned2.add(a2)
 
-    unaligned1 = [(a1, None) for a1 in set(range(l1_length)) - aligned1]
-    unaligned2 = [(None, a2) for a2 in set(range(l2_length)) - aligned2]
+    unaligned1 = [(a1, None) for a1 in xrange(l1_length)
+                  if a1 not in aligned1]
+    unaligned2 = [(None, a2) for a2 in xrange(l2_length)
+                  if a2 not in aligned2]
 
     return unaligned1, unaligned2
 
@@ -411,87 +2653,246 @@ def partial_in_alignment(word, alignment):
     return (alignment[0] <= word[0] <= alignment[2]) != \
            (alignment[1] <= word[1] <= alignment[3])
 
-def lex_pairs_to_file(file_name, l1_given_l2, l2_given_l1, lex_file):
-    """Write lexical pairs and their conditional probabilities to a file."""
-    lex_f2e = open("%s_lex_f2e" % file_name, 'w')
-    lex_e2f = open("%s_lex_e2f" % file_name, 'w')
-    old_lex = open(lex_file, 'r')
-    num_lines = number_of_lines(lex_file)
-    for i, line in enumerate(old_lex):
-        if i % (num_lines/100) == 0:
-            sys.stdout.write('\r%d%%' % (i*100/num_lines,))
-            sys.stdout.flush()
-
-        try:
-            fields = line.strip().split()
-            pair = tuple(fields[0:2])
-            l1_l2 = l1_given_l2[pair]
-            l2_l1 = l2_given_l1[pair]
-            lex_f2e.write("%s %s %.7f\n" % (pair[1], pair[0], l1_l2))
-            lex_e2f.write("%s %s %.7f\n" % (pair[0], pair[1], l2_l1))
-        except:
-            print 'line: %s' % line
-            print 'i: %s' % i
-            raise
+def lex_pairs_to_file(file_name, lex_table, lex_file):
+    """Write lexical pairs and their conditional probabilities to a file.
+    The lex file is read in blocks of lines, and the probabilities of each
+    block are looked up in the LexicalTable at once."""
+    lex_f2e = compressed.open_file(
+        compressed.insert_suffix(file_name, '_lex_f2e'), 'w', BUFFER_SIZE)
+    lex_e2f = compressed.open_file(
+        compressed.insert_suffix(file_name, '_lex_e2f'), 'w', BUFFER_SIZE)
+    old_lex = compressed.open_file(lex_file, 'r', BUFFER_SIZE)
+    bar = progress.file_progress(lex_file)
+    position = 0
+    for lines in iter(lambda: old_lex.readlines(BUFFER_SIZE), []):
+        position += sum(map(len, lines))
+        bar.update(position)
+        write_lex_pairs(lex_f2e, lex_e2f, lex_table,
+                        [tuple(line.strip().split()[0:2]) for line in lines])
 
     lex_f2e.close()
     lex_e2f.close()
     old_lex.close()
-    sys.stdout.write('\n')
-
-def phrase_pairs_to_file(file_name, phrase_l1_given_l2, phrase_l2_given_l1, lex_l1_given_l2,
-        lex_l2_given_l1, phrase_table_file):
+    bar.finish(position)
+
+def write_lex_pairs(lex_f2e, lex_e2f, lex_table, pairs):
+    """Write a batch of lexical pairs with their probabilities in the
+    LexicalTable to the files of both directions. Raises KeyError if a
+    pair is not in the table."""
+    l1_given_l2, l2_given_l1 = lex_table.probabilities_batch(pairs)
+    lex_f2e.writelines(["%s %s %.7f\n" % (pair[1], pair[0], l1_l2)
+                        for pair, l1_l2 in zip(pairs, l1_given_l2)])
+    lex_e2f.writelines(["%s %s %.7f\n" % (pair[0], pair[1], l2_l1)
+                        for pair, l2_l1 in zip(pairs, l2_given_l1)])
+
+def phrase_pairs_to_file(file_name, phrase_probs, lex_table,
+        phrase_table_file, vocabulary = None, lex_cache_size = 0,
+        pruned = False):
     """Write phrase pairs and their conditional probabilities to a file.
+    The phrase table is read in blocks of lines, and the probabilities and
+    lexical weights of each block are looked up at once.
 
     Keyword arguments:
     file_name -- name of file for writing
-    phrase_l1_given_l2 -- dictionary mapping phrase pair (l1,l2) to is conditional
-                   probability P(l1 | l2) for phrase pairs
-    phrase_l2_given_l1 -- dictionary mapping phrase pair (l1,l2) to is conditional
-                   probability P(l2 | l1) for phrase pairs
-    lex_l1_given_l2 -- same as phrsae_l1_given_l2 but for word pairs
-    lex_l2_given_l1 -- same as phrsae_l2_given_l1 but for word pairs
+    phrase_probs -- CountProbabilities or PairTableProbabilities of the
+                    phrase pairs
+    lex_table -- LexicalTable of the word pairs, see lexical_table
     phrase_table_file -- file containing phrase table
+    vocabulary -- vocabulary of the phrase ids the phrase probabilities are
+                  keyed by, or None if they are keyed by strings
+                  (default is None)
+    lex_cache_size -- number of lexical weights that are cached
+                      (default is 0)
+    pruned -- if True, phrase pairs without probabilities were pruned and
+              are left out instead of raising a KeyError (default is False)
+
+    Returns LRUCache of the lexical weights, or None if lex_cache_size is 0
+    """
+    phrase_table = compressed.open_file(
+        compressed.insert_suffix(file_name, '_phrase-table.txt'), 'w',
+        BUFFER_SIZE)
+    old_phrase_table = compressed.open_file(phrase_table_file, 'r',
+                                            BUFFER_SIZE)
+    bar = progress.file_progress(phrase_table_file)
+    position = 0
+    num_lines = 0
+    if lex_cache_size > 0:
+        lex_cache = LRUCache(lex_cache_size)
+    else:
+        lex_cache = None
+    # the blocks create many lists and tuples that are freed right away;
+    # the cyclic garbage collector would go through all counts in memory
+    # again and again
+    gc_enabled = gc.isenabled()
+    gc.disable()
+
+    try:
+        for lines in iter(lambda: old_phrase_table.readlines(BUFFER_SIZE),
+                          []):
+            position += sum(map(len, lines))
+            bar.update(position)
+
+            fields = [line.strip().split(" ||| ", 3) for line in lines]
+            pairs = [(line_fields[0], line_fields[1])
+                     for line_fields in fields]
+            keys = pair_keys(vocabulary, pairs)
+            l1_given_l2, l2_given_l1 = phrase_probs.probabilities_batch(keys)
+            scored = zip(fields, l1_given_l2, l2_given_l1)
+            if None in l1_given_l2:
+                for i, l1_l2 in enumerate(l1_given_l2):
+                    if l1_l2 == None and (not pruned or keys[i] == None):
+                        print 'line: %s' % lines[i]
+                        print 'i: %s ' % (num_lines + i)
+                        raise KeyError(pairs[i])
+                scored = [line_scores for line_scores in scored
+                          if line_scores[1] != None]
+            num_lines += len(lines)
+
+            phrase_table.writelines(phrase_table_lines(scored, lex_table,
+                                                       lex_cache))
+    finally:
+        if gc_enabled:
+            gc.enable()
+
+    phrase_table.close()
+    old_phrase_table.close()
+    bar.finish(position)
+    return lex_cache
+
+def phrase_table_lines(scored, lex_table, lex_cache = None):
+    """Create the lines of the output phrase table for a batch of phrase
+    pairs. The lexical weights that are not cached are calculated for the
+    whole batch at once by lex_table.lexical_weights_batch.
+
+    Keyword arguments:
+    scored -- list of 3-tuples (fields of a line of the moses phrase table
+              split at its first 3 separators, P(l1 | l2) of the phrase
+              pair, P(l2 | l1) of the phrase pair)
+    lex_table -- LexicalTable of the word pairs
+    lex_cache -- LRUCache mapping (l1, l2, alignment) to lexical weights,
+                 or None (default is None)
+
+    Returns list of lines for the phrase table
     """
-    phrase_table = open("%s_phrase-table.txt" % file_name, 'w')
-    old_phrase_table = open(phrase_table_file, 'r')
-    num_lines = number_of_lines(phrase_table_file)
+    alignments = [fields[3].split(" ||| ", 1)[0] for fields, _, _ in scored]
+    if lex_cache == None:
+        weights = lex_table.lexical_weights_batch(
+            [(fields[0], fields[1]) for fields, _, _ in scored], alignments)
+    else:
+        keys = [(fields[0], fields[1], alignment)
+                for (fields, _, _), alignment in zip(scored, alignments)]
+        weights = [lex_cache.get(key) for key in keys]
+        missing = {}
+        for i, lex_weights in enumerate(weights):
+            if lex_weights == None:
+                missing.setdefault(keys[i], []).append(i)
+        # a key that is repeated within the batch is calculated once, so its
+        # repeats count as hits
+        num_repeats = weights.count(None) - len(missing)
+        lex_cache.hits += num_repeats
+        lex_cache.misses -= num_repeats
+        missing_keys = missing.keys()
+        calculated = lex_table.lexical_weights_batch(
+            [key[0:2] for key in missing_keys],
+            [key[2] for key in missing_keys])
+        for key, lex_weights in zip(missing_keys, calculated):
+            for i in missing[key]:
+                weights[i] = lex_weights
+            lex_cache.put(key, lex_weights)
+
+    return ["%s ||| %s ||| %s %s %s %s 2.718 ||| %s\n" % (fields[0],
+            fields[1], l1_l2, lex_l1_l2, l2_l1, lex_l2_l1, fields[3])
+            for (fields, l1_l2, l2_l1), (lex_l1_l2, lex_l2_l1)
+            in itertools.izip(scored, weights)]
+
+def sorted_phrase_pairs_to_file(file_name, scored_pairs, lex_table,
+                                phrase_table_file, budget, tmp_dir,
+                                lex_cache_size = 0, pruned = False):
+    """Same as phrase_pairs_to_file, but the phrase probabilities are read
+    from a stream sorted on phrase pair. The phrase table is sorted on
+    phrase pair as well and joined with the stream, so the output phrase
+    table is sorted on phrase pair.
 
-    for i, line in enumerate(old_phrase_table):
-        if i % (num_lines/100) == 0:
-            sys.stdout.write('\r%d%%' % (i*100/num_lines,))
-            sys.stdout.flush()
+    Keyword arguments:
+    file_name -- name of file for writing
+    scored_pairs -- iterable of 5-tuples as yielded by score_runs
+    lex_table -- LexicalTable of the word pairs, see lexical_table
+    phrase_table_file -- file containing phrase table
+    budget -- maximum number of lines kept in memory for sorting
+    tmp_dir -- directory for run files
+    lex_cache_size -- number of lexical weights that are cached
+                      (default is 0)
+    pruned -- if True, phrase pairs that are not in scored_pairs were
+              pruned and are left out instead of raising a KeyError
+              (default is False)
+
+    Returns LRUCache of the lexical weights, or None if lex_cache_size is 0
+    """
+    old_phrase_table = compressed.open_file(phrase_table_file, 'r',
+                                            BUFFER_SIZE)
+    lines = extsort.external_sort((tuple(line.split(" ||| ", 2)[0:2]) +
+        (line,) for line in old_phrase_table), budget, tmp_dir)
+    old_phrase_table.close()
 
+    phrase_table = compressed.open_file(
+        compressed.insert_suffix(file_name, '_phrase-table.txt'), 'w',
+        BUFFER_SIZE)
+    if lex_cache_size > 0:
+        lex_cache = LRUCache(lex_cache_size)
+    else:
+        lex_cache = None
+    scored_lines = []
+    scored_pairs = iter(scored_pairs)
+    scored = next(scored_pairs, None)
+    for i, (l1, l2, line) in enumerate(lines):
         try:
-            fields = line.strip().split(" ||| ")
-            pair = tuple(fields[0:2])
-            l1_l2 = phrase_l1_given_l2[pair]
-            l2_l1 = phrase_l2_given_l1[pair]
-            alignment = str_to_alignments(fields[3])
-            lex_l1_l2, lex_l2_l1 = calc_lexical_weights(lex_l1_given_l2,
-                lex_l2_given_l1, pair, alignment)
-
-            phrase_table.write("%s ||| %s %s %s %s 2.718 ||| %s\n" %
-                (" ||| ".join(fields[0:2]), l1_l2, lex_l1_l2, l2_l1, lex_l2_l1,
-                " ||| ".join(fields[3:])))
+            while scored != None and scored[0:2] < (l1, l2):
+                scored = next(scored_pairs, None)
+            if scored == None or scored[0:2] != (l1, l2):
+                if pruned:
+                    continue
+                raise KeyError((l1, l2))
+
+            fields = line.strip().split(" ||| ", 3)
+            scored_lines.append((fields, scored[3], scored[4]))
         except:
             print 'line: %s' % line
             print 'i: %s ' % i
             raise
 
+        if len(scored_lines) >= BATCH_SIZE:
+            phrase_table.writelines(phrase_table_lines(scored_lines,
+                                                       lex_table, lex_cache))
+            scored_lines = []
+
+    # finish the stream, e.g. to report the pruned phrase pairs
+    for _ in scored_pairs:
+        pass
+
+    phrase_table.writelines(phrase_table_lines(scored_lines, lex_table,
+                                               lex_cache))
     phrase_table.close()
-    old_phrase_table.close()
-    sys.stdout.write('\n')
+    return lex_cache
 
-def calc_lexical_weights(l1_given_l2, l2_given_l1, pair, alignment):
+def calc_lexical_weights(l1_given_l2, l2_given_l1, pair, alignment,
+                         vocabulary = None):
     l1_words = pair[0].split()
     l2_words = pair[1].split()
+    null = 'NULL'
+    if vocabulary:
+        l1_words = [lookup_phrase(vocabulary, word) for word in l1_words]
+        l2_words = [lookup_phrase(vocabulary, word) for word in l2_words]
+        null = lookup_phrase(vocabulary, null)
+        make_pair = pair_to_id
+    else:
+        make_pair = lambda l1_word, l2_word: (l1_word, l2_word)
     lex_l1_l2 = 1
     lex_l2_l1 = 1
     # aligned words
     for i1, i2 in alignment:
-        lex_l1_l2 *= l1_given_l2[(l1_words[i1], l2_words[i2])]
-        lex_l2_l1 *= l2_given_l1[(l1_words[i1], l2_words[i2])]
+        key = make_pair(l1_words[i1], l2_words[i2])
+        lex_l1_l2 *= l1_given_l2[key]
+        lex_l2_l1 *= l2_given_l1[key]
 
     # words with no alignments
     unaligned, unaligned2 = unaligned_words(alignment, len(l1_words),
@@ -499,37 +2900,22 @@ def calc_lexical_weights(l1_given_l2, l2_given_l1, pair, alignment):
     unaligned.extend(unaligned2)
     for i1, i2 in unaligned:
         if i1 == None:
-            i1_word = 'NULL'
+            i1_word = null
             i2_word = l2_words[i2]
         elif i2 == None:
             i1_word = l1_words[i1]
-            i2_word = 'NULL'
+            i2_word = null
 
-        lex_l1_l2 *= l1_given_l2[(i1_word, i2_word)]
-        lex_l2_l1 *= l2_given_l1[(i1_word, i2_word)]
+        key = make_pair(i1_word, i2_word)
+        lex_l1_l2 *= l1_given_l2[key]
+        lex_l2_l1 *= l2_given_l1[key]
 
     return lex_l1_l2, lex_l2_l1
 
-def number_of_lines(file_name):
-    """Counts the number of lines in a file
-
-    Keywords arguments:
-    file_name -- name of file
-
-    Returns number of lines
-    """
-    amount = 0
-    doc = open(file_name, 'r')
-    for _ in doc:
-        amount += 1
-
-    doc.close()
-    return amount
-
 def get_phrase_pair_alignments(file_name):
     """Read phrase pair alignments from a file"""
     phrase_pairs = {}
-    phrase_pairs_file = open(file_name, 'r')
+    phrase_pairs_file = compressed.open_file(file_name, 'r')
     for line in phrase_pairs_file:
         phrase1, phrase2, alignment = line.strip().split(" ||| ")
         phrase_pairs[(phrase1, phrase2)] = alignment
@@ -537,23 +2923,280 @@ def get_phrase_pair_alignments(file_name):
     phrase_pairs_file.close()
     return phrase_pairs
 
-def freqs_to_file(file_name, freqs):
+def freqs_to_file(file_name, freqs, vocabulary = None):
+    """Write the counts of phrase pairs and phrases to the files
+    file_name.pairs, file_name.l1-phrases and file_name.l2-phrases.
+
+    Keyword arguments:
+    file_name -- prefix of the files for writing
+    freqs -- 3-tuple of counters (phrase pairs, phrases in language 1,
+             phrases in language 2)
+    vocabulary -- vocabulary of the phrase ids the counters are keyed by,
+                  or None if they are keyed by strings (default is None)
+    """
     phrase_pair_freqs, l1_phrase_freqs, l2_phrase_freqs = freqs
-    doc_phrase_pairs = open("%s.pairs" % file_name, 'w')
-    doc_l1_phrases = open("%s.l1-phrases" % file_name, 'w')
-    doc_l2_phrases = open("%s.l2-phrases" % file_name, 'w')
-    for phrase_pair, freq in phrase_pair_freqs.iteritems():
+    doc_phrase_pairs = compressed.open_file(
+        compressed.insert_suffix(file_name, '.pairs'), 'w', BUFFER_SIZE)
+    doc_l1_phrases = compressed.open_file(
+        compressed.insert_suffix(file_name, '.l1-phrases'), 'w', BUFFER_SIZE)
+    doc_l2_phrases = compressed.open_file(
+        compressed.insert_suffix(file_name, '.l2-phrases'), 'w', BUFFER_SIZE)
+    if vocabulary:
+        # decode every phrase once, for its own line and those of its pairs
+        l1_strings, l2_strings = [dict((phrase_id,
+            decode_phrase(vocabulary, phrase_id)) for phrase_id in phrase_freqs)
+            for phrase_freqs in (l1_phrase_freqs, l2_phrase_freqs)]
+        doc_phrase_pairs.writelines("%s ||| %s ||| %s\n" %
+            (l1_strings[pair_id >> 32], l2_strings[pair_id & 0xffffffff],
+             freq) for pair_id, freq in phrase_pair_freqs.iteritems())
+    else:
+        l1_strings = l2_strings = None
+        doc_phrase_pairs.writelines("%s ||| %s ||| %s\n" % (l1, l2, freq)
+            for (l1, l2), freq in phrase_pair_freqs.iteritems())
+    for phrase_freqs, strings, doc in (
+            (l1_phrase_freqs, l1_strings, doc_l1_phrases),
+            (l2_phrase_freqs, l2_strings, doc_l2_phrases)):
+        if strings != None:
+            doc.writelines("%s ||| %s\n" % (strings[phrase], freq)
+                           for phrase, freq in phrase_freqs.iteritems())
+        else:
+            doc.writelines("%s ||| %s\n" % (phrase, freq)
+                           for phrase, freq in phrase_freqs.iteritems())
+
+    doc_phrase_pairs.close()
+    doc_l1_phrases.close()
+    doc_l2_phrases.close()
+
+def sorted_freqs_to_file(file_name, runs):
+    """Same as freqs_to_file, but for counts that are spilled to run files.
+    The phrase pairs and phrases are written in sorted order.
+
+    Keyword arguments:
+    file_name -- prefix of the files for writing
+    runs -- 2-tuple of lists of run files (sorted on (l1, l2),
+            sorted on (l2, l1))
+    """
+    direct_runs, inverse_runs = runs
+    doc_phrase_pairs = compressed.open_file(
+        compressed.insert_suffix(file_name, '.pairs'), 'w')
+    doc_l1_phrases = compressed.open_file(
+        compressed.insert_suffix(file_name, '.l1-phrases'), 'w')
+    doc_l2_phrases = compressed.open_file(
+        compressed.insert_suffix(file_name, '.l2-phrases'), 'w')
+    direct = extsort.sum_sorted(extsort.merge_runs(direct_runs))
+    for phrase, group in itertools.groupby(direct, lambda pair: pair[0]):
+        freq_sum = 0
+        for l1, l2, freq in group:
+            doc_phrase_pairs.write("%s ||| %s ||| %s\n" % (l1, l2, freq))
+            freq_sum += freq
+        doc_l1_phrases.write("%s ||| %s\n" % (phrase, freq_sum))
+    inverse = extsort.sum_sorted(extsort.merge_runs(inverse_runs))
+    for phrase, group in itertools.groupby(inverse, lambda pair: pair[0]):
+        doc_l2_phrases.write("%s ||| %s\n" %
+                             (phrase, sum([freq for _, _, freq in group])))
+
+    doc_phrase_pairs.close()
+    doc_l1_phrases.close()
+    doc_l2_phrases.close()
+
+def binary_freqs_to_file(file_name, strings, table, integer_counts):
+    """Same as freqs_to_file, but for a table of a binary frequency file.
+
+    Keyword arguments:
+    file_name -- prefix of the files for writing
+    strings -- StringTable of the binary frequency file
+    table -- 4-tuple of numpy arrays (pair ids, pair counts, l1 counts,
+             l2 counts)
+    integer_counts -- whether the counts are written as integers
+    """
+    if integer_counts:
+        to_freq = int
+    else:
+        to_freq = float
+    pair_ids, pair_freqs, l1_freqs, l2_freqs = table
+    doc_phrase_pairs = compressed.open_file(
+        compressed.insert_suffix(file_name, '.pairs'), 'w', BUFFER_SIZE)
+    doc_l1_phrases = compressed.open_file(
+        compressed.insert_suffix(file_name, '.l1-phrases'), 'w', BUFFER_SIZE)
+    doc_l2_phrases = compressed.open_file(
+        compressed.insert_suffix(file_name, '.l2-phrases'), 'w', BUFFER_SIZE)
+    for pair_id, freq in itertools.izip(pair_ids, pair_freqs):
+        l1_id, l2_id = id_to_pair(int(pair_id))
         doc_phrase_pairs.write("%s ||| %s ||| %s\n" %
-                              (phrase_pair[0], phrase_pair[1], freq))
-    for phrase, freq in l1_phrase_freqs.iteritems():
-        doc_l1_phrases.write("%s ||| %s\n" % (phrase, freq))
-    for phrase, freq in l2_phrase_freqs.iteritems():
-        doc_l2_phrases.write("%s ||| %s\n" % (phrase, freq))
+            (strings[l1_id], strings[l2_id], to_freq(freq)))
+    for phrase_freqs, doc in ((l1_freqs, doc_l1_phrases),
+                              (l2_freqs, doc_l2_phrases)):
+        for phrase_id in numpy.flatnonzero(phrase_freqs):
+            doc.write("%s ||| %s\n" % (strings[phrase_id],
+                                       to_freq(phrase_freqs[phrase_id])))
 
     doc_phrase_pairs.close()
     doc_l1_phrases.close()
     doc_l2_phrases.close()
 
+def binary_pipeline(freqs_file, output_name, phrase_table_file, lex_file,
+                    lex_cache_size = 0, stats = None, pruning = None,
+                    temp_freqs = True):
+    """Score and write phrase pairs with the frequencies of a binary
+    frequency file, which are used in place. The stages are timed in stats
+    if it is not None. The phrase pairs are pruned if pruning is a 3-tuple
+    (min_count, top_k, min_significance) of prune.prune_groups_gen. The
+    frequencies are written to the .temp files if temp_freqs is True.
+    """
+    start_stage(stats, 'read freqs')
+    flags, strings, (phrase_table, lex_table) = \
+        freqfile.read_tables(freqs_file)
+    print 'Freqs read from %s.' % freqs_file
+
+    if temp_freqs:
+        start_stage(stats, 'freqs to file')
+        integer_counts = bool(flags & freqfile.INTEGER_COUNTS)
+        binary_freqs_to_file("extracted_phrase_pairs.temp", strings,
+                             phrase_table, integer_counts)
+        binary_freqs_to_file("extracted_lex_pairs.temp", strings, lex_table,
+                             integer_counts)
+
+    if pruning:
+        start_stage(stats, 'prune phrase pairs')
+        phrase_table = prune_table(phrase_table, pruning, stats)
+
+    start_stage(stats, 'calculate phrase conditional probabilities')
+    phrase_probs = PairTableProbabilities(*binary_probabilities(strings,
+        phrase_table))
+    if stats != None:
+        stats.add('phrase_pairs', len(phrase_table[0]))
+
+    start_stage(stats, 'calculate lex conditional probabilities')
+    lex_probs = lexical_table(*binary_probabilities(strings, lex_table))
+    if stats != None:
+        stats.add('lex_pairs', len(lex_table[0]))
+
+    start_stage(stats, 'phrase pairs to file')
+    lex_cache = phrase_pairs_to_file(output_name, phrase_probs, lex_probs,
+        phrase_table_file, None, lex_cache_size, pruning != None)
+    report_lex_cache(lex_cache, stats)
+
+    start_stage(stats, 'lexical pairs to file')
+    lex_pairs_to_file(output_name, lex_probs, lex_file)
+
+def array_pipeline(array_freqs, vocabulary, integer_counts, output_name,
+                   phrase_table_file, lex_file, lex_cache_size = 0,
+                   stats = None, freqs_file = None, pruning = None,
+                   temp_freqs = True):
+    """Score and write phrase pairs with the counts of ArrayCounts. The
+    probabilities are calculated with vectorized operations, as with a
+    binary frequency file. The stages are timed in stats if it is not None.
+
+    Keyword arguments:
+    array_freqs -- 2-tuple of ArrayCounts as made by new_array_freqs
+    vocabulary -- vocabulary of the pair ids of the counts
+    integer_counts -- whether the counts are written as integers
+    freqs_file -- if given, the counts are written to this binary frequency
+                  file (default is None)
+    pruning -- 3-tuple (min_count, top_k, min_significance) of
+               prune.prune_groups_gen, or None (default is None)
+    temp_freqs -- whether the counts are written to the .temp files
+                  (default is True)
+    """
+    num_phrases = len(vocabulary[1][1])
+    phrase_table, lex_table = [counts.table(num_phrases)
+                               for counts in array_freqs]
+    strings = [decode_phrase(vocabulary, phrase_id)
+               for phrase_id in xrange(num_phrases)]
+    if freqs_file:
+        flags = 0
+        if integer_counts:
+            flags |= freqfile.INTEGER_COUNTS
+        freqfile.write_tables(freqs_file, strings, (phrase_table, lex_table),
+                              flags)
+        print 'Freqs written to %s.' % freqs_file
+
+    if temp_freqs:
+        start_stage(stats, 'freqs to file')
+        binary_freqs_to_file("extracted_phrase_pairs.temp", strings,
+                             phrase_table, integer_counts)
+        binary_freqs_to_file("extracted_lex_pairs.temp", strings, lex_table,
+                             integer_counts)
+
+    if pruning:
+        start_stage(stats, 'prune phrase pairs')
+        phrase_table = prune_table(phrase_table, pruning, stats)
+
+    start_stage(stats, 'calculate phrase conditional probabilities')
+    phrase_probs = PairTableProbabilities(*sorted_array_probabilities(
+        *phrase_table))
+    if stats != None:
+        stats.add('phrase_pairs', len(phrase_table[0]))
+
+    start_stage(stats, 'calculate lex conditional probabilities')
+    lex_probs = lexical_table(*sorted_array_probabilities(*lex_table),
+                              vocabulary=vocabulary)
+    if stats != None:
+        stats.add('lex_pairs', len(lex_table[0]))
+
+    start_stage(stats, 'phrase pairs to file')
+    lex_cache = phrase_pairs_to_file(output_name, phrase_probs, lex_probs,
+        phrase_table_file, vocabulary, lex_cache_size, pruning != None)
+    report_lex_cache(lex_cache, stats)
+
+    start_stage(stats, 'lexical pairs to file')
+    lex_pairs_to_file(output_name, lex_probs, lex_file)
+
+def external_pipeline(alignments, language1, language2, max_length,
+                      sentence_weights, algorithm, output_name,
+                      phrase_table_file, lex_file, memory_budget, tmp_dir,
+                      lex_cache_size = 0, stats = None,
+                      alignment_cache = None, pruning = None,
+                      temp_freqs = True):
+    """Extract, score and write phrase pairs with at most memory_budget
+    distinct pairs in memory at a time. The counts are spilled to sorted run
+    files in a temporary directory, which is removed afterwards. The stages
+    are timed in stats if it is not None. The scored phrase pairs are pruned
+    while they are written if pruning is a 2-tuple (min_count, top_k) of
+    prune.prune_groups_gen. The counts are written to the .temp files if
+    temp_freqs is True.
+    """
+    tmp_dir = tempfile.mkdtemp(prefix='ppe-', dir=tmp_dir)
+    try:
+        start_stage(stats, 'extract phrase pairs')
+        phrase_runs, lex_runs = extract_phrase_pair_runs(alignments,
+            language1, language2, max_length, sentence_weights,
+            memory_budget, tmp_dir, algorithm, stats, alignment_cache)
+        report_alignment_cache(alignment_cache, stats)
+
+        if temp_freqs:
+            start_stage(stats, 'freqs to file')
+            sorted_freqs_to_file("extracted_phrase_pairs.temp", phrase_runs)
+            sorted_freqs_to_file("extracted_lex_pairs.temp", lex_runs)
+
+        start_stage(stats, 'calculate lex conditional probabilities')
+        lex_probs = lexical_table(*conditional_probabilities_runs(
+            lex_runs, memory_budget, tmp_dir))
+        if stats != None:
+            stats.add('lex_pairs', len(lex_probs))
+
+        start_stage(stats, 'calculate phrase conditional probabilities and '
+                    'write phrase pairs to file')
+        scored_pairs = score_runs(phrase_runs, memory_budget, tmp_dir)
+        if pruning:
+            scored_pairs = prune_scored_gen(scored_pairs, pruning, stats)
+        lex_cache = sorted_phrase_pairs_to_file(output_name, scored_pairs,
+            lex_probs, phrase_table_file, memory_budget, tmp_dir,
+            lex_cache_size, pruning != None)
+        report_lex_cache(lex_cache, stats)
+
+        start_stage(stats, 'lexical pairs to file')
+        lex_pairs_to_file(output_name, lex_probs, lex_file)
+    finally:
+        shutil.rmtree(tmp_dir)
+
+def write_stats(stats, file_name):
+    """Write the statistics of the pipeline to a JSON file if stats is not
+    None."""
+    if stats != None:
+        stats.write(file_name)
+        print 'Stats written to %s.' % file_name
+
 def main():
     """Read the following arguments from the cmd line:
     - name of file containing the alignments
@@ -583,8 +3226,107 @@ def main():
         help="File containing lexical pairs. e2f")
     arg_parser.add_argument("-pickle", "--pickle", action='store_true',
         default=False, help="Pickle or unpickle freqs.")
+    arg_parser.add_argument("-workers", "--workers", type=int, default=1,
+        help="Number of processes used for extracting phrase pairs.")
+    arg_parser.add_argument("-algorithm", "--algorithm", default='expand',
+        choices=sorted(EXTRACTORS),
+        help="Algorithm for extracting phrase alignments.")
+    arg_parser.add_argument("-vocab", "--vocabulary", action='store_true',
+        default=False,
+        help="Count phrases by integer ids instead of strings. With numpy "
+             "the counts are kept in arrays of float64 as with "
+             "--array_counts float64, unless they are needed as counters "
+             "for --pickle, --incremental, --workers or --pipeline.")
+    arg_parser.add_argument("-budget", "--memory_budget", type=int,
+        help="Maximum number of distinct phrase pairs kept in memory. "
+             "Counts are spilled to sorted files on disk and merged.")
+    arg_parser.add_argument("-tmp", "--tmp_dir",
+        help="Directory for temporary files of --memory_budget.")
+    arg_parser.add_argument("-numpy", "--numpy", action='store_true',
+        default=False,
+        help="Calculate probabilities with vectorized numpy operations.")
+    arg_parser.add_argument("-lex_cache", "--lex_cache_size", type=int,
+        default=0,
+        help="Number of lexical weights of the phrase table that are cached.")
+    arg_parser.add_argument("-freqs", "--freqs_file",
+        help="Binary frequency file. If it exists the frequencies are read "
+             "from it instead of extracted, otherwise it is written after "
+             "extracting. Requires numpy.")
+    arg_parser.add_argument("-inc", "--incremental",
+        help="State file with the counts and a checkpoint of the corpus. "
+             "Only sentence pairs appended since the last run are "
+             "extracted.")
+    arg_parser.add_argument("-align_cache", "--alignment_cache_size",
+        type=int, default=10000,
+        help="Number of phrase alignments of sentence pairs that are cached, "
+             "keyed by word alignment and sentence lengths.")
+    arg_parser.add_argument("-array_counts", "--array_counts",
+        choices=['float32', 'float64'],
+        help="Count phrase pairs by id in numpy arrays of this type instead "
+             "of counters to save memory. float64 gives the same counts as "
+             "the counters; float32 rounds every weight and count to 7 "
+             "digits. Implies --vocabulary.")
+    arg_parser.add_argument("-min_count", "--min_count", type=float,
+        default=0, help="Prune phrase pairs with a lower count.")
+    arg_parser.add_argument("-top_k", "--top_k", type=int, default=0,
+        help="Keep at most this many phrase pairs per l1 phrase, those with "
+             "the highest P(l2 | l1).")
+    arg_parser.add_argument("-significance", "--min_significance",
+        type=float, default=0,
+        help="Prune phrase pairs whose -log p-value of Fisher's exact test "
+             "is lower.")
+    arg_parser.add_argument("-pipeline", "--pipeline", action='store_true',
+        default=False,
+        help="Read, extract and count at the same time: a thread reads "
+             "batches of sentence pairs, --workers processes extract them "
+             "and the counts are merged, connected by bounded queues.")
+    arg_parser.add_argument("-batch_size", "--batch_size", type=int,
+        default=PIPELINE_BATCH_SIZE,
+        help="Number of sentence pairs per batch of --pipeline.")
+    arg_parser.add_argument("-queue_size", "--queue_size", type=int,
+        help="Maximum number of batches in each queue of --pipeline "
+             "(default is twice the number of workers).")
+    arg_parser.add_argument("-no_temp", "--no_temp_freqs",
+        action='store_true', default=False,
+        help="Do not write the extracted frequencies to the .temp files.")
+    arg_parser.add_argument("-stats", "--stats",
+        help="Write the time, throughput and peak memory of each stage to "
+             "this JSON file.")
 
     args = arg_parser.parse_args()
+    if args.memory_budget and (args.vocabulary or args.pickle or
+                               args.workers > 1 or args.numpy):
+        arg_parser.error("--memory_budget can not be combined with "
+                         "--vocabulary, --pickle, --workers or --numpy")
+    if (args.numpy or args.freqs_file or args.array_counts) and \
+            numpy == None:
+        arg_parser.error("--numpy, --freqs_file and --array_counts require "
+                         "numpy to be installed")
+    if args.array_counts and (args.pickle or args.memory_budget or
+                              args.incremental or args.workers > 1):
+        arg_parser.error("--array_counts can not be combined with --pickle, "
+                         "--memory_budget, --incremental or --workers")
+    if args.freqs_file and (args.pickle or args.memory_budget):
+        arg_parser.error("--freqs_file can not be combined with --pickle "
+                         "or --memory_budget")
+    if args.incremental and (args.pickle or args.memory_budget or
+                             args.freqs_file or args.workers > 1):
+        arg_parser.error("--incremental can not be combined with --pickle, "
+                         "--memory_budget, --freqs_file or --workers")
+    if args.pipeline and (args.memory_budget or args.incremental or
+                          args.array_counts):
+        arg_parser.error("--pipeline can not be combined with "
+                         "--memory_budget, --incremental or --array_counts")
+    if args.batch_size < 1 or (args.queue_size != None and
+                               args.queue_size < 1):
+        arg_parser.error("--batch_size and --queue_size must be at least 1")
+    if args.min_significance and args.memory_budget:
+        arg_parser.error("--min_significance can not be combined with "
+                         "--memory_budget")
+    if args.incremental and [name for name in (args.alignments,
+            args.language1, args.language2, args.sentence_weights)
+            if name and compressed.compression(name)]:
+        arg_parser.error("--incremental requires uncompressed corpus files")
     alignments = args.alignments
     language1 = args.language1
     language2 = args.language2
@@ -599,6 +3341,14 @@ def main():
         sentence_weights = args.sentence_weights
     else:
         sentence_weights = None
+    # with a vocabulary the counts are kept in arrays of float64, which
+    # gives the same counts as the counters, unless they are needed as
+    # counters
+    array_counts = args.array_counts
+    if args.vocabulary and not array_counts and numpy != None and \
+            not (args.pickle or args.incremental or args.workers > 1 or
+                 args.pipeline):
+        array_counts = 'float64'
 
     print 'alignments: %s' % alignments
     print 'language1: %s' % language1
@@ -607,51 +3357,167 @@ def main():
     print 'lex file (e2f): %s' % lex_file
     print 'output name: %s' % output_name
     print 'max length: %s'  % max_length
+    print 'workers: %s' % args.workers
+    print 'pipeline: %s' % args.pipeline
+    print 'algorithm: %s' % args.algorithm
+    print 'vocabulary: %s' % args.vocabulary
+    print 'memory budget: %s' % args.memory_budget
+    print 'incremental: %s' % args.incremental
+    print 'array counts: %s' % array_counts
+    print 'min count: %s' % args.min_count
+    print 'top k: %s' % args.top_k
+    print 'min significance: %s' % args.min_significance
+    print 'alignment cache size: %s' % args.alignment_cache_size
+    print 'temp freqs: %s' % (not args.no_temp_freqs)
+    print 'stats: %s' % args.stats
     print ''
 
-    print 'extract phrase pairs'
-    if args.pickle:
+    if args.stats:
+        stats = pipestats.PipelineStats()
+    else:
+        stats = None
+    if args.alignment_cache_size > 0:
+        alignment_cache = LRUCache(args.alignment_cache_size)
+    else:
+        alignment_cache = None
+    if args.min_count or args.top_k or args.min_significance:
+        pruning = (args.min_count, args.top_k, args.min_significance)
+    else:
+        pruning = None
+    if args.pipeline:
+        pipeline = (args.batch_size, args.queue_size or 2 * args.workers)
+    else:
+        pipeline = None
+
+    if args.memory_budget:
+        external_pipeline(alignments, language1, language2, max_length,
+            sentence_weights, args.algorithm, output_name, phrase_table_file,
+            lex_file, args.memory_budget, args.tmp_dir, args.lex_cache_size,
+            stats, alignment_cache, pruning and pruning[:2],
+            not args.no_temp_freqs)
+        write_stats(stats, args.stats)
+        print 'Done.'
+        return
+
+    if args.vocabulary or array_counts:
+        vocabulary = new_vocabulary()
+    else:
+        vocabulary = None
+
+    if args.freqs_file and os.path.exists(args.freqs_file):
+        binary_pipeline(args.freqs_file, output_name, phrase_table_file,
+                        lex_file, args.lex_cache_size, stats, pruning,
+                        not args.no_temp_freqs)
+        write_stats(stats, args.stats)
+        print 'Done.'
+        return
+
+    start_stage(stats, 'extract phrase pairs')
+    if array_counts:
+        array_freqs = extract_phrase_pair_freqs(alignments, language1,
+            language2, max_length, sentence_weights, 1, args.algorithm,
+            vocabulary, stats, alignment_cache, array_counts)
+        report_alignment_cache(alignment_cache, stats)
+        array_pipeline(array_freqs, vocabulary, sentence_weights == None,
+            output_name, phrase_table_file, lex_file, args.lex_cache_size,
+            stats, args.freqs_file, pruning, not args.no_temp_freqs)
+        write_stats(stats, args.stats)
+        print 'Done.'
+        return
+
+    if args.incremental:
+        corpus_files = [alignments, language1, language2]
+        if sentence_weights:
+            corpus_files.append(sentence_weights)
+        phrase_freqs, lex_freqs, vocabulary = update_incremental(
+            args.incremental, corpus_files, max_length, args.algorithm,
+            args.vocabulary, stats, alignment_cache)
+    elif args.freqs_file:
+        phrase_freqs, lex_freqs = extract_phrase_pair_freqs(alignments,
+            language1, language2, max_length, sentence_weights,
+            args.workers, args.algorithm, vocabulary, stats, alignment_cache,
+            pipeline=pipeline)
+        freqs_to_binary(args.freqs_file, (phrase_freqs, lex_freqs),
+                        vocabulary)
+        print 'Freqs written to %s.' % args.freqs_file
+    elif args.pickle:
         try:
             pickle_file = open("freqs.pickle", 'r')
-            phrase_freqs, lex_freqs = pickle.load(pickle_file)
+            pickled = pickle.load(pickle_file)
             pickle_file.close()
+            phrase_freqs, lex_freqs = pickled[0:2]
+            # freqs pickled with a vocabulary are keyed by phrase ids
+            if len(pickled) > 2:
+                vocabulary = pickled[2]
+            else:
+                vocabulary = None
             print 'Freqs read from freqs.pickle.'
         except:
             print 'Could not find/read freqs.pickle. Creating a new one.'
             phrase_freqs, lex_freqs = extract_phrase_pair_freqs(alignments,
-                language1, language2, max_length, sentence_weights)
+                language1, language2, max_length, sentence_weights,
+                args.workers, args.algorithm, vocabulary, stats,
+                alignment_cache, pipeline=pipeline)
             pickle_file = open("freqs.pickle", 'w')
-            pickle.dump((phrase_freqs, lex_freqs), pickle_file)
+            if vocabulary:
+                pickle.dump((phrase_freqs, lex_freqs, vocabulary),
+                            pickle_file, pickle.HIGHEST_PROTOCOL)
+            else:
+                pickle.dump((phrase_freqs, lex_freqs), pickle_file)
             pickle_file.close()
     else:
         phrase_freqs, lex_freqs = extract_phrase_pair_freqs(alignments, language1, language2,
-            max_length, sentence_weights)
-
-    print 'freqs to file'
-    freqs_to_file("extracted_phrase_pairs.temp", phrase_freqs)
-    freqs_to_file("extracted_lex_pairs.temp", lex_freqs)
-    phrase_pair_freqs, l1_phrase_freqs, l2_phrase_freqs = phrase_freqs
-    lex_pair_freqs, l1_lex_freqs, l2_lex_freqs = lex_freqs
-
-    print 'calculate phrase conditional probabilities'
-    phrase_l1_given_l2, phrase_l2_given_l1 = conditional_probabilities(phrase_pair_freqs,
-                              l1_phrase_freqs, l2_phrase_freqs)
-
-    print 'calculate lex conditional probabilities'
-    lex_l1_given_l2, lex_l2_given_l1 = conditional_probabilities(lex_pair_freqs,
-                              l1_lex_freqs, l2_lex_freqs)
-
-    print 'phrase pairs to file'
-    phrase_pairs_to_file(output_name, phrase_l1_given_l2, phrase_l2_given_l1,
-        lex_l1_given_l2, lex_l2_given_l1, phrase_table_file)
-
-    print 'lexical pairs to file'
-    lex_pairs_to_file(output_name, lex_l1_given_l2, lex_l2_given_l1, lex_file)
-
+            max_length, sentence_weights, args.workers, args.algorithm,
+            vocabulary, stats, alignment_cache, pipeline=pipeline)
+    report_alignment_cache(alignment_cache, stats)
+
+    if not args.no_temp_freqs:
+        start_stage(stats, 'freqs to file')
+        freqs_to_file("extracted_phrase_pairs.temp", phrase_freqs, vocabulary)
+        freqs_to_file("extracted_lex_pairs.temp", lex_freqs, vocabulary)
+    if pruning:
+        start_stage(stats, 'prune phrase pairs')
+        prune_freqs(phrase_freqs, pruning, vocabulary, stats)
+
+    start_stage(stats, 'calculate lex conditional probabilities')
+    if stats != None:
+        stats.add('lex_pairs', len(lex_freqs[0]))
+    if args.numpy:
+        lex_probs = lexical_table(*array_probabilities(*lex_freqs,
+            vocabulary=vocabulary), vocabulary=vocabulary)
+    else:
+        lex_probs = lexical_table_freqs(lex_freqs, vocabulary)
+
+    # without numpy the phrase probabilities are calculated from the counts
+    # while the phrase pairs are written
+    if args.numpy:
+        start_stage(stats, 'calculate phrase conditional probabilities')
+        phrase_probs = PairTableProbabilities(*array_probabilities(
+            *phrase_freqs, vocabulary=vocabulary))
+        start_stage(stats, 'phrase pairs to file')
+    else:
+        phrase_probs = CountProbabilities(phrase_freqs, vocabulary)
+        start_stage(stats, 'calculate phrase conditional probabilities and '
+                    'write phrase pairs to file')
+    if stats != None:
+        stats.add('phrase_pairs', len(phrase_probs))
+    lex_cache = phrase_pairs_to_file(output_name, phrase_probs, lex_probs,
+        phrase_table_file, vocabulary, args.lex_cache_size, pruning != None)
+    report_lex_cache(lex_cache, stats)
+
+    start_stage(stats, 'lexical pairs to file')
+    lex_pairs_to_file(output_name, lex_probs, lex_file)
+
+    write_stats(stats, args.stats)
     print 'Done.'
 
-def test():
-    """For testing purposes."""
+def test_sentences():
+    """Sentence pairs for testing purposes.
+
+    Returns list of sentences in language 1, list of sentences in language 2,
+            list of alignments and a list of phrase pairs that should be
+            extracted from each sentence pair
+    """
     l1_list = ["( applaudissements du groupe PSE ) ",
         "la concentration scandaleuse de pouvoir dans des secteurs d&apos; importance strategique livre a des multinationales uniquement soucieuses de profit l&apos; economie d&apos; Etats tout entiers - et d&apos; Etats membres de l&apos; Union ! ",
         "nous avons considere ce probleme , pensez-vous ! nous l&apos; avons considere et le passons au crible avec une grande attention , notamment grace aux inquietudes que vous avez exposees . ",
@@ -673,6 +3539,11 @@ def test():
         ('! &quot;', 'chapeau &quot;'),
         ('cruel', 'sorely')]
 
+    return l1_list, l2_list, align_list, check_list
+
+def test():
+    """For testing purposes."""
+    l1_list, l2_list, align_list, check_list = test_sentences()
     max_length = 7
     for i in xrange(4, 5):
         result = test_phrase_extraction(align_list[i], l1_list[i], l2_list[i],
@@ -681,14 +3552,288 @@ def test():
         print result[1]
         print result[2]
 
-def test_phrase_extraction(str_align, l1, l2, check, max_length):
+def test_extraction_parity(max_lengths = (1, 2, 3, 5, 7, float('inf'))):
+    """Check that all algorithms in EXTRACTORS extract the same phrase
+    alignments as extract_alignments for the test sentences.
+
+    Keyword arguments:
+    max_lengths -- maximum lengths of phrase pairs to test with
+
+    Returns True if all algorithms agree
+    """
+    l1_list, l2_list, align_list, _ = test_sentences()
+    agree = True
+    for max_length in max_lengths:
+        for str_align, l1, l2 in zip(align_list, l1_list, l2_list):
+            align = set(str_to_alignments(str_align))
+            l1_length = len(l1.split())
+            l2_length = len(l2.split())
+            expected = extract_alignments(set(align), l1_length, l2_length,
+                max_length)
+            for name, extractor in sorted(EXTRACTORS.iteritems()):
+                result = extractor(set(align), l1_length, l2_length,
+                    max_length)
+                if result != expected:
+                    agree = False
+                    print '%s differs (max length %s): %s' % (name,
+                        max_length, str_align)
+                    print 'missing: %s' % sorted(expected - result)
+                    print 'extra: %s' % sorted(result - expected)
+
+    return agree
+
+def parallel_freqs(alignments_file, language1_file, language2_file,
+                   max_length, sentence_weights_file, workers = 3):
+    """Extract the counts by several processes, for test_freqs_parity.
+
+    Keyword arguments:
+    workers -- number of processes (default is 3)
+    """
+    return extract_phrase_pair_freqs(alignments_file, language1_file,
+        language2_file, max_length, sentence_weights_file, workers)
+
+def budget_freqs(alignments_file, language1_file, language2_file,
+                 max_length, sentence_weights_file, memory_budget = 500,
+                 fan_in = extsort.MAX_FAN_IN):
+    """Spill the counts to run files by extract_phrase_pair_runs and add up
+    the merged runs in counters, for test_freqs_parity.
+
+    Keyword arguments:
+    memory_budget -- maximum number of distinct pairs kept in memory
+                     (default is 500)
+    fan_in -- maximum number of runs merged at once; lower than the number
+              of runs to test merging in several passes (default is
+              extsort.MAX_FAN_IN)
+    """
+    run_freqs = new_freqs()
+    tmp_dir = tempfile.mkdtemp(prefix='ppe-')
+    try:
+        runs = extract_phrase_pair_runs(alignments_file, language1_file,
+            language2_file, max_length, sentence_weights_file,
+            memory_budget, tmp_dir)
+        for (direct_runs, _), (pair_freqs, l1_freqs, l2_freqs) in zip(runs,
+                run_freqs):
+            for l1, l2, freq in extsort.sum_sorted(
+                    extsort.merge_runs(direct_runs, tmp_dir, fan_in)):
+                pair_freqs[(l1, l2)] = freq
+                l1_freqs[l1] += freq
+                l2_freqs[l2] += freq
+    finally:
+        shutil.rmtree(tmp_dir)
+
+    return run_freqs
+
+def array_counts_freqs(alignments_file, language1_file, language2_file,
+                       max_length, sentence_weights_file, dtype = 'float64'):
+    """Extract the counts in ArrayCounts and put them in counters keyed by
+    strings, for test_freqs_parity.
+
+    Keyword arguments:
+    dtype -- numpy type of the ArrayCounts (default is 'float64')
+    """
+    vocabulary = new_vocabulary()
+    array_freqs = extract_phrase_pair_freqs(alignments_file, language1_file,
+        language2_file, max_length, sentence_weights_file,
+        vocabulary = vocabulary, array_counts = dtype)
+    num_phrases = len(vocabulary[1][1])
+    strings = [decode_phrase(vocabulary, phrase_id)
+               for phrase_id in xrange(num_phrases)]
+    counted_freqs = []
+    for counts in array_freqs:
+        index, pair_counts, l1_counts, l2_counts = counts.table(num_phrases)
+        l1_ids = set((index >> 32).tolist())
+        l2_ids = set((index & 0xffffffff).tolist())
+        counted_freqs.append((
+            Counter(dict(((strings[l1], strings[l2]), count)
+                         for (l1, l2), count in itertools.izip(
+                             itertools.imap(id_to_pair, index.tolist()),
+                             pair_counts.tolist()))),
+            Counter(dict((strings[l1], l1_counts[l1]) for l1 in l1_ids)),
+            Counter(dict((strings[l2], l2_counts[l2]) for l2 in l2_ids))))
+
+    return counted_freqs
+
+# extractions that test_freqs_parity compares with the serial counters
+PARITY_EXTRACTIONS = {'parallel': parallel_freqs,
+                      'budget': budget_freqs,
+                      'array_counts': array_counts_freqs}
+
+def test_freqs_parity(alignments_file, language1_file, language2_file,
+                      extraction, sentence_weights_file = None,
+                      max_length = 7, tolerance = 0, **options):
+    """Check that an extraction of PARITY_EXTRACTIONS gives the same counts
+    as the serial extract_phrase_pair_freqs. 'parallel' and 'array_counts'
+    with float64 add the weights in corpus order, so their counts are
+    exactly the same, also with sentence weights. 'budget' sums weighted
+    counts per run and float32 'array_counts' rounds every weight, so those
+    only agree within a relative tolerance, such as 1e-12 and 1e-6.
+
+    Keyword arguments:
+    alignments_file -- file that contains the alignments
+    language1_file -- file containing sentences from language 1
+    language2_file -- file containing sentences from language 2
+    extraction -- name of the extraction in PARITY_EXTRACTIONS
+    sentence_weights_file -- file containing weights for each sentence pair
+                             or None (default is None)
+    max_length -- maximum length of phrase pairs (default is 7)
+    tolerance -- maximum relative difference of two counts, 0 for exactly
+                 the same counts (default is 0)
+    options -- keyword arguments of the extraction, e.g. workers,
+               memory_budget, fan_in or dtype
+
+    Returns True if the counts agree
+    """
+    freqs = extract_phrase_pair_freqs(alignments_file, language1_file,
+        language2_file, max_length, sentence_weights_file)
+    other_freqs = PARITY_EXTRACTIONS[extraction](alignments_file,
+        language1_file, language2_file, max_length, sentence_weights_file,
+        **options)
+    agree = True
+    for counters, other_counters in zip(freqs, other_freqs):
+        for counter, other_counter in zip(counters, other_counters):
+            if set(counter) != set(other_counter):
+                agree = False
+                print 'different keys: %d and %d' % (len(counter),
+                                                     len(other_counter))
+                continue
+            for key, count in counter.iteritems():
+                other_count = other_counter[key]
+                if count != other_count and \
+                        abs(count - other_count) > tolerance * abs(count):
+                    agree = False
+                    print 'differs: %s %r %r' % (key, count, other_count)
+
+    return agree
+
+def test_external_sort(num_records = 2000, budget = 10, fan_in = 3):
+    """Check that extsort.external_sort and extsort.sum_sorted give the same
+    records and counts as sorting and counting in memory, with more runs
+    than fan_in, so that they are merged in several passes.
+
+    Keyword arguments:
+    num_records -- number of records to sort (default is 2000)
+    budget -- number of records per run (default is 10)
+    fan_in -- maximum number of runs merged at once (default is 3)
+
+    Returns True if the results are the same
+    """
+    records = [('l1 %d' % (i * 7919 % 97), 'l2 %d' % (i % 13), i % 5 + 1)
+               for i in xrange(num_records)]
+    counts = Counter()
+    for l1, l2, count in records:
+        counts[(l1, l2)] += count
+    tmp_dir = tempfile.mkdtemp(prefix='ppe-')
+    try:
+        sorted_records = list(extsort.external_sort(iter(records), budget,
+                                                    tmp_dir, fan_in))
+        # the runs and the intermediate runs of the last pass
+        num_files = len(os.listdir(tmp_dir))
+        summed = list(extsort.sum_sorted(extsort.external_sort(
+            iter(records), budget, tmp_dir, fan_in)))
+    finally:
+        shutil.rmtree(tmp_dir)
+
+    # external_sort writes the records left after the last full run, if
+    # any, to one more run
+    num_runs = num_records // budget + 1
+    same = sorted_records == sorted(records) and \
+        summed == sorted(key + (count,) for key, count in counts.iteritems())
+    if num_files > num_runs + fan_in:
+        same = False
+        print 'intermediate runs are not removed: %d files' % num_files
+
+    return same
+
+def test_string_ids(num_strings = 200000):
+    """Check that the ids of the strings of a binary frequency file are
+    found in its hash index, also for strings with the same hash, one by
+    one and in batches, and that missing strings are not found.
+
+    Keyword arguments:
+    num_strings -- number of strings in the file, enough for some of their
+                   hashes to be the same (default is 200000)
+
+    Returns True if every string is found with its own id
+    """
+    strings = ['phrase %s' % hashlib.md5(str(i)).hexdigest()[:12]
+               for i in xrange(num_strings)]
+    missing = ['missing %d' % i for i in xrange(1000)]
+    file_name = tempfile.mktemp(prefix='ppe-', suffix='.freqs')
+    try:
+        freqfile.write_tables(file_name, strings, [])
+        _, string_table, _ = freqfile.read_tables(file_name)
+        ids = string_table.ids()
+        hashes = string_table.hashes
+        num_shared = int((hashes[1:] == hashes[:-1]).sum())
+        same = ids.ids_batch(strings + missing + [None]).tolist() == \
+            range(num_strings) + [-1] * (len(missing) + 1)
+        same = same and all(ids[string] == i
+                            for i, string in enumerate(strings))
+        same = same and not any(string in ids for string in missing)
+    finally:
+        os.remove(file_name)
+
+    print '%d hashes shared by more than one string' % num_shared
+    return same
+
+def test_lexical_table_parity(phrase_table_file, l1_given_l2, l2_given_l1,
+                              vocabulary = None):
+    """Check that LexicalTable.lexical_weights_batch gives the same lexical
+    weights as calc_lexical_weights for the phrase pairs of a phrase table.
+
+    Keyword arguments:
+    phrase_table_file -- file containing phrase table in the moses format
+    l1_given_l2 -- dictionary mapping a word pair to P(l1 | l2)
+    l2_given_l1 -- dictionary mapping a word pair to P(l2 | l1)
+    vocabulary -- vocabulary of the phrase ids the probabilities are keyed
+                  by, or None if they are keyed by strings (default is None)
+
+    Returns True if the lexical weights are the same
+    """
+    lex_table = lexical_table(l1_given_l2, l2_given_l1, vocabulary)
+    doc = compressed.open_file(phrase_table_file, 'r')
+    fields = [line.strip().split(" ||| ") for line in doc]
+    doc.close()
+    pairs = [tuple(line_fields[0:2]) for line_fields in fields]
+    alignments = [line_fields[3] for line_fields in fields]
+    same = True
+    for pair, alignment, lex_weights in zip(pairs, alignments,
+            lex_table.lexical_weights_batch(pairs, alignments)):
+        expected = calc_lexical_weights(l1_given_l2, l2_given_l1, pair,
+            str_to_alignments(alignment), vocabulary)
+        if lex_weights != expected:
+            same = False
+            print 'differs: %s %s %s' % (pair, lex_weights, expected)
+
+    # the lexical table of a fully aligned corpus has no NULL, and an
+    # alignment must not link the words of the next phrase pair
+    aligned_l1_given_l2 = {('a', 'x'): 0.5, ('b', 'y'): 0.25}
+    aligned_l2_given_l1 = {('a', 'x'): 1.0, ('b', 'y'): 0.5}
+    aligned_table = lexical_table(aligned_l1_given_l2, aligned_l2_given_l1)
+    lex_weights = aligned_table.lexical_weights_batch(
+        [('a b', 'x y'), ('b', 'y')], ['0-0 1-1', '0-0'])
+    if lex_weights != [(0.125, 0.5), (0.25, 0.5)]:
+        same = False
+        print 'differs for a fully aligned corpus: %s' % lex_weights
+    try:
+        aligned_table.lexical_weights_batch([('a b', 'x'), ('b', 'y')],
+                                            ['1-1', '0-0'])
+        same = False
+        print 'no error for an alignment outside its phrase pair'
+    except IndexError:
+        pass
+
+    return same
+
+def test_phrase_extraction(str_align, l1, l2, check, max_length,
+                           algorithm = 'expand'):
     l1_words = l1.strip().split()
     l2_words = l2.strip().split()
     l1_length = len(l1_words)
     l2_length = len(l2_words)
 
     align = str_to_alignments(str_align)
-    phrase_alignments = extract_alignments(set(align), l1_length,
+    phrase_alignments = EXTRACTORS[algorithm](set(align), l1_length,
         l2_length, max_length)
 
     phrase_pairs = set(extract_phrase_pairs_gen(phrase_alignments, l1_words,
@@ -705,3 +3850,4 @@ def test_phrase_extraction(str_align, l1, l2, check, max_length):
 if __name__ == '__main__':
     main()
     #test()
+    #print test_extraction_parity()
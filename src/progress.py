@@ -0,0 +1,96 @@
+# progress
+
+"""
+Progress of long running loops, shown on one line with the percentage done,
+the throughput and the estimated time remaining. The progress of reading a
+file is measured in bytes, so the file does not have to be read beforehand
+to count its lines.
+"""
+
+import os
+import sys
+import time
+import compressed
+
+class Progress(object):
+    """Shows the progress of a loop at most every interval seconds.
+
+    Keyword arguments:
+    total -- total amount of work, or None if it is unknown
+    unit -- unit of the amount of work. Bytes are shown in KB, MB or GB
+            (default is 'B')
+    interval -- minimum number of seconds between updates (default is 0.5)
+    """
+
+    def __init__(self, total = None, unit = 'B', interval = 0.5):
+        self.total = total
+        self.unit = unit
+        self.interval = interval
+        self.started = time.time()
+        self.shown = self.started
+        # amount of work after which the time is checked again
+        if total:
+            self.step = max(total // 1000, 1)
+        else:
+            self.step = 1 << 20 if unit == 'B' else 1000
+        self.next_check = self.step
+
+    def update(self, done):
+        """Set the amount of work done, and show it if the last update was
+        more than interval seconds ago"""
+        if done < self.next_check:
+            return
+
+        self.next_check = done + self.step
+        now = time.time()
+        if now - self.shown >= self.interval:
+            self.shown = now
+            self.show(done, now)
+
+    def show(self, done, now):
+        """Write the progress line"""
+        elapsed = now - self.started
+        rate = done / elapsed if elapsed > 0 else 0.0
+        if self.unit == 'B':
+            text = '%s, %s/s' % (format_bytes(done), format_bytes(rate))
+        else:
+            text = '%d %s, %d %s/s' % (done, self.unit, rate, self.unit)
+        if self.total:
+            text = '%d%% (%s' % (min(done * 100 // self.total, 100), text)
+            if rate > 0 and done < self.total:
+                text += ', ETA %s' % format_seconds((self.total - done) / rate)
+            text += ')'
+        sys.stdout.write('\r%s   ' % text)
+        sys.stdout.flush()
+
+    def finish(self, done = None):
+        """Show the final amount of work and end the line"""
+        if done == None:
+            done = self.total or 0
+        now = time.time()
+        self.show(done, now)
+        sys.stdout.write('in %s\n' % format_seconds(now - self.started))
+        sys.stdout.flush()
+
+def format_bytes(size):
+    """Format a number of bytes in KB, MB or GB"""
+    for unit in ('KB', 'MB'):
+        size /= 1024.0
+        if size < 1024:
+            return '%.1f %s' % (size, unit)
+
+    return '%.1f GB' % (size / 1024.0)
+
+def format_seconds(seconds):
+    """Format a number of seconds as h:mm:ss"""
+    seconds = int(max(seconds, 0))
+    return '%d:%02d:%02d' % (seconds // 3600, seconds // 60 % 60,
+                             seconds % 60)
+
+def file_progress(file_name, interval = 0.5):
+    """Progress of reading a file, in bytes. The total is unknown for
+    compressed files, since only their decompressed bytes are counted."""
+    if compressed.compression(file_name):
+        return Progress(None, 'B', interval)
+
+    return Progress(os.path.getsize(file_name), 'B', interval)
@@ -0,0 +1,91 @@
+# phrase table pruning
+
+"""
+Pruning of extracted phrase pairs before they are scored and written. A
+phrase pair is kept if its count is at least a minimum count, if it is
+significant by Fisher's exact test on its counts (as in Johnson et al.,
+2007, but with the extraction counts instead of sentence co-occurrence
+counts) and if it is among the top k phrase pairs of its l1 phrase by
+P(l2 | l1). The pairs are pruned in a single pass over a stream that is
+grouped by l1 phrase.
+"""
+
+import heapq
+import math
+
+def log_choose(n, k):
+    """Returns natural logarithm of the binomial coefficient n over k"""
+    return math.lgamma(n + 1) - math.lgamma(k + 1) - math.lgamma(n - k + 1)
+
+def significance(pair_count, l1_count, l2_count, total):
+    """Significance of the association of the phrases of a phrase pair, by
+    the one-sided p-value of Fisher's exact test: the probability of a pair
+    count of at least pair_count if the phrases were independent.
+
+    Keyword arguments:
+    pair_count -- count of the phrase pair
+    l1_count -- count of the l1 phrase in all phrase pairs
+    l2_count -- count of the l2 phrase in all phrase pairs
+    total -- count of all phrase pairs
+
+    Returns -log(p-value). Higher is more significant
+    """
+    rest = total - l1_count - l2_count
+    log_term = (log_choose(l1_count, pair_count) +
+                log_choose(total - l1_count, l2_count - pair_count) -
+                log_choose(total, l2_count))
+    # sum the terms of the hypergeometric distribution relative to the
+    # first one, until they become negligible
+    term = 1.0
+    ratio_sum = 1.0
+    count = pair_count
+    while count < min(l1_count, l2_count):
+        denominator = (count + 1) * (rest + count + 1)
+        if denominator <= 0:
+            break
+        term *= (l1_count - count) * (l2_count - count) / float(denominator)
+        ratio_sum += term
+        count += 1
+        if term < ratio_sum * 1e-12:
+            break
+
+    return max(-(log_term + math.log(ratio_sum)), 0.0)
+
+def prune_groups_gen(groups, total, min_count = 0, top_k = 0,
+                     min_significance = 0):
+    """Decide which phrase pairs of a stream are kept.
+
+    Keyword arguments:
+    groups -- iterable of lists of 4-tuples (key, pair count, l1 count,
+              l2 count), where all pairs of a list have the same l1 phrase
+    total -- count of all phrase pairs, for the significance
+    min_count -- minimum count of a phrase pair (default is 0)
+    top_k -- number of phrase pairs per l1 phrase, or 0 for no maximum
+             (default is 0). Pairs with the same count as the k-th pair are
+             kept as well, so the result does not depend on the order of
+             the group
+    min_significance -- minimum significance (see significance), or 0 to
+                        keep insignificant pairs (default is 0)
+
+    Yield 2-tuple (key, whether the phrase pair is kept)
+    """
+    for group in groups:
+        kept = [pair for pair in group if pair[1] >= min_count and
+                (not min_significance or
+                 significance(pair[1], pair[2], pair[3], total) >=
+                 min_significance)]
+        if top_k and len(kept) > top_k:
+            # within a group P(l2 | l1) is proportional to the pair count
+            min_top_count = heapq.nlargest(top_k, [pair[1]
+                                                   for pair in kept])[-1]
+            kept = [pair for pair in kept if pair[1] >= min_top_count]
+        kept_keys = set([pair[0] for pair in kept])
+        for pair in group:
+            yield pair[0], pair[0] in kept_keys
+
+def report(num_pruned, num_pairs, stats = None):
+    """Show the number of pruned phrase pairs and record it in stats if it
+    is not None."""
+    print 'pruned %d of %d phrase pairs' % (num_pruned, num_pairs)
+    if stats != None:
+        stats.add('pruned_phrase_pairs', num_pruned)